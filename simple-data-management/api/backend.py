@@ -0,0 +1,84 @@
+import os
+from contextlib import nullcontext
+
+# Which engine persists the records: 'csv' (students.csv) or 'sqlite'
+STORAGE = os.environ.get('SDM_STORAGE', 'csv')
+SQLITE_FILE = os.environ.get('SDM_SQLITE_FILE', 'students.db')
+# Number of files the 'csv' engine spreads records over; 1 keeps them all in students.csv
+SHARDS = int(os.environ.get('SDM_SHARDS', '1'))
+
+class StorageBackend:
+    # Persistence engine underneath the RecordStore. Engines hand records around
+    # as {"id", "first_name", "last_name", "date_of_birth"} dicts and report
+    # failures as error strings, like the rest of api/.
+
+    def key(self):
+        # A value that changes whenever the stored data does, including changes
+        # made by other processes
+        raise NotImplementedError
+
+    def generation(self):
+        # Like key(), but the same in every process that sees the same stored
+        # data, so it can name that data to clients; None if there is no such value
+        return self.key()
+
+    def load(self):
+        # Every live record, sorted by ID: (records, error)
+        raise NotImplementedError
+
+    def get(self, record_id):
+        # (record, error) for a single record
+        raise NotImplementedError
+
+    def scan(self, cursor=0):
+        # Generator over the records with IDs after cursor, in ID order
+        raise NotImplementedError
+
+    def apply(self, changes, records):
+        # Insert, update and delete: write ("create" | "update" | "delete", record)
+        # changes in order. records is the full live dataset after the changes,
+        # for engines that may need to rewrite everything. Returns an error or None.
+        raise NotImplementedError
+
+    def allocate_id(self):
+        raise NotImplementedError
+
+    def read_lock(self):
+        # Context manager that keeps other threads and processes from writing
+        return nullcontext()
+
+    def write_lock(self):
+        # Context manager for exclusive access, held across a read-modify-write
+        return nullcontext()
+
+    def log_path(self):
+        # Where the RecordStore keeps its write-ahead log for this engine, or None
+        # to keep none
+        return None
+
+    def sync(self):
+        # Make every change applied so far durable. Returns an error or None.
+        return None
+
+    def tombstone_ratio(self):
+        # Share of the storage taken up by deleted data
+        return 0.0
+
+    def compact(self, records):
+        # Reclaim the space held by deleted data. Returns an error or None.
+        return None
+
+    def close(self):
+        pass
+
+def get_backend():
+    if STORAGE == 'sqlite':
+        from .sqlite_backend import SqliteBackend
+        return SqliteBackend(SQLITE_FILE)
+
+    if SHARDS > 1:
+        from .sharded_backend import ShardedBackend
+        return ShardedBackend(SHARDS)
+
+    from .csv_backend import CsvBackend
+    return CsvBackend()
@@ -0,0 +1,6 @@
+from .store import get_store
+
+def apply_batch(operations):
+    # operations: validated dicts with "op" ("create", "update" or "delete"),
+    # "record_id" for updates and deletes, and the name/date fields for writes
+    return get_store().batch(operations)
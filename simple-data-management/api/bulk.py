@@ -0,0 +1,147 @@
+import csv
+import io
+import json
+import zlib
+
+from .file_operations import HEADER
+from .batch import apply_batch
+
+# Valid rows written to storage together, in one flush
+IMPORT_BATCH_SIZE = 1000
+# Rejected rows described in the import result; the rest are only counted
+MAX_IMPORT_ERRORS = 100
+# Records encoded into each chunk of an export
+EXPORT_BATCH_SIZE = 1000
+
+FIELDS = ("first_name", "last_name", "date_of_birth")
+# CSV headers accepted for each field, as exported or as written by hand
+_CSV_COLUMNS = {"first name": "first_name", "first_name": "first_name", "last name": "last_name",
+                "last_name": "last_name", "date of birth": "date_of_birth", "date_of_birth": "date_of_birth"}
+
+def parse_csv(stream):
+    # Yields (line number, fields, error) for each row of a binary CSV stream,
+    # reading it line by line. An ID column is ignored: imported records get new IDs.
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    header = next(reader, None)
+    columns = {}
+    for position, name in enumerate(header or []):
+        field = _CSV_COLUMNS.get(name.strip().lower())
+        if field:
+            columns[field] = position
+    missing = [field for field in FIELDS if field not in columns]
+    if missing:
+        yield 1, None, f"Header must name the columns {', '.join(HEADER[1:])}."
+        return
+
+    for row in reader:
+        if not any(row):
+            continue
+        try:
+            yield reader.line_num, {field: row[columns[field]].strip() for field in FIELDS}, None
+        except IndexError:
+            yield reader.line_num, None, "Row has too few columns."
+
+def parse_ndjson(stream):
+    # Yields (line number, fields, error) for each JSON object of a binary NDJSON stream
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            yield line_number, None, "Line is not valid JSON."
+            continue
+        if not isinstance(item, dict):
+            yield line_number, None, "Each line must be a JSON object."
+            continue
+        fields = {field: item.get(field, '') for field in FIELDS}
+        wrong = [field for field, value in fields.items() if not isinstance(value, str)]
+        if wrong:
+            yield line_number, None, f"Fields must be strings: {', '.join(wrong)}."
+            continue
+        yield line_number, {field: value.strip() for field, value in fields.items()}, None
+
+def import_records(rows, validate_batch, batch_size=IMPORT_BATCH_SIZE):
+    # Create a record for every valid row from parse_csv/parse_ndjson. Rows are
+    # validated and written batch_size at a time: validate_batch(list of fields)
+    # returns a list of messages per row. Returns (imported, rejected, errors,
+    # error); a storage error stops the import. An upload that can't be read
+    # raises ValueError once the rows before it are written.
+    imported = rejected = 0
+    errors = []
+    pending = []  # (line number, fields) parsed but not yet validated
+
+    def reject(line_number, messages):
+        nonlocal rejected
+        rejected += 1
+        if len(errors) < MAX_IMPORT_ERRORS:
+            errors.append({"line": line_number, "errors": messages})
+
+    def write():
+        nonlocal imported
+        operations = []
+        for (line_number, fields), messages in zip(pending, validate_batch([fields for _, fields in pending])):
+            if messages:
+                reject(line_number, messages)
+            else:
+                operations.append({"op": "create", **fields})
+        pending.clear()
+        if not operations:
+            return None
+        results, error = apply_batch(operations)
+        imported += len(results or [])
+        return error
+
+    try:
+        for line_number, fields, error in rows:
+            if error:
+                reject(line_number, [error])
+                continue
+            pending.append((line_number, fields))
+            if len(pending) >= batch_size:
+                error = write()
+                if error:
+                    return imported, rejected, errors, error
+    except (UnicodeDecodeError, csv.Error, OSError, EOFError) as e:
+        write()
+        raise ValueError(f"Could not read the upload after {imported} imported records: {e}") from e
+
+    error = write()
+    errors.sort(key=lambda entry: entry["line"])  # Parse errors are found before validation errors
+    return imported, rejected, errors, error
+
+def export_csv(records, batch_size=EXPORT_BATCH_SIZE):
+    # Same layout as students.csv, so an export can be imported again
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HEADER)
+    count = 0
+    for record in records:
+        writer.writerow((record["id"], record["first_name"], record["last_name"], record["date_of_birth"]))
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def export_ndjson(records, batch_size=EXPORT_BATCH_SIZE):
+    # records are Records, as the store hands them out
+    batch = []
+    for record in records:
+        batch.append(json.dumps(record.to_dict()))
+        if len(batch) >= batch_size:
+            yield ("\n".join(batch) + "\n").encode('utf-8')
+            batch = []
+    if batch:
+        yield ("\n".join(batch) + "\n").encode('utf-8')
+
+def gzip_chunks(chunks):
+    # Compress a stream of byte chunks into one gzip file as they come
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,55 @@
+import os
+import threading
+from bisect import bisect_right
+from operator import itemgetter
+
+# Changes kept for /api/changes. A mirror that falls further behind than this
+# is told to reload everything.
+MAX_CHANGES = int(os.environ.get('SDM_CHANGE_LOG_SIZE', '10000'))
+
+class ChangeLog:
+    # The latest changes made through the RecordStore, each tagged with the
+    # store version it produced. Versions only go up, so the changes since any
+    # version still covered are found by bisection. Waiters are woken on every
+    # change, for long-polling.
+
+    def __init__(self, max_entries=MAX_CHANGES):
+        self.max_entries = max_entries
+        self._entries = []  # (version, "create" | "update" | "delete", record), oldest first
+        self._floor = 0  # Changes after this version are all in _entries
+        self._latest = 0
+        self._condition = threading.Condition()
+
+    def append(self, version, op, record):
+        with self._condition:
+            self._entries.append((version, op, record))
+            if len(self._entries) > self.max_entries:
+                # Trim in steps rather than on every change
+                drop = len(self._entries) - self.max_entries + self.max_entries // 4
+                self._floor = self._entries[drop - 1][0]
+                del self._entries[:drop]
+            self._latest = version
+            self._condition.notify_all()
+
+    def reset(self, version):
+        # The records changed in ways we have no log of, e.g. an outside edit
+        with self._condition:
+            self._entries.clear()
+            self._floor = version
+            self._latest = version
+            self._condition.notify_all()
+
+    def since(self, version, limit=None):
+        # Changes after version, oldest first, or None if some of them are no
+        # longer kept
+        with self._condition:
+            if version < self._floor or version > self._latest:
+                return None
+            start = bisect_right(self._entries, version, key=itemgetter(0))
+            end = len(self._entries) if limit is None else start + limit
+            return self._entries[start:end]
+
+    def wait(self, version, timeout):
+        # Block until there is a version after `version`, or timeout seconds pass
+        with self._condition:
+            return self._condition.wait_for(lambda: self._latest > version, timeout)
@@ -0,0 +1,53 @@
+import argparse
+import logging
+import os
+import threading
+import time
+
+from .store import get_store
+
+logger = logging.getLogger(__name__)
+
+# Share of rows in the file that may be tombstones before it is rewritten
+COMPACT_THRESHOLD = float(os.environ.get('SDM_COMPACT_THRESHOLD', '0.3'))
+# Seconds between background checks; 0 leaves compaction to the command line
+COMPACT_INTERVAL = float(os.environ.get('SDM_COMPACT_INTERVAL', '0'))
+
+def compact_if_needed(threshold=COMPACT_THRESHOLD):
+    store = get_store()
+    ratio, error = store.tombstone_ratio()
+    if error:
+        return False, error
+    if not ratio or ratio < threshold:
+        return False, None
+
+    error = store.compact()
+    return error is None, error
+
+def start_background_compaction(interval=COMPACT_INTERVAL, threshold=COMPACT_THRESHOLD):
+    def run():
+        while True:
+            time.sleep(interval)
+            compacted, error = compact_if_needed(threshold)
+            if error:
+                logger.error("Compaction failed: %s", error)
+            elif compacted:
+                logger.info("Compacted the record storage")
+
+    thread = threading.Thread(target=run, name="record-compactor", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reclaim the space held by deleted records: rewrites students.csv, "
+                                                 "or VACUUMs the database with SDM_STORAGE=sqlite.")
+    parser.add_argument('--threshold', type=float, default=COMPACT_THRESHOLD,
+                        help="only compact when at least this share of rows are deleted (default: %(default)s)")
+    parser.add_argument('--force', action='store_true', help="compact whenever there is a deleted row")
+    args = parser.parse_args()
+
+    compacted, error = compact_if_needed(0 if args.force else args.threshold)
+    if error:
+        raise SystemExit(f"Compaction failed: {error}")
+    print("Compacted the record storage." if compacted else "Nothing to compact.")
@@ -0,0 +1,183 @@
+from . import file_operations
+from .backend import StorageBackend
+from .file_operations import (has_id_column, read_indexed_records, scan_records, read_record_at, write_records,
+                              append_records, overwrite_record, tombstone_record, sync_file)
+from .id_index import IdIndex
+
+def read_live_records(path=None):
+    # (live records sorted by ID, row offsets, dead rows, file key, error) for one
+    # CSV file. A plain function so that shards can be read in worker processes.
+    with file_operations.lock(path).read():
+        records, offsets, tombstones, error = read_indexed_records(path)
+        if error:
+            return None, None, 0, None, error
+        try:
+            file_key = file_operations._file_key(path)
+        except OSError:
+            file_key = None
+
+    # A crash between appending a moved row and tombstoning the old one
+    # leaves two rows with the same ID; the later one wins
+    by_id = {record["id"]: record for record in records}
+    live = sorted(by_id.values(), key=lambda record: record["id"])
+    return live, offsets, tombstones + len(records) - len(live), file_key, None
+
+class CsvBackend(StorageBackend):
+    # Stores records in CSV_FILE, or the file at path. Creates are appended,
+    # updates are overwritten in place (or moved to the end when they no longer
+    # fit) and deletes are tombstoned, all found through the on-disk ID index.
+
+    def __init__(self, path=None):
+        self.path = path
+        self._index = IdIndex(path)
+        self._file_key = None  # (mtime, size) of the file after our last load or write
+        self._live = 0
+        self._tombstones = 0  # Dead rows still taking up space in the file
+
+    def key(self):
+        try:
+            return file_operations._file_key(self.path)
+        except OSError:
+            return None
+
+    def load(self):
+        with self.read_lock():
+            live, offsets, dead, file_key, error = read_live_records(self.path)
+            if error:
+                return None, error
+            legacy = not has_id_column(self.path)
+            self.loaded(live, offsets, dead, file_key, index=not legacy)
+
+        if legacy:
+            # Written before records had IDs: save it with the ID column once
+            error = self.compact(live)
+            if error:
+                return None, error
+        return live, None
+
+    def loaded(self, live, offsets, dead, file_key, index=True):
+        # Take on what read_live_records found in our file
+        self._live = len(live)
+        self._tombstones = dead
+        self._file_key = file_key
+        if index and not self._index.load(file_key):
+            self._index.rebuild(offsets, file_key)
+
+    def _ensure_index(self):
+        if self._file_key is not None and self._file_key == self.key():
+            return None
+        if self._index.load(self.key()):
+            self._file_key = self.key()
+            return None
+        _, error = self.load()
+        return error
+
+    def get(self, record_id):
+        error = self._ensure_index()
+        if error:
+            return None, error
+        offset = self._index.offsets.get(record_id)
+        if offset is None:
+            return None, f"No record with ID {record_id}."
+        return read_record_at(offset, record_id, self.path)
+
+    def scan(self, cursor=0):
+        for _, record in scan_records(self.path):
+            if record is not None and record["id"] > cursor:
+                yield record
+
+    def next_id(self):
+        self._ensure_index()
+        return self._index.next_id
+
+    def allocate_id(self):
+        return self._index.allocate_id()
+
+    def read_lock(self):
+        return file_operations.lock(self.path).read()
+
+    def write_lock(self):
+        return file_operations.lock(self.path).write()
+
+    def _append(self, records, added):
+        offsets, error = append_records(records, self.path)
+        if error:
+            return False
+        for record, offset in zip(records, offsets):
+            added[record["id"]] = offset
+            self._index.offsets[record["id"]] = offset
+        records.clear()
+        return True
+
+    def _write_in_place(self, changes):
+        # Returns False when only a full rewrite will do
+        added = {}
+        appending = []  # Runs of rows to append are written together
+        for op, record in changes:
+            record_id = record["id"]
+            if op == "create":
+                appending.append(record)
+                self._live += 1
+                continue
+            if appending and not self._append(appending, added):
+                return False
+
+            offset = self._index.offsets.get(record_id)
+            if offset is None:
+                return False
+
+            if op == "update":
+                written, error = overwrite_record(offset, record, self.path)
+                if error:
+                    return False
+                if written:
+                    continue
+                # The new row doesn't fit, so append it and retire the old one.
+                # Appending first means a crash can only leave a duplicate, never lose the record.
+                if not self._append([record], added):
+                    return False
+
+            written, error = tombstone_record(offset, record_id, self.path)
+            if not written:
+                return False
+            self._tombstones += 1
+            if op == "delete":
+                self._live -= 1
+                del self._index.offsets[record_id]
+
+        if appending and not self._append(appending, added):
+            return False
+        self._index.update(added, self.key())
+        return True
+
+    def apply(self, changes, records):
+        with self.write_lock():
+            if self.key() != self._file_key:
+                # Changed under us, so the row offsets can't be trusted
+                return self.compact(records)
+            if not self._write_in_place(changes):
+                return self.compact(records)
+            self._file_key = self.key()
+            return None
+
+    def log_path(self):
+        return (self.path or file_operations.CSV_FILE) + '.wal'
+
+    def sync(self):
+        return sync_file(self.path)
+
+    def tombstone_ratio(self):
+        rows = self._live + self._tombstones
+        return self._tombstones / rows if rows else 0.0
+
+    def compact(self, records):
+        # Write out every live record, which also drops all tombstoned rows
+        with self.write_lock():
+            offsets, error = write_records(records, self.path)
+            if error:
+                return error
+            self._file_key = self.key()
+            self._index.rebuild(offsets, self._file_key)
+        self._live = len(records)
+        self._tombstones = 0
+        return None
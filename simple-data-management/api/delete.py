@@ -1,14 +1,5 @@
-from .file_operations import read_records, write_records
+from .store import get_store
 
-def delete_record(record_number):
-    records, error = read_records()
-    if error:
-        return error
-    if not records:
-        return "No records to delete."
-
-    if 1 <= record_number <= len(records):
-        del records[record_number - 1]
-        return write_records(records)
-    else:
-        return "Invalid record number. Please enter a valid number."
+def delete_record(record_id):
+    # Only tombstones the row; api.compact reclaims the space later
+    return get_store().delete(record_id)
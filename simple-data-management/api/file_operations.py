@@ -1,40 +1,251 @@
+import io
+import logging
 import os
 import csv
+import tempfile
+
+from .locks import file_lock
+from .metrics import count_read, count_written, instrument
+
+logger = logging.getLogger(__name__)
 
 CSV_FILE = 'students.csv'
+HEADER = ["ID", "First Name", "Last Name", "Date of Birth"]
+
+# Written over the first byte of a deleted row. The row then no longer starts
+# with an ID, so readers skip it until compaction drops it from the file.
+TOMBSTONE = b'#'
+
+# 'always' fsyncs after every appended row, 'never' leaves flushing to the OS
+FSYNC_POLICY = os.environ.get('SDM_FSYNC_POLICY', 'never')
+
+def lock(path=None):
+    # Shared with other threads and processes: read() for readers, write() for writers.
+    # Every function here works on CSV_FILE unless given the path of another data
+    # file, such as a shard.
+    return file_lock(path or CSV_FILE)
 
 # Ensure the CSV file exists
 if not os.path.exists(CSV_FILE):
     with open(CSV_FILE, mode="w", newline="", encoding="utf-8") as file:
         writer = csv.writer(file)
-        writer.writerow(["First Name", "Last Name", "Date of Birth"])  # Add header
+        writer.writerow(HEADER)  # Add header
 
-def read_records():
+def _file_key(path=None):
+    stat = os.stat(path or CSV_FILE)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def shard_path(shard, shards):
+    # Data file of one of several shards: students.csv -> students.0-of-4.csv. The
+    # count is part of the name, so files split another way are never mixed up.
+    root, ext = os.path.splitext(CSV_FILE)
+    return f"{root}.{shard}-of-{shards}{ext}"
+
+def shard_of(record_id, shards):
+    # IDs are handed out in sequence, so hashing them by remainder spreads new
+    # records evenly over the shards
+    return record_id % shards
+
+def encode_row(values):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue().encode('utf-8')
+
+def encode_record(record):
+    return encode_row([record["id"], record["first_name"], record["last_name"], record["date_of_birth"]])
+
+def scan_records(path=None):
+    # Yields (byte offset, record) for every valid row and (byte offset, None) for
+    # tombstoned ones. Validated fields never contain newlines, so each row is
+    # exactly one line of the file.
+    with lock(path).read(), open(path or CSV_FILE, mode='rb') as file:
+        header = next(csv.reader([file.readline().decode('utf-8')]), [])
+        has_id = header[:1] == ["ID"]  # Files from before the ID column use row positions as IDs
+
+        offset = file.tell()
+        rows = 0
+        for idx, line in enumerate(iter(file.readline, b''), start=1):
+            rows = idx
+            if line.startswith(TOMBSTONE):
+                yield offset, None
+                offset += len(line)
+                continue
+
+            row = next(csv.reader([line.decode('utf-8')]), [])
+            if has_id and len(row) == 4 and row[0].isdigit():  # Fully valid row
+                yield offset, {"id": int(row[0]), "first_name": row[1], "last_name": row[2], "date_of_birth": row[3]}
+            elif not has_id and len(row) == 3:
+                yield offset, {"id": idx, "first_name": row[0], "last_name": row[1], "date_of_birth": row[2]}
+            offset += len(line)
+        count_read(offset, rows)
+
+def has_id_column(path=None):
+    with lock(path).read(), open(path or CSV_FILE, mode='r', encoding='utf-8') as file:
+        return next(csv.reader([file.readline()]), [])[:1] == ["ID"]
+
+@instrument('read_records')
+def read_indexed_records(path=None):
+    path = path or CSV_FILE
     records = []
+    offsets = {}
+    tombstones = 0
     try:
-        with open(CSV_FILE, mode='r', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            next(reader, None)  # Skip header row
+        for offset, record in scan_records(path):
+            if record is None:
+                tombstones += 1
+                continue
+            records.append(record)
+            offsets[record["id"]] = offset
 
-            for idx, row in enumerate(reader, start=1):
-                if len(row) == 3:  # Fully valid row
-                    records.append({"index": idx, "first_name": row[0], "last_name": row[1], "date_of_birth": row[2]})
-            
-            print("Records read from CSV:", records) 
+        logger.debug("Read %d records and %d deleted rows from %s", len(records), tombstones, path)
 
-        return records, None  # Return records and no error
+        return records, offsets, tombstones, None  # Return records, their offsets, the dead row count and no error
     except FileNotFoundError:
-        return [], f"The file '{CSV_FILE}' does not exist."
+        return [], {}, 0, f"The file '{path}' does not exist."
     except Exception as e:
-        return [], f"An error occurred: {e}"
+        return [], {}, 0, f"An error occurred: {e}"
+
+def read_records():
+    records, _, _, error = read_indexed_records()
+    return records, error
 
-def write_records(records):
+@instrument('write_records')
+def write_records(records, path=None):
+    # Write the new contents to a temporary file next to CSV_FILE and swap it in,
+    # so readers see either the old file or the new one, never half of each
+    path = path or CSV_FILE
+    offsets = {}
+    temp_path = None
     try:
-        with open(CSV_FILE, mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow(["First Name", "Last Name", "Date of Birth"])  # Write header
-            for record in records:
-                writer.writerow([record["first_name"], record["last_name"], record["date_of_birth"]])
+        with lock(path).write():
+            fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                             dir=os.path.dirname(os.path.abspath(path)))
+            with os.fdopen(fd, mode='wb') as file:
+                file.write(encode_row(HEADER))  # Write header
+                for record in records:
+                    offsets[record["id"]] = file.tell()
+                    file.write(encode_record(record))
+                count_written(file.tell(), len(records))
+                file.flush()
+                os.fsync(file.fileno())  # The rename must not reach the disk before the data
+            if os.path.exists(path):
+                os.chmod(temp_path, os.stat(path).st_mode & 0o777)  # mkstemp files are private
+            os.replace(temp_path, path)
+            temp_path = None
+        return offsets, None  # Offset of every row, for the ID index
+    except Exception as e:
+        return {}, f"An error occurred while writing to the file: {e}"
+    finally:
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+def sync_file(path=None):
+    # Force every change made to CSV_FILE so far onto the disk, along with the
+    # directory entry a rewrite swapped in. Returns an error or None.
+    path = path or CSV_FILE
+    try:
+        with lock(path).read():
+            for synced in (path, os.path.dirname(os.path.abspath(path))):
+                fd = os.open(synced, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
         return None
     except Exception as e:
-        return f"An error occurred while writing to the file: {e}"
\ No newline at end of file
+        return f"An error occurred while syncing the file: {e}"
+
+@instrument('append_records')
+def append_records(records, path=None):
+    # Append rows with a single write and return the offset of each
+    data = [encode_record(record) for record in records]
+    try:
+        with lock(path).write(), open(path or CSV_FILE, mode='a+b') as file:
+            size = file.seek(0, os.SEEK_END)
+            prefix = b''
+            if not size:
+                prefix = encode_row(HEADER)
+            else:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) not in (b'\n', b'\r'):
+                    prefix = b'\r\n'  # Previous row was left unterminated
+            file.write(prefix + b''.join(data))
+            count_written(len(prefix) + sum(map(len, data)), len(data))
+            file.flush()
+            if FSYNC_POLICY == 'always':
+                os.fsync(file.fileno())
+
+        offsets = []
+        offset = size + len(prefix)
+        for row in data:
+            offsets.append(offset)
+            offset += len(row)
+        return offsets, None
+    except Exception as e:
+        return None, f"An error occurred while writing to the file: {e}"
+
+def append_record(record):
+    offsets, error = append_records([record])
+    if error:
+        return None, error
+    return offsets[0], None  # Offset of the new row
+
+def _check_row(file, offset, record_id):
+    # The row at offset, or None if it does not belong to record_id (anymore)
+    file.seek(offset)
+    row = file.readline()
+    return row if row.startswith(f'{record_id},'.encode('utf-8')) else None
+
+@instrument('read_record_at')
+def read_record_at(offset, record_id, path=None):
+    # Seek straight to one row instead of parsing the whole file
+    try:
+        with lock(path).read(), open(path or CSV_FILE, mode='rb') as file:
+            line = _check_row(file, offset, record_id)
+        count_read(len(line or b''), 1)
+        if line is None:
+            return None, f"No record with ID {record_id}."
+        row = next(csv.reader([line.decode('utf-8')]), [])
+        return {"id": record_id, "first_name": row[1], "last_name": row[2], "date_of_birth": row[3]}, None
+    except Exception as e:
+        return None, f"An error occurred: {e}"
+
+@instrument('overwrite_record')
+def overwrite_record(offset, record, path=None):
+    # Rewrite one row where it sits. Only possible when the new row has exactly
+    # the same length, otherwise (False, None) tells the caller to move the row.
+    data = encode_record(record)
+    try:
+        with lock(path).write(), open(path or CSV_FILE, mode='r+b') as file:
+            old = _check_row(file, offset, record["id"])
+            if old is None or len(old) != len(data):
+                return False, None
+            file.seek(offset)
+            file.write(data)
+            count_written(len(data), 1)
+            file.flush()
+            if FSYNC_POLICY == 'always':
+                os.fsync(file.fileno())
+        return True, None
+    except Exception as e:
+        return False, f"An error occurred while writing to the file: {e}"
+
+@instrument('tombstone_record')
+def tombstone_record(offset, record_id, path=None):
+    # Mark one row as deleted with a single byte write instead of rewriting the file
+    try:
+        with lock(path).write(), open(path or CSV_FILE, mode='r+b') as file:
+            if _check_row(file, offset, record_id) is None:
+                return False, None
+            file.seek(offset)
+            file.write(TOMBSTONE)
+            count_written(len(TOMBSTONE), 1)
+            file.flush()
+            if FSYNC_POLICY == 'always':
+                os.fsync(file.fileno())
+        return True, None
+    except Exception as e:
+        return False, f"An error occurred while writing to the file: {e}"
@@ -0,0 +1,104 @@
+import logging
+import os
+import struct
+import tempfile
+from array import array
+
+from . import file_operations
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.idx'
+
+# Fixed-size header so it can be rewritten in place after every append:
+# magic, mtime and size of the CSV file the offsets belong to, next ID to hand out
+_HEADER = struct.Struct('<4sqqq')
+_MAGIC = b'SDI1'
+
+class IdIndex:
+    # Maps record IDs to the byte offset of their row in CSV_FILE, saved next to
+    # it as (id, offset) int64 pairs. Failing to save is not fatal: a stale or
+    # missing index is simply rebuilt the next time the records are loaded.
+
+    def __init__(self, data_path=None):
+        self.data_path = data_path  # The CSV file indexed, if not CSV_FILE
+        self.offsets = {}
+        self.next_id = 1
+        self._saved = False  # Whether the file on disk matched the CSV after our last write
+
+    @property
+    def path(self):
+        return (self.data_path or file_operations.CSV_FILE) + INDEX_SUFFIX
+
+    def _header(self, file_key):
+        mtime, size = file_key
+        return _HEADER.pack(_MAGIC, mtime, size, self.next_id)
+
+    def load(self, file_key):
+        # Use the saved offsets only if they were written for this exact version of the file
+        try:
+            with open(self.path, mode='rb') as file:
+                magic, mtime, size, next_id = _HEADER.unpack(file.read(_HEADER.size))
+                if magic != _MAGIC:
+                    return False
+                self.next_id = max(self.next_id, next_id)  # IDs stay monotonic even across rebuilds
+                if (mtime, size) != file_key:
+                    return False
+                pairs = array('q')
+                pairs.frombytes(file.read())
+        except (OSError, struct.error, ValueError):
+            return False
+
+        self.offsets = dict(zip(pairs[::2], pairs[1::2]))
+        self._saved = True
+        return True
+
+    def rebuild(self, offsets, file_key):
+        self.offsets = offsets
+        if offsets:
+            self.next_id = max(self.next_id, max(offsets) + 1)
+
+        try:
+            # A temporary name of our own, since readers in other processes may rebuild at the same time
+            fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', suffix='.tmp',
+                                             dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, mode='wb') as file:
+                file.write(self._header(file_key))
+                file.write(_pack(offsets))
+            os.replace(temp_path, self.path)
+            self._saved = True
+        except OSError as e:
+            self._saved = False
+            logger.warning("Could not save the ID index: %s", e)
+
+    def update(self, offsets, file_key):
+        # Record rows appended to the CSV file and stamp the index with the file's
+        # new version, appending to the index instead of rewriting it
+        self.offsets.update(offsets)
+        if offsets:
+            self.next_id = max(self.next_id, max(offsets) + 1)  # Rows replayed from the log bring their own IDs
+        if not self._saved:
+            return self.rebuild(self.offsets, file_key)
+
+        try:
+            with open(self.path, mode='r+b') as file:
+                file.seek(0, os.SEEK_END)
+                file.write(_pack(offsets))
+                file.seek(0)
+                file.write(self._header(file_key))
+        except OSError as e:
+            self._saved = False
+            logger.warning("Could not update the ID index: %s", e)
+
+    def allocate_id(self):
+        record_id = self.next_id
+        self.next_id += 1
+        return record_id
+
+
+def _pack(offsets):
+    pairs = array('q')
+    for record_id, offset in offsets.items():
+        pairs.append(record_id)
+        pairs.append(offset)
+    return pairs.tobytes()
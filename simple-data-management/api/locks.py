@@ -0,0 +1,158 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows: only threads of this process are kept apart
+    fcntl = None
+
+_SHARED, _EXCLUSIVE, _UNLOCK = (fcntl.LOCK_SH, fcntl.LOCK_EX, fcntl.LOCK_UN) if fcntl else (None, None, None)
+
+LOCK_SUFFIX = '.lock'
+
+class RWLock:
+    # Any number of readers or a single writer. Waiting writers keep new readers
+    # out so they can't be starved. Both sides may re-enter, and the writer may
+    # take read locks too, but a reader must never ask for the write lock.
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+        self._waiting_writers = 0
+        self._held = threading.local()  # Read depth of the current thread
+
+    def owns_write(self):
+        return self._writer == threading.get_ident()
+
+    def acquire_read(self):
+        with self._cond:
+            if self.owns_write():
+                self._depth += 1
+                return
+            depth = getattr(self._held, 'depth', 0)
+            if not depth:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+                self._readers += 1
+            self._held.depth = depth + 1
+
+    def release_read(self):
+        with self._cond:
+            if self.owns_write():
+                self._depth -= 1
+                return
+            self._held.depth -= 1
+            if not self._held.depth:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            if self.owns_write():
+                self._depth += 1
+                return
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = threading.get_ident()
+            self._depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._depth -= 1
+            if not self._depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+class FileLock:
+    # Reader/writer lock for one data file, held against the other threads of this
+    # process (RWLock) and against other processes (flock). The flock is taken on
+    # a separate .lock file because writes replace the data file with a new one.
+
+    def __init__(self, path):
+        self.path = path + LOCK_SUFFIX
+        self._local = RWLock()
+        self._mutex = threading.Lock()  # Guards the shared flock below
+        self._readers = 0
+        self._fd = None
+        self._pid = None
+
+    def _flock(self, operation):
+        if fcntl is None:
+            return
+        if self._pid != os.getpid():
+            # flock locks belong to the open file, which a forked worker would
+            # share with its parent, so every process opens its own
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        fcntl.flock(self._fd, operation)
+
+    @contextmanager
+    def read(self):
+        nested = self._local.owns_write()
+        self._local.acquire_read()
+        try:
+            if not nested:
+                with self._mutex:
+                    # The first reader in takes the shared flock for all of them
+                    if not self._readers:
+                        self._flock(_SHARED)
+                    self._readers += 1
+            try:
+                yield
+            finally:
+                if not nested:
+                    with self._mutex:
+                        self._readers -= 1
+                        if not self._readers:
+                            self._flock(_UNLOCK)
+        finally:
+            self._local.release_read()
+
+    @contextmanager
+    def write(self):
+        nested = self._local.owns_write()
+        self._local.acquire_write()
+        try:
+            if not nested:
+                self._flock(_EXCLUSIVE)
+            try:
+                yield
+            finally:
+                if not nested:
+                    self._flock(_UNLOCK)
+        finally:
+            self._local.release_write()
+
+
+_file_locks = {}
+_file_locks_mutex = threading.Lock()
+
+def file_lock(path):
+    # One FileLock per data file, so every caller in the process shares it
+    path = os.path.abspath(path)
+    with _file_locks_mutex:
+        if path not in _file_locks:
+            _file_locks[path] = FileLock(path)
+        return _file_locks[path]
@@ -0,0 +1,55 @@
+import json
+import logging
+import os
+import random
+
+# DEBUG, INFO, WARNING or ERROR
+LOG_LEVEL = os.environ.get('SDM_LOG_LEVEL', 'INFO').upper()
+# 'text' for key=value lines, 'json' for one JSON object per line
+LOG_FORMAT = os.environ.get('SDM_LOG_FORMAT', 'text')
+# Share of per-request summaries that are logged; warnings and errors always are
+LOG_SAMPLE_RATE = float(os.environ.get('SDM_LOG_SAMPLE_RATE', '1.0'))
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+class StructuredFormatter(logging.Formatter):
+    # The message followed by the `fields` dict passed with extra={'fields': ...}.
+    # Nothing is formatted unless the record passed the level and sampling checks.
+
+    def __init__(self, as_json=False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        if self.as_json:
+            entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                     'message': record.getMessage(), **fields}
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+
+        line = f"{self.formatTime(record)} {record.levelname} {record.name}: {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+def configure_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    # Send the api and server loggers to stderr. Only entry points call this;
+    # modules just use logging.getLogger(__name__).
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(as_json=log_format == 'json'))
+    for name in ('api', 'server'):
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        if not logger.handlers:
+            logger.addHandler(handler)
+        logger.propagate = False
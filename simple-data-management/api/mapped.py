@@ -0,0 +1,166 @@
+import csv
+import mmap
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence
+
+from . import file_operations
+from .file_operations import TOMBSTONE, lock
+from .metrics import count_read, instrument
+from .records import Record
+
+# Rows decoded per step while iterating a view
+DECODE_CHUNK_SIZE = 1000
+
+def _split(line):
+    # Fields of one row. Validated names never contain commas or quotes, so
+    # str.split does unless the row was written with quoting.
+    text = line.rstrip(b'\r\n').decode('utf-8')
+    if '"' not in text:
+        return text.split(',')
+    return next(csv.reader([text]), [])
+
+class MappedRecords(Sequence):
+    # Read-only view of the live records in CSV_FILE, in ID order, that never
+    # holds more than one page of Records. The file is memory-mapped and only an
+    # ID and a byte offset per row are kept (12 bytes instead of a 400-byte
+    # dict); rows are decoded when they are indexed or iterated.
+    #
+    # The view is a snapshot of the file as it was opened. A rewrite replaces
+    # the file rather than changing it, so the mapping keeps the old contents;
+    # a row tombstoned since only loses its first byte, and its ID is known.
+
+    def __init__(self, mapping, ids, offsets, has_id, start=0, stop=None):
+        self._mapping = mapping
+        self._ids = ids
+        self._offsets = offsets
+        self._has_id = has_id
+        self._start = start
+        self._stop = len(ids) if stop is None else stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            start, stop, step = position.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return MappedRecords(self._mapping, self._ids, self._offsets, self._has_id,
+                                 self._start + start, self._start + max(start, stop))
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("record index out of range")
+        return self._decode(self._start + position, self._start + position + 1)[0]
+
+    def __iter__(self):
+        for start in range(self._start, self._stop, DECODE_CHUNK_SIZE):
+            yield from self._decode(start, min(start + DECODE_CHUNK_SIZE, self._stop))
+
+    def _decode(self, start, stop):
+        # Records for rows start..stop, read under one lock so an in-place
+        # update is never seen half-written
+        records = []
+        mapping, ids, offsets = self._mapping, self._ids, self._offsets
+        with lock().read():
+            for i in range(start, stop):
+                offset = offsets[i]
+                fields = _split(mapping[offset:mapping.find(b'\n', offset) + 1 or len(mapping)])
+                if self._has_id:
+                    fields = fields[1:]
+                records.append(Record(ids[i], fields[0], fields[1], fields[2]))
+        return records
+
+    def get(self, record_id):
+        position = bisect_left(self._ids, record_id, self._start, self._stop)
+        if position == self._stop or self._ids[position] != record_id:
+            return None
+        return self._decode(position, position + 1)[0]
+
+    def after(self, cursor):
+        # View of the records with IDs after cursor
+        return self[bisect_right(self._ids, cursor, self._start, self._stop) - self._start:]
+
+    def page(self, cursor=0, limit=None):
+        # Same contract as RecordStore.page: (records, next cursor)
+        start = bisect_right(self._ids, cursor, self._start, self._stop)
+        end = self._stop if limit is None else min(start + limit, self._stop)
+        next_cursor = self._ids[end - 1] if end < self._stop else None
+        return self._decode(start, end), next_cursor
+
+def _index_rows(mapping):
+    # (ids, offsets, has_id) for the live rows of a mapped file. Same rules
+    # as scan_records: invalid rows are skipped, and of two rows with the same ID
+    # (left by a crash while moving a row) the later one wins.
+    header = _split(mapping.readline())
+    has_id = header[:1] == ["ID"]
+    ids = array('q')
+    offsets = array('Q')
+    rows = 0
+    ordered = True
+    last_id = 0
+
+    offset = mapping.tell()
+    for line in iter(mapping.readline, b''):
+        rows += 1
+        if has_id and line[:1].isdigit():  # Tombstoned rows start with TOMBSTONE instead
+            if b'"' not in line and line.count(b',') == 3:
+                valid = True
+            else:
+                fields = _split(line)
+                valid = len(fields) == 4 and fields[0].isdigit()
+            if valid:
+                record_id = int(line[:line.index(b',')])
+                ordered = ordered and record_id > last_id
+                last_id = record_id
+                ids.append(record_id)
+                offsets.append(offset)
+        elif not has_id and not line.startswith(TOMBSTONE) and len(_split(line)) == 3:
+            ids.append(rows)  # Files from before the ID column use row positions as IDs
+            offsets.append(offset)
+        offset += len(line)
+    count_read(offset, rows)
+
+    if not ordered:
+        # Moved rows are appended at the end of the file; put them back in ID order
+        latest = dict(zip(ids, offsets))
+        ids = array('q', sorted(latest))
+        offsets = array('Q', (latest[record_id] for record_id in ids))
+    return ids, offsets, has_id
+
+@instrument('read_mapped_records')
+def read_mapped_records():
+    # (MappedRecords, error) for CSV_FILE, without building a dict per row
+    try:
+        with lock().read(), open(file_operations.CSV_FILE, mode='rb') as file:
+            try:
+                mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # An empty file can't be mapped
+                return MappedRecords(b'', array('q'), array('Q'), True), None
+            ids, offsets, has_id = _index_rows(mapping)
+        return MappedRecords(mapping, ids, offsets, has_id), None
+    except FileNotFoundError:
+        return None, f"The file '{file_operations.CSV_FILE}' does not exist."
+    except Exception as e:
+        return None, f"An error occurred: {e}"
+
+_mapped = None  # (file key, MappedRecords) of the last file mapped
+_mapped_lock = threading.Lock()
+
+def get_mapped_records():
+    # The view of CSV_FILE as it is now, mapped again only after the file changed
+    global _mapped
+    with _mapped_lock:
+        try:
+            key = (file_operations.CSV_FILE, file_operations._file_key())
+        except OSError:
+            key = None
+        if _mapped is not None and key is not None and _mapped[0] == key:
+            return _mapped[1], None
+        records, error = read_mapped_records()
+        if error:
+            return None, error
+        _mapped = (key, records)
+        return records, None
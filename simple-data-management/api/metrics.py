@@ -0,0 +1,127 @@
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Set SDM_METRICS=0 to turn metrics off; instrumented functions are then left unwrapped
+ENABLED = os.environ.get('SDM_METRICS', '1') not in ('0', 'false', 'no', 'off')
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(key)} {_number(value)}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][position] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _number(float(bound))
+                    lines.append(f'{self.name}_bucket{_labels(key + (("le", le),))} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(key)} {_number(total)}')
+                lines.append(f'{self.name}_count{_labels(key)} {cumulative}')
+        return lines
+
+
+storage_seconds = Histogram('sdm_storage_seconds', 'Time spent in storage operations.')
+storage_errors = Counter('sdm_storage_errors_total', 'Storage operations that returned an error or raised.')
+bytes_read = Counter('sdm_storage_read_bytes_total', 'Bytes read from the data file.')
+bytes_written = Counter('sdm_storage_written_bytes_total', 'Bytes written to the data file.')
+rows_read = Counter('sdm_storage_read_rows_total', 'Rows read from storage, deleted ones included.')
+rows_written = Counter('sdm_storage_written_rows_total', 'Rows written to storage.')
+request_seconds = Histogram('sdm_http_request_seconds', 'Time spent handling API requests.')
+response_bytes = Counter('sdm_http_response_bytes_total', 'Bytes sent in API response bodies (streamed responses excluded).')
+
+METRICS = (storage_seconds, storage_errors, bytes_read, bytes_written, rows_read, rows_written, request_seconds, response_bytes)
+
+def instrument(operation):
+    # Time a storage function and count its errors: an error string as (the last
+    # item of) its return value, or an exception
+    def decorate(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                storage_errors.inc(operation=operation)
+                raise
+            finally:
+                storage_seconds.observe(time.perf_counter() - started, operation=operation)
+            error = result[-1] if isinstance(result, tuple) else result
+            if isinstance(error, str):
+                storage_errors.inc(operation=operation)
+            return result
+        return wrapper
+    return decorate
+
+def count_read(size, rows=0):
+    if ENABLED:
+        bytes_read.inc(size)
+        if rows:
+            rows_read.inc(rows)
+
+def count_written(size, rows=0):
+    if ENABLED:
+        bytes_written.inc(size)
+        if rows:
+            rows_written.inc(rows)
+
+def render():
+    # Every metric in the Prometheus text exposition format
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
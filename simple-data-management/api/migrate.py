@@ -0,0 +1,29 @@
+import argparse
+
+from . import file_operations
+from .backend import SQLITE_FILE
+from .csv_backend import CsvBackend
+from .sqlite_backend import SqliteBackend
+
+def migrate_to_sqlite(database=SQLITE_FILE):
+    # Copy every record in CSV_FILE into the SQLite database, keeping their IDs
+    source = CsvBackend()
+    target = SqliteBackend(database)
+    try:
+        return target.import_records(source.scan(), next_id=source.next_id())
+    except Exception as e:
+        return 0, f"An error occurred: {e}"
+    finally:
+        target.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Copy students.csv into an SQLite database.")
+    parser.add_argument('--db', default=SQLITE_FILE, help="database to copy into (default: %(default)s)")
+    args = parser.parse_args()
+
+    copied, error = migrate_to_sqlite(args.db)
+    if error:
+        raise SystemExit(f"Migration failed: {error}")
+    print(f"Copied {copied} records from {file_operations.CSV_FILE} into {args.db}.")
+    print("Start the backend API with SDM_STORAGE=sqlite to use it.")
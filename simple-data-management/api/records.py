@@ -0,0 +1,265 @@
+import sys
+from array import array
+from collections import Counter
+from bisect import bisect_left, bisect_right
+from datetime import date
+
+FIELDS = ("id", "first_name", "last_name", "date_of_birth")
+# Records built per step while iterating a table
+ITER_CHUNK_SIZE = 1000
+# Rows diff() compares at once, as slices, before going row by row
+DIFF_CHUNK_SIZE = 1024
+
+class Record:
+    # One student record. Fields can also be read as record["first_name"], like
+    # the dicts storage engines hand around; to_dict() gives the JSON form.
+    __slots__ = FIELDS
+
+    def __init__(self, id, first_name, last_name, date_of_birth):
+        self.id = id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.date_of_birth = date_of_birth
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(record["id"], record["first_name"], record["last_name"], record["date_of_birth"])
+
+    def __getitem__(self, field):
+        if field not in FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def keys(self):
+        return FIELDS
+
+    def to_dict(self):
+        return {"id": self.id, "first_name": self.first_name, "last_name": self.last_name, "date_of_birth": self.date_of_birth}
+
+    def __eq__(self, other):
+        if not isinstance(other, Record):
+            return NotImplemented
+        return (self.id, self.first_name, self.last_name, self.date_of_birth) == \
+            (other.id, other.first_name, other.last_name, other.date_of_birth)
+
+    def __repr__(self):
+        return f"Record({self.id!r}, {self.first_name!r}, {self.last_name!r}, {self.date_of_birth!r})"
+
+# Stands in for a date of birth that isn't a YYYY-MM-DD date; the text is kept aside
+_NOT_A_DAY = -1
+_day_texts = {}  # Day number -> YYYY-MM-DD, shared by every record born that day
+_text_days = {}  # and back
+
+def _parse_day(text):
+    if len(text) == 10 and text[4] == '-' and text[7] == '-' and text.isascii():
+        year, month, day = text[:4], text[5:7], text[8:]
+        if year.isdigit() and month.isdigit() and day.isdigit():
+            try:
+                return date(int(year), int(month), int(day)).toordinal()
+            except ValueError:
+                pass
+    return None
+
+def _to_day(text):
+    # date.toordinal() of a YYYY-MM-DD string, or None if it isn't one
+    day = _text_days.get(text)
+    if day is None:
+        day = _parse_day(text)
+        if day is not None:
+            _text_days[text] = day
+            _day_texts[day] = text
+    return day
+
+def _from_days(days):
+    # YYYY-MM-DD for each day number
+    for day in set(days).difference(_day_texts):
+        _day_texts[day] = date.fromordinal(day).isoformat()
+    return map(_day_texts.__getitem__, days)
+
+class RecordTable:
+    # Every record held in memory, sorted by ID, one column per field: IDs in an
+    # int64 array, names as lists of interned strings (so each distinct name is
+    # stored once), dates of birth as int32 day numbers. A row costs about 30
+    # bytes instead of the 400 or so of a dict. Record objects are only built
+    # for the rows a caller asks for.
+
+    def __init__(self):
+        self.ids = array('q')
+        self.first_names = []
+        self.last_names = []
+        self.births = array('i')
+        self._odd_births = {}  # ID -> date of birth text that isn't a date
+
+    @classmethod
+    def from_records(cls, records):
+        # records: a list in ID order, of dicts or Records. Built a column at a time.
+        table = cls()
+        intern = sys.intern
+        table.ids = array('q', [record["id"] for record in records])
+        table.first_names = [intern(record["first_name"]) for record in records]
+        table.last_names = [intern(record["last_name"]) for record in records]
+        days = [_to_day(record["date_of_birth"]) for record in records]
+        if None in days:
+            for position, day in enumerate(days):
+                if day is None:
+                    table._odd_births[table.ids[position]] = records[position]["date_of_birth"]
+                    days[position] = _NOT_A_DAY
+        table.births = array('i', days)
+        return table
+
+    def __len__(self):
+        return len(self.ids)
+
+    def copy(self, start=0, stop=None):
+        # Snapshot of rows start..stop sharing no columns with this table: a few
+        # memcpys rather than a Record per row
+        table = RecordTable()
+        table.ids = self.ids[start:stop]
+        table.first_names = self.first_names[start:stop]
+        table.last_names = self.last_names[start:stop]
+        table.births = self.births[start:stop]
+        if self._odd_births:
+            table._odd_births = {record_id: self._odd_births[record_id] for record_id in table.ids if record_id in self._odd_births}
+        return table
+
+    def _birth(self, position):
+        day = self.births[position]
+        if day == _NOT_A_DAY:
+            return self._odd_births[self.ids[position]]
+        text = _day_texts.get(day)
+        return text if text is not None else next(_from_days([day]))
+
+    def _births(self, start, stop):
+        births = list(_from_days([day for day in self.births[start:stop] if day != _NOT_A_DAY]))
+        if self._odd_births and len(births) < stop - start:
+            dated = iter(births)
+            births = [self._odd_births[record_id] if day == _NOT_A_DAY else next(dated)
+                      for record_id, day in zip(self.ids[start:stop], self.births[start:stop])]
+        return births
+
+    def birth_counts(self):
+        # Counter of date of birth text -> rows, counted over the day numbers
+        days = Counter(self.births)
+        days.pop(_NOT_A_DAY, None)
+        counts = Counter(dict(zip(_from_days(list(days)), days.values())))
+        counts.update(self._odd_births.values())
+        return counts
+
+    def to_dicts(self, start=0, stop=None):
+        # JSON form of the rows, built straight from the columns. Small dicts of
+        # strings and ints are not tracked by the garbage collector, so for large
+        # responses this is much cheaper than going through Records.
+        stop = len(self.ids) if stop is None else stop
+        return [{"id": record_id, "first_name": first_name, "last_name": last_name, "date_of_birth": born}
+                for record_id, first_name, last_name, born in zip(self.ids[start:stop], self.first_names[start:stop],
+                                                                   self.last_names[start:stop], self._births(start, stop))]
+
+    def to_columns(self, start=0, stop=None):
+        # {field: list of values} for the rows, straight from the columns
+        stop = len(self.ids) if stop is None else stop
+        return {"id": self.ids[start:stop].tolist(), "first_name": self.first_names[start:stop],
+                "last_name": self.last_names[start:stop], "date_of_birth": self._births(start, stop)}
+
+    def _slice(self, start, stop):
+        return list(map(Record, self.ids[start:stop], self.first_names[start:stop], self.last_names[start:stop],
+                        self._births(start, stop)))
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            start, stop, step = position.indices(len(self.ids))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self._slice(start, stop)
+        if position < 0:
+            position += len(self.ids)
+        if not 0 <= position < len(self.ids):
+            raise IndexError("record index out of range")
+        return Record(self.ids[position], self.first_names[position], self.last_names[position], self._birth(position))
+
+    def __iter__(self):
+        for start in range(0, len(self.ids), ITER_CHUNK_SIZE):
+            yield from self._slice(start, start + ITER_CHUNK_SIZE)
+
+    def position(self, record_id):
+        # Where record_id is, or None
+        position = bisect_left(self.ids, record_id)
+        if position < len(self.ids) and self.ids[position] == record_id:
+            return position
+        return None
+
+    def after(self, cursor):
+        # Position of the first record with an ID after cursor
+        return bisect_right(self.ids, cursor)
+
+    def value(self, position, field):
+        # One field of one row, without building a Record
+        if field == "first_name":
+            return self.first_names[position]
+        if field == "last_name":
+            return self.last_names[position]
+        if field == "date_of_birth":
+            return self._birth(position)
+        return self.ids[position]
+
+    def get(self, record_id):
+        position = self.position(record_id)
+        return None if position is None else self[position]
+
+    def diff(self, other):
+        # Yields the ("create" | "update" | "delete", Record) changes that turn
+        # this table into other, in ID order. Deletes carry the old record. Runs
+        # of identical rows are skipped a chunk at a time.
+        odd_same = self._odd_births == other._odd_births
+        i = j = 0
+        while i < len(self.ids) or j < len(other.ids):
+            size = min(DIFF_CHUNK_SIZE, len(self.ids) - i, len(other.ids) - j)
+            if (size and self.ids[i:i + size] == other.ids[j:j + size] and self.births[i:i + size] == other.births[j:j + size]
+                    and self.first_names[i:i + size] == other.first_names[j:j + size]
+                    and self.last_names[i:i + size] == other.last_names[j:j + size]
+                    and (odd_same or _NOT_A_DAY not in self.births[i:i + size])):
+                i += size
+                j += size
+                continue
+            for _ in range(max(size, 1)):
+                if j == len(other.ids) or (i < len(self.ids) and self.ids[i] < other.ids[j]):
+                    yield "delete", self[i]
+                    i += 1
+                elif i == len(self.ids) or other.ids[j] < self.ids[i]:
+                    yield "create", other[j]
+                    j += 1
+                else:
+                    if (self.first_names[i] != other.first_names[j] or self.last_names[i] != other.last_names[j]
+                            or self.births[i] != other.births[j]
+                            or (self.births[i] == _NOT_A_DAY and self._birth(i) != other._birth(j))):
+                        yield "update", other[j]
+                    i += 1
+                    j += 1
+
+    def _set_birth(self, position, record):
+        day = _to_day(record["date_of_birth"])
+        if day is None:
+            self._odd_births[record["id"]] = record["date_of_birth"]
+            day = _NOT_A_DAY
+        else:
+            self._odd_births.pop(record["id"], None)
+        self.births[position] = day
+
+    def append(self, record):
+        # New IDs are always the largest, so appending keeps the order
+        self.ids.append(record["id"])
+        self.first_names.append(sys.intern(record["first_name"]))
+        self.last_names.append(sys.intern(record["last_name"]))
+        self.births.append(0)
+        self._set_birth(len(self.ids) - 1, record)
+
+    def replace(self, position, record):
+        self.first_names[position] = sys.intern(record["first_name"])
+        self.last_names[position] = sys.intern(record["last_name"])
+        self._set_birth(position, record)
+
+    def delete(self, position):
+        self._odd_births.pop(self.ids[position], None)
+        del self.ids[position]
+        del self.first_names[position]
+        del self.last_names[position]
+        del self.births[position]
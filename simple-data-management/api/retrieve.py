@@ -1,7 +1,119 @@
-from .file_operations import read_records
+import os
+import time
+
+from . import file_operations
+from .backend import SHARDS, STORAGE
+from .mapped import get_mapped_records
+from .store import get_store
+
+# Records copied out of the store per step while streaming
+STREAM_CHUNK_SIZE = 1000
+# 'memory' serves reads from the record store, which keeps every record as a
+# dict. 'mapped' reads them from a memory-mapped students.csv instead, so large
+# files can be counted, paged and exported without loading them. Writes always
+# go through the store.
+READ_MODE = os.environ.get('SDM_READ_MODE', 'memory')
+
+def _mapped():
+    return READ_MODE == 'mapped' and STORAGE == 'csv' and SHARDS == 1
+
+def _mapped_records():
+    # Changes still waiting in the store's memory have to reach the file first
+    error = get_store().flush()
+    if error:
+        return None, error
+    return get_mapped_records()
 
 def get_all_records():
-    records, error = read_records()
+    if _mapped():
+        records, error = _mapped_records()
+        if error:
+            return None, error
+        return list(records), None
+
+    records, error = get_store().all()
     if error:
         return None, error
-    return records, None
\ No newline at end of file
+    return records, None
+
+def count_records():
+    if _mapped():
+        records, error = _mapped_records()
+        if error:
+            return None, error
+        return len(records), None
+    return get_store().count()
+
+def get_data_version():
+    # Changes whenever the records do, for ETags and Last-Modified
+    if _mapped():
+        error = get_store().flush()
+        if error:
+            return None, None, error
+        try:
+            mtime, size = file_operations._file_key()
+        except OSError as e:
+            return None, None, f"An error occurred: {e}"
+        return f"{mtime:x}-{size:x}", mtime / 1e9, None
+    return get_store().version()
+
+def get_records_page(cursor=0, limit=None):
+    if _mapped():
+        records, error = _mapped_records()
+        if error:
+            return None, None, error
+        return records.page(cursor, limit) + (None,)
+    return get_store().page(cursor, limit)
+
+def iter_records(cursor=0, limit=None, chunk_size=STREAM_CHUNK_SIZE):
+    # Walk the store one chunk at a time so streaming never copies the whole dataset
+    if _mapped():
+        records, error = _mapped_records()
+        if error:
+            raise RuntimeError(error)
+        records = records.after(cursor)
+        yield from records if limit is None else records[:limit]
+        return
+
+    while limit is None or limit > 0:
+        size = chunk_size if limit is None else min(chunk_size, limit)
+        records, cursor, error = get_records_page(cursor, size)
+        if error:
+            raise RuntimeError(error)
+
+        yield from records
+        if cursor is None:
+            break
+        if limit is not None:
+            limit -= len(records)
+
+def search_records(criteria, cursor=0, limit=None):
+    return get_store().search(criteria, cursor, limit)
+
+def get_stats():
+    # Counts are kept by the store as records change, so this is cheap however many there are
+    return get_store().stats()
+
+def get_changes(since=None, limit=None, wait=0):
+    # Changes after version `since`, waiting up to `wait` seconds for one if
+    # there are none yet: (changes, version, reset, error). See RecordStore.changes.
+    store = get_store()
+    deadline = time.monotonic() + wait
+    while True:
+        changes, version, reset, error = store.changes(since, limit)
+        remaining = deadline - time.monotonic()
+        if error or changes or reset or since is None or remaining <= 0:
+            return changes, version, reset, error
+        # Wake at least once a second so changes by other processes are picked up
+        store.wait_for_change(version, min(remaining, 1.0))
+
+def get_record(record_id):
+    if _mapped():
+        records, error = _mapped_records()
+        if error:
+            return None, error
+        record = records.get(record_id)
+        if record is None:
+            return None, f"No record with ID {record_id}."
+        return record, None
+    return get_store().get(record_id)
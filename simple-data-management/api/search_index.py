@@ -0,0 +1,96 @@
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from functools import lru_cache
+
+# Sorts after every character a name can contain, so (prefix, prefix + _MAX_CHAR)
+# spans every key starting with prefix
+_MAX_CHAR = '\U0010ffff'
+
+def _casefold(value):
+    return sys.intern(value.casefold())  # Names repeat a lot, so share the folded copies
+
+def _same(value):
+    return value
+
+@lru_cache(maxsize=4096)
+def _padded_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+    except ValueError:
+        return value
+
+def _iso_date(value):
+    # Dates as zero-padded YYYY-MM-DD, so they sort by date. Validation accepts
+    # 1995-9-5 as well; text that isn't a date is left as it is.
+    if len(value) == 10 and value[4] == '-' and value[7] == '-':
+        return value
+    return _padded_date(value)
+
+class SortedIndex:
+    # Keys for one record field with the ID of each, sorted by (key, id) so a
+    # range of keys is found with two binary searches. Names are indexed
+    # case-insensitively, dates as YYYY-MM-DD strings, which sort by date. Keys
+    # and IDs are kept in two columns rather than as a tuple per record.
+
+    def __init__(self, field, normalize=_same):
+        self.field = field
+        self.normalize = normalize
+        self._keys = []
+        self._ids = array('q')
+
+    def build(self, records):
+        # records in ID order: a stable sort on the keys alone then leaves equal
+        # keys in ID order, and is much faster than sorting (key, id) tuples
+        keys = [self.normalize(record[self.field]) for record in records]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self._keys = [keys[position] for position in order]
+        self._ids = array('q', [records[position]["id"] for position in order])
+
+    def _find(self, key, record_id):
+        # Where (key, record_id) is or would go
+        start = bisect_left(self._keys, key)
+        end = bisect_right(self._keys, key, start)
+        return bisect_left(self._ids, record_id, start, end)
+
+    def add(self, record):
+        key = self.normalize(record[self.field])
+        position = self._find(key, record["id"])
+        self._keys.insert(position, key)
+        self._ids.insert(position, record["id"])
+
+    def remove(self, record):
+        key = self.normalize(record[self.field])
+        position = self._find(key, record["id"])
+        if position < len(self._ids) and self._ids[position] == record["id"] and self._keys[position] == key:
+            del self._keys[position]
+            del self._ids[position]
+
+    def bounds(self, low, high):
+        # Slice of the entries with low <= key <= high; None leaves that end open
+        start = 0 if low is None else bisect_left(self._keys, low)
+        end = len(self._keys) if high is None else bisect_right(self._keys, high)
+        return start, max(start, end)
+
+    def ids(self, low, high):
+        start, end = self.bounds(low, high)
+        return self._ids[start:end]
+
+    def matches(self, value, low, high):
+        # Whether a value of this field falls in the (normalized) range
+        key = self.normalize(value)
+        return (low is None or low <= key) and (high is None or key <= high)
+
+def create_indexes():
+    return {
+        "first_name": SortedIndex("first_name", _casefold),
+        "last_name": SortedIndex("last_name", _casefold),
+        "date_of_birth": SortedIndex("date_of_birth", _iso_date),
+    }
+
+def exact(value):
+    return (value, value)
+
+def prefix(value):
+    return (value, value + _MAX_CHAR)
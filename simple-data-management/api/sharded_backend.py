@@ -0,0 +1,182 @@
+import heapq
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+
+from . import file_operations
+from .backend import StorageBackend
+from .csv_backend import CsvBackend, read_live_records
+from .file_operations import shard_of, shard_path
+from .metrics import instrument
+
+logger = logging.getLogger(__name__)
+
+# Processes that read shards in parallel when every record is loaded
+SCAN_WORKERS = int(os.environ.get('SDM_SCAN_WORKERS', str(os.cpu_count() or 1)))
+# Below this many bytes in all shards together, reading them in this process
+# is quicker than handing the work to the pool
+PARALLEL_SCAN_BYTES = 16 * 1024 * 1024
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def _scan_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # Spawned rather than forked, so workers never inherit a lock some
+            # other thread of ours was holding
+            _pool = ProcessPoolExecutor(max_workers=SCAN_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+        return _pool
+
+def _read_shards(paths):
+    # read_live_records for every shard, across the pool when there is enough to read
+    size = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+    if SCAN_WORKERS <= 1 or len(paths) == 1 or size < PARALLEL_SCAN_BYTES:
+        return [read_live_records(path) for path in paths]
+    return list(_scan_pool().map(read_live_records, paths))
+
+class _ShardRecords:
+    # The records of one shard out of the full dataset, picked out only if a
+    # shard has to be rewritten
+    def __init__(self, records, shard, shards):
+        self._records = records
+        self._shard = shard
+        self._shards = shards
+
+    def __iter__(self):
+        return (record for record in self._records if shard_of(record["id"], self._shards) == self._shard)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+class ShardedBackend(StorageBackend):
+    # Spreads records over several CSV files by ID (see shard_of), each a
+    # CsvBackend with its own ID index and lock. A write touches only the shards
+    # its records live in, a compaction rewrites only shards with dead rows, and
+    # loading reads the shards in parallel across a process pool. One lock on
+    # CSV_FILE is held by writers, so IDs are still handed out one at a time.
+    #
+    # The first time a number of shards is used, CSV_FILE is split into them.
+    # It is left as it was after that.
+
+    def __init__(self, shards):
+        self.shards = [CsvBackend(shard_path(shard, shards)) for shard in range(shards)]
+        self._next_id = 1
+
+    def _shard(self, record_id):
+        return self.shards[shard_of(record_id, len(self.shards))]
+
+    def key(self):
+        return tuple(shard.key() for shard in self.shards)
+
+    def _split(self):
+        # Create the shard files from CSV_FILE, or empty, if none exist yet
+        if any(os.path.exists(shard.path) for shard in self.shards):
+            for shard in self.shards:
+                if not os.path.exists(shard.path):
+                    _, error = file_operations.write_records([], shard.path)
+                    if error:
+                        return error
+            return None
+
+        source = CsvBackend()
+        records, error = source.load() if os.path.exists(file_operations.CSV_FILE) else ([], None)
+        if error:
+            return error
+        buckets = [[] for _ in self.shards]
+        for record in records:
+            buckets[shard_of(record["id"], len(self.shards))].append(record)
+        for shard, bucket in zip(self.shards, buckets):
+            shard._index.next_id = source._index.next_id  # IDs retired before the split stay retired
+            error = shard.compact(bucket)
+            if error:
+                return error
+        logger.info("Split %d records from %s into %d shards", len(records), file_operations.CSV_FILE, len(self.shards))
+        return None
+
+    @instrument('sharded_load')
+    def load(self):
+        with self.write_lock():
+            error = self._split()
+            if error:
+                return None, error
+
+            try:
+                results = _read_shards([shard.path for shard in self.shards])
+            except Exception as e:
+                return None, f"An error occurred while reading the shards: {e}"
+
+            records = []
+            for shard, (live, offsets, dead, file_key, error) in zip(self.shards, results):
+                if error:
+                    return None, error
+                shard.loaded(live, offsets, dead, file_key)
+                records.extend(live)
+                self._next_id = max(self._next_id, shard._index.next_id)
+
+        # Each shard is already in ID order, which the sort takes advantage of
+        records.sort(key=itemgetter("id"))
+        return records, None
+
+    def get(self, record_id):
+        return self._shard(record_id).get(record_id)
+
+    def scan(self, cursor=0):
+        return heapq.merge(*(shard.scan(cursor) for shard in self.shards), key=itemgetter("id"))
+
+    def allocate_id(self):
+        record_id = self._next_id
+        self._next_id += 1
+        return record_id
+
+    def read_lock(self):
+        return file_operations.lock().read()
+
+    def write_lock(self):
+        return file_operations.lock().write()
+
+    def apply(self, changes, records):
+        by_shard = {}
+        for op, record in changes:
+            by_shard.setdefault(shard_of(record["id"], len(self.shards)), []).append((op, record))
+
+        with self.write_lock():
+            for shard, shard_changes in by_shard.items():
+                error = self.shards[shard].apply(shard_changes, _ShardRecords(records, shard, len(self.shards)))
+                if error:
+                    return error
+        return None
+
+    def log_path(self):
+        return file_operations.CSV_FILE + '.wal'
+
+    def sync(self):
+        for shard in self.shards:
+            error = shard.sync()
+            if error:
+                return error
+        return None
+
+    def tombstone_ratio(self):
+        live = sum(shard._live for shard in self.shards)
+        dead = sum(shard._tombstones for shard in self.shards)
+        return dead / (live + dead) if live + dead else 0.0
+
+    def compact(self, records):
+        buckets = [[] for _ in self.shards]
+        for record in records:
+            buckets[shard_of(record["id"], len(self.shards))].append(record)
+
+        with self.write_lock():
+            for shard, bucket in zip(self.shards, buckets):
+                if shard._tombstones or shard._live != len(bucket):
+                    error = shard.compact(bucket)
+                    if error:
+                        return error
+        return None
@@ -0,0 +1,201 @@
+import sqlite3
+import threading
+
+from .backend import StorageBackend
+from .file_operations import FSYNC_POLICY
+from .locks import file_lock
+from .metrics import count_read, count_written, instrument
+
+_SCHEMA = (
+    # AUTOINCREMENT keeps IDs monotonic, like the CSV engine: deleted IDs are never reused
+    "CREATE TABLE IF NOT EXISTS students ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, first_name TEXT NOT NULL, last_name TEXT NOT NULL, date_of_birth TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS students_first_name ON students (first_name)",
+    "CREATE INDEX IF NOT EXISTS students_last_name ON students (last_name)",
+    "CREATE INDEX IF NOT EXISTS students_date_of_birth ON students (date_of_birth)",
+    # Counts the writes to students, for generation()
+    "CREATE TABLE IF NOT EXISTS generation (value INTEGER NOT NULL)",
+    "INSERT INTO generation (value) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM generation)",
+)
+
+# Fixed statement text with ? parameters, so sqlite3's per-connection statement
+# cache prepares each of them only once
+_SELECT = "SELECT id, first_name, last_name, date_of_birth FROM students"
+_SELECT_ALL = _SELECT + " ORDER BY id"
+_SELECT_ONE = _SELECT + " WHERE id = ?"
+_SELECT_AFTER = _SELECT + " WHERE id > ? ORDER BY id LIMIT ?"
+_INSERT = "INSERT INTO students (id, first_name, last_name, date_of_birth) VALUES (?, ?, ?, ?)"
+_UPSERT = "INSERT OR REPLACE INTO students (id, first_name, last_name, date_of_birth) VALUES (?, ?, ?, ?)"
+_UPDATE = "UPDATE students SET first_name = ?, last_name = ?, date_of_birth = ? WHERE id = ?"
+_DELETE = "DELETE FROM students WHERE id = ?"
+_NEXT_GENERATION = "UPDATE generation SET value = value + 1"
+_GENERATION = "SELECT value FROM generation"
+_LAST_ID = "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'students'), 0), COALESCE((SELECT MAX(id) FROM students), 0))"
+
+# Rows fetched per query while scanning
+SCAN_BATCH_SIZE = 1000
+
+def _to_record(row):
+    return {"id": row[0], "first_name": row[1], "last_name": row[2], "date_of_birth": row[3]}
+
+def _to_row(record):
+    return (record["id"], record["first_name"], record["last_name"], record["date_of_birth"])
+
+class SqliteBackend(StorageBackend):
+    # Stores records in an SQLite database in WAL mode, so readers in other
+    # processes never block on a write. One connection is shared and guarded
+    # by a lock; the RecordStore serialises its calls anyway.
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._connection = None
+        self._next_id = 1
+
+    def _connect(self):
+        if self._connection is None:
+            # Autocommit mode; writes open their own transactions
+            connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute(f"PRAGMA synchronous = {'FULL' if FSYNC_POLICY == 'always' else 'NORMAL'}")
+            for statement in _SCHEMA:
+                connection.execute(statement)
+            self._connection = connection
+        return self._connection
+
+    def _write(self, statements):
+        # Run (sql, parameters) pairs in a single transaction
+        with self._lock:
+            connection = self._connect()
+            try:
+                connection.execute("BEGIN IMMEDIATE")
+                for sql, parameters in statements:
+                    connection.execute(sql, parameters)
+                connection.execute(_NEXT_GENERATION)
+                connection.execute("COMMIT")
+                return None
+            except sqlite3.Error as e:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                return f"An error occurred while writing to the database: {e}"
+
+    def key(self):
+        # data_version only moves when another connection commits, so our own
+        # writes don't count as outside changes
+        try:
+            with self._lock:
+                return self._connect().execute("PRAGMA data_version").fetchone()[0]
+        except sqlite3.Error:
+            return None
+
+    def generation(self):
+        # data_version differs from one connection to the next, so count writes in the database
+        try:
+            with self._lock:
+                return self._connect().execute(_GENERATION).fetchone()[0]
+        except sqlite3.Error:
+            return None
+
+    @instrument('sqlite_load')
+    def load(self):
+        try:
+            with self._lock:
+                connection = self._connect()
+                records = [_to_record(row) for row in connection.execute(_SELECT_ALL)]
+                count_read(0, len(records))
+                self._next_id = max(self._next_id, connection.execute(_LAST_ID).fetchone()[0] + 1)
+            return records, None
+        except sqlite3.Error as e:
+            return None, f"An error occurred: {e}"
+
+    @instrument('sqlite_get')
+    def get(self, record_id):
+        try:
+            with self._lock:
+                row = self._connect().execute(_SELECT_ONE, (record_id,)).fetchone()
+        except sqlite3.Error as e:
+            return None, f"An error occurred: {e}"
+        if row is None:
+            return None, f"No record with ID {record_id}."
+        return _to_record(row), None
+
+    def scan(self, cursor=0):
+        while True:
+            with self._lock:
+                rows = self._connect().execute(_SELECT_AFTER, (cursor, SCAN_BATCH_SIZE)).fetchall()
+            for row in rows:
+                yield _to_record(row)
+            if len(rows) < SCAN_BATCH_SIZE:
+                return
+            cursor = rows[-1][0]
+
+    def allocate_id(self):
+        record_id = self._next_id
+        self._next_id += 1
+        return record_id
+
+    def read_lock(self):
+        return file_lock(self.path).read()
+
+    def write_lock(self):
+        # Transactions alone would let two processes hand out the same next ID
+        return file_lock(self.path).write()
+
+    @instrument('sqlite_apply')
+    def apply(self, changes, records):
+        statements = []
+        for op, record in changes:
+            if op == "create":
+                statements.append((_INSERT, _to_row(record)))
+            elif op == "update":
+                statements.append((_UPDATE, (record["first_name"], record["last_name"], record["date_of_birth"], record["id"])))
+            else:
+                statements.append((_DELETE, (record["id"],)))
+        error = self._write(statements)
+        if not error:
+            count_written(0, len(statements))
+        return error
+
+    def import_records(self, records, next_id=1):
+        # Copy records from another engine in one transaction, streaming them
+        # through executemany so the source is never held in memory
+        with self._lock:
+            connection = self._connect()
+            try:
+                connection.execute("BEGIN IMMEDIATE")
+                copied = connection.executemany(_UPSERT, (_to_row(record) for record in records)).rowcount
+                # Carry over the source's next ID so IDs it already retired stay unused
+                if connection.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'students'", (next_id - 1,)).rowcount == 0:
+                    connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('students', ?)", (next_id - 1,))
+                connection.execute(_NEXT_GENERATION)
+                connection.execute("COMMIT")
+                return copied, None
+            except sqlite3.Error as e:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                return 0, f"An error occurred while writing to the database: {e}"
+
+    def tombstone_ratio(self):
+        try:
+            with self._lock:
+                connection = self._connect()
+                pages = connection.execute("PRAGMA page_count").fetchone()[0]
+                free = connection.execute("PRAGMA freelist_count").fetchone()[0]
+            return free / pages if pages else 0.0
+        except sqlite3.Error:
+            return 0.0
+
+    @instrument('sqlite_compact')
+    def compact(self, records):
+        try:
+            with self._lock:
+                self._connect().execute("VACUUM")
+            return None
+        except sqlite3.Error as e:
+            return f"An error occurred while compacting the database: {e}"
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
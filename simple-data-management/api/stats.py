@@ -0,0 +1,55 @@
+from collections import Counter
+
+def _year(date_of_birth):
+    return date_of_birth[:4]
+
+def _initial(last_name):
+    return last_name[:1].upper()
+
+class RecordStats:
+    # Counts over every record, kept up to date by the RecordStore as records
+    # are added and removed, so reading them never touches the records. Built
+    # from scratch only when the records are (re)loaded.
+
+    def __init__(self):
+        self.total = 0
+        self._years = Counter()
+        self._initials = Counter()
+        self._snapshot = None  # Cached result of snapshot() until the next change
+
+    def build(self, table):
+        # From a RecordTable: count the distinct values of each column, then
+        # fold those into years and initials
+        self.total = len(table)
+        self._years = Counter()
+        for born, count in table.birth_counts().items():
+            self._years[_year(born)] += count
+        self._initials = Counter()
+        for name, count in Counter(table.last_names).items():
+            self._initials[_initial(name)] += count
+        self._snapshot = None
+
+    def add(self, record):
+        self.total += 1
+        self._years[_year(record["date_of_birth"])] += 1
+        self._initials[_initial(record["last_name"])] += 1
+        self._snapshot = None
+
+    def remove(self, record):
+        self.total -= 1
+        for counter, key in ((self._years, _year(record["date_of_birth"])), (self._initials, _initial(record["last_name"]))):
+            counter[key] -= 1
+            if not counter[key]:
+                del counter[key]
+        self._snapshot = None
+
+    def snapshot(self):
+        # {"total", "by_birth_year", "by_last_initial"}, keys in order. Shared
+        # between callers until something changes, so don't modify it.
+        if self._snapshot is None:
+            self._snapshot = {
+                "total": self.total,
+                "by_birth_year": dict(sorted(self._years.items())),
+                "by_last_initial": dict(sorted(self._initials.items())),
+            }
+        return self._snapshot
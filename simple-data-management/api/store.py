@@ -0,0 +1,591 @@
+import atexit
+import hashlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+from .backend import get_backend
+from .changes import ChangeLog
+from .locks import RWLock
+from .records import Record, RecordTable
+from .search_index import create_indexes
+from .stats import RecordStats
+from .wal import WAL_CHECKPOINT_BYTES, WAL_ENABLED, WriteAheadLog, replay
+
+logger = logging.getLogger(__name__)
+
+# Longest time (in seconds) a change may stay in memory before it is written to
+# storage. 0 writes every change through immediately.
+FLUSH_INTERVAL = float(os.environ.get('SDM_FLUSH_INTERVAL', '1.0'))
+# Number of unwritten changes that forces a flush before the interval is up
+MAX_PENDING = int(os.environ.get('SDM_MAX_PENDING', '1000'))
+# Versions named after storage (see RecordStore._settle) that are still understood
+MAX_SHARED_VERSIONS = 1024
+
+class RecordStore:
+    # Reads share the lock, changes take it exclusively. Changes also hold the
+    # backend's write lock from the reload check through to the flush, so with a
+    # flush interval of 0 several processes can write to the same data safely.
+    #
+    # When the backend has a log path, every change is also appended to a
+    # write-ahead log and synced before it is reported as done, so changes still
+    # waiting for a flush survive a crash. The log is replayed on first load and
+    # emptied (a checkpoint) once it grows past checkpoint_bytes.
+
+    def __init__(self, backend=None, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING,
+                 wal=WAL_ENABLED, checkpoint_bytes=WAL_CHECKPOINT_BYTES):
+        self.backend = backend if backend is not None else get_backend()
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.checkpoint_bytes = checkpoint_bytes
+
+        log_path = self.backend.log_path() if wal else None
+        self._wal = WriteAheadLog(log_path) if log_path else None
+        self._unlogged = []  # Changes queued since the last append to the log
+
+        self._lock = RWLock()
+        self._wake = threading.Event()  # Tells the flusher a change is waiting
+        self._records = None  # RecordTable, loaded lazily on first use
+        self._indexes = create_indexes()  # Sorted field indexes for search()
+        self._stats = RecordStats()  # Counts for stats(), kept up to date with the indexes
+        self._key = None  # backend.key() when we last loaded or wrote
+        # Moves on every change to the records, ours or picked up from outside. The
+        # token keeps versions from an earlier run of the process from matching.
+        self._token = os.urandom(4).hex()
+        self._version = 0
+        # While storage holds exactly our records, the version is named after the
+        # stored data instead, so every process serving it hands out the same one
+        self._shared = None
+        self._shared_versions = {}  # Those names -> our version number, oldest first
+        self._modified = time.time()
+        self._changes = ChangeLog()  # Recent changes, for mirrors following /api/changes
+        self._pending = []  # Changes not yet on disk: ("create" | "update" | "delete", record)
+        self._dirty_since = None
+        self._flusher = None
+        self._closed = False
+
+    def _sync(self):
+        # Reload when the data was changed by someone else since we last saw it
+        key = self.backend.key()
+        if self._records is not None and key == self._key:
+            return None
+
+        if self._pending:
+            # Write our own changes first so they are not lost by the reload
+            error = self._flush_locked()
+            if error:
+                return error
+
+        # Lock out writers so the key we remember belongs to what we loaded. This
+        # takes the write lock because loading may upgrade an old data file.
+        with self.backend.write_lock():
+            records, error = self.backend.load()
+            if error:
+                return error
+            if self._records is None and self._wal is not None:
+                records, error = self._recover(records)
+                if error:
+                    return error
+            previous, self._records = self._records, RecordTable.from_records(records)
+            for index in self._indexes.values():
+                index.build(records)
+            self._stats.build(self._records)
+            self._key = self.backend.key()
+            self._log_outside_changes(previous)
+            self._settle()
+        return None
+
+    def _log_outside_changes(self, previous):
+        # The records were reloaded, e.g. after another process wrote to storage.
+        # Put what changed since `previous` in the change log, so clients
+        # following /api/changes don't have to reload everything.
+        changes = None
+        if previous is not None:
+            changes = list(islice(previous.diff(self._records), self._changes.max_entries + 1))
+        if changes is None or len(changes) > self._changes.max_entries:
+            self._changed()
+            self._changes.reset(self._version)
+            return
+        for op, record in changes:
+            self._changed()
+            self._changes.append(self._version, op, record)
+
+    def _settle(self):
+        # Storage holds exactly our records now (call with its write lock held):
+        # name the version after the stored data
+        generation = self.backend.generation()
+        if generation is None:
+            self._shared = None
+            return
+        self._shared = hashlib.blake2b(repr(generation).encode(), digest_size=8).hexdigest()
+        self._shared_versions.pop(self._shared, None)
+        self._shared_versions[self._shared] = self._version
+        if len(self._shared_versions) > MAX_SHARED_VERSIONS:
+            del self._shared_versions[next(iter(self._shared_versions))]
+
+    def _name(self, version):
+        # What clients see of one of our version numbers
+        if version == self._version and self._shared is not None:
+            return self._shared
+        return f"{self._token}-{version}"
+
+    def _number(self, name):
+        # Our version number for a name from _name, or None
+        version = self._shared_versions.get(name)
+        if version is not None:
+            return version
+        token, _, number = name.rpartition('-')
+        return int(number) if token == self._token and number.isdigit() else None
+
+    def _recover(self, records):
+        # Replay changes a crash kept from reaching storage: (records, error)
+        changes, error = self._wal.read()
+        if error:
+            return None, error
+        if not changes:
+            return records, None
+        records, missing = replay(records, changes, self.backend.allocate_id)
+        if missing:
+            error = self.backend.apply(missing, records)
+            if error:
+                return None, error
+            logger.info("Recovered %d changes from %s", len(missing), self._wal.path)
+        error = self.backend.sync() or self._wal.truncate()
+        if error:
+            return None, error
+        return records, None
+
+    @contextmanager
+    def _reading(self):
+        # Shared access to up-to-date records. Yields the error from reloading, if any.
+        with self._lock.read():
+            if self._records is not None and self.backend.key() == self._key:
+                yield None
+                return
+        with self._lock.write():
+            yield self._sync()
+
+    @contextmanager
+    def _writing(self):
+        # Exclusive access to up-to-date records. Yields the error from reloading, if any.
+        with self._lock.write(), self.backend.write_lock():
+            yield self._sync()
+
+    def _changed(self):
+        self._version += 1
+        self._modified = time.time()
+        self._shared = None
+
+    def _queue(self, op, record):
+        self._changed()
+        self._changes.append(self._version, op, record)
+        self._pending.append((op, record))
+        if self._wal is not None:
+            self._unlogged.append((op, record))
+        if self._dirty_since is None:
+            self._dirty_since = time.monotonic()
+
+    def _log(self):
+        # Append the changes queued since the last call to the write-ahead log.
+        # Returns the sequence number to wait for with _commit, or None when
+        # there is no log or nothing to write.
+        if self._wal is None or not self._unlogged:
+            return None
+        sequence, error = self._wal.append(self._unlogged)
+        self._unlogged = []
+        if error:
+            # Without the log the changes are only safe once they are flushed
+            logger.warning("%s; flushing instead", error)
+            error = self._flush_locked()
+            if error:
+                logger.error("Flushing after a failed log write failed: %s", error)
+            return None
+        return sequence
+
+    def _commit(self, sequence, error=None):
+        # Wait, outside the lock, until the logged changes are on disk. Writers
+        # that get here together share one fsync. A failed flush is retried
+        # later, so the change is still logged.
+        if sequence is None:
+            return error
+        return self._wal.sync(sequence) or error
+
+    def _schedule_flush(self):
+        if self.flush_interval <= 0 or len(self._pending) >= self.max_pending:
+            return self._flush_locked()
+
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run_flusher, name="record-store-flusher", daemon=True)
+            self._flusher.start()
+        self._wake.set()
+        return None
+
+    def _flush_locked(self):
+        if not self._pending:
+            return None
+
+        with self.backend.write_lock():
+            merged = self.backend.key() != self._key
+            if merged:
+                error = self._merge_locked()
+            else:
+                error = self.backend.apply(self._pending, self._records)
+            if error:
+                return error
+            self._key = self.backend.key()
+            self._settle()
+            if self._wal is not None:
+                error = self._wal.mark_flushed()
+                if error:
+                    logger.warning("%s; the flushed changes will be checked again on recovery", error)
+                # After a merge the log may hold creates under IDs they no longer have
+                if merged or self._wal.size() >= self.checkpoint_bytes:
+                    self._checkpoint()
+
+        self._pending.clear()
+        self._dirty_since = None
+        return None
+
+    def _merge_locked(self):
+        # Storage changed since we loaded it (another process wrote to it), so
+        # writing our records out would drop whatever that process added. Load
+        # storage again and apply our pending changes on top instead. A create
+        # whose ID the other process has used since gets a new one; an update of
+        # a record it deleted is dropped, and so is a record created and deleted
+        # here before it ever reached storage.
+        records, error = self.backend.load()
+        if error:
+            return error
+        by_id = {record["id"]: record for record in records}
+        taken = set(by_id).union(record["id"] for op, record in self._pending if op == "create")
+        renumbered = {}
+        unstored = set()  # IDs of records created here since the last flush
+        discarded = set()  # ... and of those deleted again since
+        changes = []
+        for op, record in self._pending:
+            record_id = renumbered.get(record["id"], record["id"])
+            if op == "create":
+                if record_id in by_id:
+                    record_id = self.backend.allocate_id()
+                    while record_id in taken:
+                        record_id = self.backend.allocate_id()
+                    taken.add(record_id)
+                    renumbered[record["id"]] = record_id
+                unstored.add(record_id)
+            if op == "delete":
+                deleted = by_id.pop(record_id, None)
+                if record_id in unstored:
+                    discarded.add(record_id)
+                elif deleted is not None:
+                    changes.append((op, deleted))
+                continue
+            if op == "update" and record_id not in by_id:
+                logger.warning("Dropping an update of record %d, which another process deleted", record_id)
+                continue
+            record = Record(record_id, record["first_name"], record["last_name"], record["date_of_birth"])
+            by_id[record_id] = record
+            changes.append((op, record))
+        changes = [(op, record) for op, record in changes if record["id"] not in discarded]
+        if renumbered:
+            logger.warning("Another process used the IDs of records created here; renumbered %s",
+                           ", ".join(f"{old} to {new}" for old, new in renumbered.items()))
+
+        records = sorted(by_id.values(), key=lambda record: record["id"])
+        error = self.backend.apply(changes, records)
+        if error:
+            return error
+        previous, self._records = self._records, RecordTable.from_records(records)
+        for index in self._indexes.values():
+            index.build(records)
+        self._stats.build(self._records)
+        self._log_outside_changes(previous)
+        return None
+
+    def _checkpoint(self):
+        # Everything logged is in storage now; once storage is on disk the log
+        # can be emptied. A failure just leaves the log to be replayed.
+        error = self.backend.sync() or self._wal.truncate()
+        if error:
+            logger.warning("Checkpoint failed: %s", error)
+
+    def _run_flusher(self):
+        while True:
+            with self._lock.write():
+                if self._closed:
+                    return
+                delay = None
+                if self._dirty_since is not None:
+                    delay = self._dirty_since + self.flush_interval - time.monotonic()
+                    if delay <= 0:
+                        error = self._flush_locked()
+                        if error:
+                            logger.error("Background flush failed: %s", error)
+                            self._dirty_since = time.monotonic()  # Try again after another interval
+                        continue
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def flush(self):
+        with self._lock.write():
+            return self._flush_locked()
+
+    def close(self):
+        with self._lock.write():
+            self._closed = True
+            self._wake.set()
+            error = self._flush_locked()
+            if not error and self._wal is not None:
+                if self._wal.size():
+                    with self.backend.write_lock():
+                        self._checkpoint()
+                self._wal.close()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.backend.close()
+        return error
+
+    def tombstone_ratio(self):
+        with self._reading() as error:
+            if error:
+                return None, error
+            return self.backend.tombstone_ratio(), None
+
+    def compact(self):
+        with self._writing() as error:
+            error = error or self._flush_locked()
+            if error:
+                return error
+            error = self.backend.compact(self._records)
+            if error:
+                return error
+            self._key = self.backend.key()
+            self._settle()
+            return None
+
+    def all(self):
+        with self._reading() as error:
+            if error:
+                return None, error
+            return self._records.copy(), None  # A RecordTable: a sequence of Records
+
+    def count(self):
+        with self._reading() as error:
+            if error:
+                return None, error
+            return len(self._records), None
+
+    def stats(self):
+        # Counts over all records: (stats, error); see RecordStats.snapshot
+        with self._reading() as error:
+            if error:
+                return None, error
+            return self._stats.snapshot(), None
+
+    def version(self):
+        # (version, last_modified, error). last_modified is a Unix timestamp.
+        with self._reading() as error:
+            if error:
+                return None, None, error
+            return self._name(self._version), self._modified, None
+
+    def changes(self, since=None, limit=None):
+        # Changes made after version `since` (as returned by version()), oldest
+        # first: (changes, version, reset, error). Each change is a
+        # (version, op, record) tuple, and version is the one to ask from next.
+        # reset means the changes since then are not all known, so the caller
+        # has to reload everything.
+        with self._reading() as error:
+            if error:
+                return None, None, None, error
+            current = self._name(self._version)
+            if since is None:
+                return [], current, False, None
+
+            number = self._number(since)
+            changes = self._changes.since(number, limit) if number is not None else None
+            if changes is None:
+                return [], current, True, None
+            if changes and len(changes) == limit:
+                current = self._name(changes[-1][0])  # More may follow
+            return [(self._name(version), op, record) for version, op, record in changes], current, False, None
+
+    def wait_for_change(self, version, timeout):
+        # Block until the store moves past version (as returned by version()),
+        # or timeout seconds pass. Changes from other processes are only noticed
+        # on the next read.
+        number = self._number(version)
+        return self._changes.wait(self._version if number is None else number, timeout)
+
+    def get(self, record_id):
+        with self._reading() as error:
+            if error:
+                return None, error
+            record = self._records.get(record_id)
+            if record is None:
+                return None, f"No record with ID {record_id}."
+            return record, None
+
+    def page(self, cursor=0, limit=None):
+        # Records with IDs after `cursor`, plus the cursor for the next page
+        with self._reading() as error:
+            if error:
+                return None, None, error
+
+            start = self._records.after(cursor)
+            end = len(self._records) if limit is None else start + limit
+            next_cursor = self._records.ids[end - 1] if end < len(self._records) else None
+            return self._records.copy(start, end), next_cursor, None
+
+    def search(self, criteria, cursor=0, limit=None):
+        # Records matching every {field: (low, high)} range in criteria (bounds
+        # inclusive, None for open), with IDs after `cursor`, in ID order
+        with self._reading() as error:
+            if error:
+                return None, None, error
+
+            ranges = {}
+            for field, (low, high) in criteria.items():
+                index = self._indexes[field]
+                ranges[field] = (None if low is None else index.normalize(low), None if high is None else index.normalize(high))
+
+            # The narrowest index gives the fewest candidates, but in key order, so
+            # they have to be sorted by ID before the cursor and limit apply. When
+            # most records match, walking the table in ID order from the cursor
+            # and checking every field reaches the end of the page much sooner.
+            bounds = {field: self._indexes[field].bounds(*ranges[field]) for field in ranges}
+            narrowest = min(ranges, key=lambda field: bounds[field][1] - bounds[field][0])
+            table = self._records
+            matches = bounds[narrowest][1] - bounds[narrowest][0]
+            remaining = len(table) - table.after(cursor)
+            to_scan = remaining if limit is None or not matches else min(remaining, (limit + 1) * len(table) // matches)
+            if to_scan <= matches:
+                checks = [(self._indexes[field], low, high) for field, (low, high) in ranges.items()]
+                candidates = range(table.after(cursor), len(table))
+            else:
+                checks = [(self._indexes[field], low, high) for field, (low, high) in ranges.items() if field != narrowest]
+                candidates = (table.position(record_id) for record_id in sorted(self._indexes[narrowest].ids(*ranges[narrowest]))
+                              if record_id > cursor)
+
+            positions = []  # Of the matching rows; Records are only built for these
+            for position in candidates:
+                if all(index.matches(table.value(position, index.field), low, high) for index, low, high in checks):
+                    positions.append(position)
+                    if limit is not None and len(positions) > limit:
+                        break
+
+            next_cursor = None
+            if limit is not None and len(positions) > limit:
+                positions = positions[:limit]
+                next_cursor = table.ids[positions[-1]]
+            return [table[position] for position in positions], next_cursor, None
+
+    def _index_add(self, record):
+        for index in self._indexes.values():
+            index.add(record)
+        self._stats.add(record)
+
+    def _index_remove(self, record):
+        for index in self._indexes.values():
+            index.remove(record)
+        self._stats.remove(record)
+
+    def _create(self, first_name, last_name, date_of_birth):
+        record_id = self.backend.allocate_id()
+        record = Record(record_id, first_name, last_name, date_of_birth)
+        self._records.append(record)
+        self._index_add(record)
+        self._queue("create", record)
+        return record_id
+
+    def _update(self, record_id, first_name, last_name, date_of_birth):
+        if not self._records:
+            return "No records to update."
+
+        position = self._records.position(record_id)
+        if position is not None:
+            record = Record(record_id, first_name, last_name, date_of_birth)
+            self._index_remove(self._records[position])
+            self._records.replace(position, record)
+            self._index_add(record)
+            self._queue("update", record)
+            return None
+        else:
+            return "Invalid record ID. Please enter a valid ID."
+
+    def _delete(self, record_id):
+        if not self._records:
+            return "No records to delete."
+
+        position = self._records.position(record_id)
+        if position is not None:
+            record = self._records[position]
+            self._records.delete(position)
+            self._index_remove(record)
+            self._queue("delete", record)
+            return None
+        else:
+            return "Invalid record ID. Please enter a valid ID."
+
+    def create(self, first_name, last_name, date_of_birth):
+        with self._writing() as error:
+            if error:
+                return None, error
+            record_id = self._create(first_name, last_name, date_of_birth)
+            sequence = self._log()
+            error = self._schedule_flush()
+        return record_id, self._commit(sequence, error)
+
+    def update(self, record_id, first_name, last_name, date_of_birth):
+        with self._writing() as error:
+            error = error or self._update(record_id, first_name, last_name, date_of_birth)
+            if error:
+                return error
+            sequence = self._log()
+            error = self._schedule_flush()
+        return self._commit(sequence, error)
+
+    def delete(self, record_id):
+        with self._writing() as error:
+            error = error or self._delete(record_id)
+            if error:
+                return error
+            sequence = self._log()
+            error = self._schedule_flush()
+        return self._commit(sequence, error)
+
+    def batch(self, operations):
+        # Apply every operation under one lock and write them all out with a
+        # single flush. Returns an (id, error) pair per operation.
+        with self._writing() as error:
+            if error:
+                return None, error
+
+            results = []
+            for operation in operations:
+                op = operation["op"]
+                if op == "create":
+                    record_id = self._create(operation["first_name"], operation["last_name"], operation["date_of_birth"])
+                    results.append((record_id, None))
+                elif op == "update":
+                    error = self._update(operation["record_id"], operation["first_name"], operation["last_name"], operation["date_of_birth"])
+                    results.append((operation["record_id"], error))
+                else:
+                    results.append((operation["record_id"], self._delete(operation["record_id"])))
+            sequence = self._log()
+            error = self._flush_locked()
+        return results, self._commit(sequence, error)
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = RecordStore()
+            atexit.register(_store.close)  # Don't lose the dirty window on shutdown
+        return _store
@@ -0,0 +1,260 @@
+import glob
+import json
+import logging
+import os
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows: every process shares one log
+    fcntl = None
+
+from .metrics import count_read, count_written, instrument
+
+logger = logging.getLogger(__name__)
+
+# Set SDM_WAL=0 to write changes only to the data file, as before
+WAL_ENABLED = os.environ.get('SDM_WAL', '1') not in ('0', 'false', 'no', 'off')
+# Size the log may grow to before the data file is synced and the log emptied
+WAL_CHECKPOINT_BYTES = int(os.environ.get('SDM_WAL_CHECKPOINT_BYTES', str(4 * 1024 * 1024)))
+
+WAL_SUFFIX = '.wal'
+# Entry that says storage holds every change logged before it
+FLUSHED = "flushed"
+
+def _encode(op, record):
+    # One line per change: CRC32 of the JSON, then the JSON, so a line torn by a
+    # crash is recognised and dropped
+    entry = {"op": op}
+    if record is not None:
+        entry.update({"id": record["id"], "first_name": record["first_name"], "last_name": record["last_name"],
+                      "date_of_birth": record["date_of_birth"]})
+    data = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+    return b'%08x %s\n' % (zlib.crc32(data), data)
+
+def _decode(line):
+    # (op, record), or None if the line is incomplete or damaged
+    checksum, _, data = line.rstrip(b'\n').partition(b' ')
+    if not line.endswith(b'\n') or checksum != b'%08x' % zlib.crc32(data):
+        return None
+    try:
+        entry = json.loads(data)
+    except ValueError:
+        return None
+    op = entry.pop("op")
+    return op, entry
+
+def _claim(path):
+    # Open path and take its flock, or return None if a live process holds it
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+    return fd
+
+class WriteAheadLog:
+    # Append-only log of changes made to the RecordStore, synced to disk before
+    # a change is reported as done, so nothing acknowledged is lost if the process
+    # dies before the change reaches the data file.
+    #
+    # Each process writes its own log, held with a flock: the first to open one
+    # gets `path`, the others `path.1`, `path.2` and so on. Only logs nobody
+    # holds, left by processes that died, are read back; a live process's log is
+    # never replayed or emptied by another.
+    #
+    # Appending and syncing are separate steps (group commit): writers append
+    # while holding the store's lock, then wait for sync() after releasing it.
+    # Whoever syncs first covers every line appended up to then, so concurrent
+    # writers share a single fsync.
+
+    def __init__(self, path):
+        self.base = path
+        self.path = path  # The log this process writes, once opened
+        self._orphans = []  # (fd, path) of dead processes' logs read but not yet removed
+        self._lock = threading.Lock()  # Guards the file and the counters
+        self._sync_lock = threading.Lock()  # One fsync at a time
+        self._fd = None
+        self._pid = None
+        self._appended = 0  # Sequence number of the last append
+        self._synced = 0  # Appends known to be on disk
+        self._size = 0
+
+    def _open(self):
+        if self._pid != os.getpid():
+            if self._fd is not None:
+                os.close(self._fd)  # A forked worker must not share its parent's log
+            self._fd = None
+            number = 0
+            while self._fd is None:
+                self.path = self.base if not number else f"{self.base}.{number}"
+                self._fd = _claim(self.path)
+                number += 1
+            self._pid = os.getpid()
+            self._size = os.fstat(self._fd).st_size
+        return self._fd
+
+    @instrument('wal_append')
+    def append(self, changes):
+        # Write ("create" | "update" | "delete", record) changes to the log.
+        # Returns (sequence number to pass to sync(), error).
+        data = b''.join(_encode(op, record) for op, record in changes)
+        try:
+            with self._lock:
+                fd = self._open()
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                self._size += len(data)
+                self._appended += 1
+                count_written(len(data), len(changes))
+                return self._appended, None
+        except OSError as e:
+            return None, f"An error occurred while writing to the log: {e}"
+
+    @instrument('wal_sync')
+    def sync(self, sequence):
+        # Wait until the append numbered sequence is on disk. Returns an error or None.
+        if self._synced >= sequence:
+            return None
+        try:
+            with self._sync_lock:
+                if self._synced >= sequence:
+                    return None  # Synced by another writer while we waited
+                with self._lock:
+                    fd = self._open()
+                    target = self._appended
+                os.fsync(fd)
+                self._synced = max(self._synced, target)
+            return None
+        except OSError as e:
+            return f"An error occurred while syncing the log: {e}"
+
+    def mark_flushed(self):
+        # Note that every change appended so far has reached storage, so they
+        # are not replayed. Not synced: losing the note only means they are
+        # checked against storage again. Returns an error or None.
+        return self.append([(FLUSHED, None)])[1]
+
+    def size(self):
+        with self._lock:
+            return self._size
+
+    @instrument('wal_read')
+    def read(self):
+        # Every complete change in our log and in those left by processes that
+        # died, log by log, leaving out those marked as flushed: (changes,
+        # error). Reading a log stops at its first damaged line; nothing after
+        # it was acknowledged.
+        changes = []
+        try:
+            with self._lock:
+                logs = [(self._open(), self.path)]
+                for path in sorted(glob.glob(glob.escape(self.base) + '*')):
+                    if path != self.path and (path == self.base or path[len(self.base) + 1:].isdigit()):
+                        fd = _claim(path)
+                        if fd is not None:
+                            self._orphans.append((fd, path))
+                            logs.append((fd, path))
+                for fd, path in logs:
+                    data = os.pread(fd, os.fstat(fd).st_size, 0)
+                    count_read(len(data))
+                    unflushed = []
+                    for line in data.splitlines(keepends=True):
+                        change = _decode(line)
+                        if change is None:
+                            logger.warning("Ignoring a damaged entry at the end of %s", path)
+                            break
+                        if change[0] == FLUSHED:
+                            unflushed = []
+                        else:
+                            unflushed.append(change)
+                    changes.extend(unflushed)
+        except OSError as e:
+            return None, f"An error occurred while reading the log: {e}"
+        return changes, None
+
+    def truncate(self):
+        # Empty the log once the data file holds, on disk, every change in it,
+        # and remove the dead processes' logs read with it
+        try:
+            with self._lock:
+                os.ftruncate(self._open(), 0)
+                self._size = 0
+                self._synced = self._appended
+                while self._orphans:
+                    fd, path = self._orphans.pop()
+                    os.unlink(path)
+                    os.close(fd)
+            return None
+        except OSError as e:
+            return f"An error occurred while emptying the log: {e}"
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None and self._pid == os.getpid():
+                if self.path != self.base and not os.fstat(self._fd).st_size:
+                    try:
+                        os.unlink(self.path)  # Numbered logs are only kept while they hold something
+                    except FileNotFoundError:
+                        pass
+                os.close(self._fd)
+            for fd, _ in self._orphans:
+                os.close(fd)
+            self._orphans = []
+            self._fd = None
+            self._pid = None
+
+def replay(records, changes, allocate_id):
+    # Apply logged changes over records loaded from storage. Every change carries
+    # the whole record, so one that already reached storage is skipped. A create
+    # whose ID now holds a record it never had has lost that ID to another
+    # process, and gets a new one from allocate_id(). Returns (records sorted by
+    # ID, the changes that were missing from storage).
+    by_id = {record["id"]: record for record in records}
+    stored = set(by_id)
+    logged = {}  # ID -> every state the log gives that record
+    for op, record in changes:
+        if op != "delete":
+            logged.setdefault(record["id"], []).append(record)
+    taken = set(by_id).union(logged)
+    renumbered = {}
+    missing = []
+    for op, record in changes:
+        if op == "create":
+            record_id = record["id"]
+            renumbered.pop(record_id, None)
+            current = by_id.get(record_id)
+            # Stored as one of the states logged for it, the record is this one;
+            # anything else (including a create replayed just before) is not
+            if current is not None and (record_id not in stored or dict(current) not in logged[record_id]):
+                record_id = allocate_id()
+                while record_id in taken:
+                    record_id = allocate_id()
+                taken.add(record_id)
+                renumbered[record["id"]] = record_id
+                current = None
+        else:
+            record_id = renumbered.get(record["id"], record["id"])
+            current = by_id.get(record_id)
+        if record_id != record["id"]:
+            record = {**record, "id": record_id}
+        if op == "delete":
+            if current is not None:
+                del by_id[record["id"]]
+                missing.append(("delete", record))
+        elif current is None:
+            by_id[record["id"]] = record
+            missing.append(("create", record))
+        elif dict(current) != record:
+            by_id[record["id"]] = record
+            missing.append(("update", record))
+    if renumbered:
+        logger.warning("Another process used the IDs of logged records; renumbered %s",
+                       ", ".join(f"{old} to {new}" for old, new in renumbered.items()))
+    if not missing:
+        return records, []
+    return sorted(by_id.values(), key=lambda record: record["id"]), missing
@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)
+FIRST_NAMES = ("Amy", "Ben", "Cara", "Dan", "Eve", "Finn", "Gina", "Hugo", "Iris", "Jack", "Kate", "Liam",
+               "Mia", "Noah", "Olga", "Paul", "Quinn", "Rosa", "Sam", "Tara", "Uma", "Vic", "Wes", "Zoe")
+LAST_NAMES = ("Adams", "Brown", "Clark", "Davis", "Evans", "Foster", "Green", "Hill", "Irwin", "Jones", "King",
+              "Lewis", "Moore", "Nash", "Owens", "Price", "Reed", "Smith", "Turner", "Walsh", "Young")
+
+def random_fields(rng):
+    return (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES),
+            f"{rng.randint(1950, 2010)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}")
+
+def generate_csv(path, rows, seed=0):
+    # Synthetic students.csv with IDs 1..rows; the same seed always gives the same file
+    rng = random.Random(seed)
+    with open(path, mode='w', newline='', encoding='utf-8') as file:
+        file.write("ID,First Name,Last Name,Date of Birth\r\n")
+        batch = []
+        for record_id in range(1, rows + 1):
+            batch.append("%d,%s,%s,%s\r\n" % ((record_id,) + random_fields(rng)))
+            if len(batch) >= 10_000:
+                file.write(''.join(batch))
+                batch = []
+        file.write(''.join(batch))
+
+def summarize(latencies):
+    # ops/sec and latency percentiles (nearest rank) for one benchmark
+    ordered = sorted(latencies)
+    total = sum(ordered)
+
+    def percentile(share):
+        return ordered[min(len(ordered) - 1, max(0, round(share * len(ordered)) - 1))] * 1000
+
+    return {
+        "ops": len(ordered),
+        "ops_per_sec": round(len(ordered) / total, 2) if total else None,
+        "p50_ms": round(percentile(0.50), 4),
+        "p99_ms": round(percentile(0.99), 4),
+    }
+
+def measure(function, arguments):
+    latencies = []
+    for args in arguments:
+        started = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - started)
+    return summarize(latencies)
+
+def peak_rss_kb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # macOS reports bytes, Linux kilobytes
+
+def check(error):
+    if error:
+        raise RuntimeError(error)
+
+def run_size(rows, ops, repeats, seed):
+    # Runs in a fresh process whose working directory holds the generated students.csv
+    started = time.perf_counter()
+    generate_csv('students.csv', rows, seed)
+    generate_seconds = time.perf_counter() - started
+
+    from api import store
+    from api.backend import STORAGE
+    from api.file_operations import read_records
+    from api.create import create_record
+    from api.retrieve import get_all_records
+    from api.update import update_record
+    from api.delete import delete_record
+    from server.api import app
+
+    if STORAGE == 'sqlite':
+        from api.migrate import migrate_to_sqlite
+        check(migrate_to_sqlite()[1])
+
+    rng = random.Random(seed + 1)
+    ops = min(ops, rows // 4)  # Leave records to update and delete in both rounds
+    results = {}
+
+    def run_direct(name, function, arguments):
+        results[f"direct.{name}"] = measure(function, arguments)
+
+    run_direct("read_records", lambda: check(read_records()[1]), [()] * repeats)
+
+    store._store = store.RecordStore()
+    started = time.perf_counter()
+    check(get_all_records()[1])
+    results["direct.get_all_records.cold"] = summarize([time.perf_counter() - started])
+    run_direct("get_all_records", lambda: check(get_all_records()[1]), [()] * repeats)
+
+    ids = rng.sample(range(1, rows + 1), 4 * ops)
+    run_direct("create_record", lambda *fields: check(create_record(*fields)[1]),
+               [random_fields(rng) for _ in range(ops)])
+    run_direct("update_record", lambda record_id, *fields: check(update_record(record_id, *fields)),
+               [(record_id,) + random_fields(rng) for record_id in ids[:ops]])
+    run_direct("delete_record", lambda record_id: check(delete_record(record_id)),
+               [(record_id,) for record_id in ids[ops:2 * ops]])
+    check(store.get_store().flush())
+
+    client = app.test_client()
+
+    def run_http(name, method, path, bodies):
+        def call(body):
+            response = client.open(path, method=method, json=body)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{method} {path} returned {response.status_code}")
+        results[f"http.{name}"] = measure(call, [(body,) for body in bodies])
+
+    run_http("get_records", 'GET', '/api/records', [None] * repeats)
+    run_http("get_records_page", 'GET', '/api/records?limit=100', [None] * ops)
+    run_http("create", 'POST', '/api/create',
+             [dict(zip(("first_name", "last_name", "date_of_birth"), random_fields(rng))) for _ in range(ops)])
+    run_http("update_record", 'PUT', '/api/update_record',
+             [dict(zip(("record_id", "first_name", "last_name", "date_of_birth"), (record_id,) + random_fields(rng)))
+              for record_id in ids[2 * ops:3 * ops]])
+    run_http("delete", 'DELETE', '/api/delete', [{"record_id": record_id} for record_id in ids[3 * ops:]])
+    check(store.get_store().flush())
+
+    return {
+        "rows": rows,
+        "flush_interval": store.get_store().flush_interval,
+        "generate_seconds": round(generate_seconds, 3),
+        "peak_rss_kb": peak_rss_kb(),
+        "benchmarks": results,
+    }
+
+def run_in_child(rows, ops, repeats, seed):
+    # A process per size, so peak RSS and module state start from scratch each time
+    env = dict(os.environ)
+    env.setdefault('SDM_LOG_LEVEL', 'WARNING')  # Request summaries would be timed too
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (ROOT, env.get('PYTHONPATH'))))
+    with tempfile.TemporaryDirectory(prefix='sdm-bench-') as directory:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.crud', '--child', str(rows), '--ops', str(ops),
+             '--repeats', str(repeats), '--seed', str(seed)],
+            cwd=directory, env=env, check=True, stdout=subprocess.PIPE, text=True,
+        ).stdout
+    return json.loads(output)
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(baseline, report):
+    # One line per benchmark: ops/sec now against the baseline report
+    previous = {(size["rows"], name): result for size in baseline["results"] for name, result in size["benchmarks"].items()}
+    for size in report["results"]:
+        for name, result in size["benchmarks"].items():
+            before = previous.get((size["rows"], name))
+            if before and before["ops_per_sec"] and result["ops_per_sec"]:
+                change = result["ops_per_sec"] / before["ops_per_sec"] - 1
+                print(f"{size['rows']:>9} {name:<32} {result['ops_per_sec']:>12.1f} ops/s {change:+8.1%}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the CRUD paths on synthetic students.csv files.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="rows per dataset (default: %(default)s)")
+    parser.add_argument('--ops', type=int, default=1000, help="creates, updates and deletes per benchmark (default: %(default)s)")
+    parser.add_argument('--repeats', type=int, default=5, help="full reads per benchmark (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the generated data (default: %(default)s)")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--compare', help="earlier JSON report to compare ops/sec against")
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_size(args.child, args.ops, args.repeats, args.seed)))
+        raise SystemExit
+
+    report = {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "storage": os.environ.get('SDM_STORAGE', 'csv'),
+        "results": [run_in_child(rows, args.ops, args.repeats, args.seed) for rows in args.sizes],
+    }
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            compare(json.load(file), report)
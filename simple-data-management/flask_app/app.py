@@ -1,25 +1,171 @@
-from flask import Flask, jsonify, render_template, redirect, url_for, flash, request
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import Flask, jsonify, render_template, redirect, url_for, flash, request, session
+from markupsafe import Markup
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 app = Flask(__name__)
 app.secret_key = 'top_secret0'
 
-API_BASE_URL = 'http://127.0.0.1:5000/api'
+API_BASE_URL = os.environ.get('SDM_API_BASE_URL', 'http://127.0.0.1:5000/api')
+API_POOL_SIZE = int(os.environ.get('SDM_API_POOL_SIZE', '10'))  # Kept-alive connections to the backend API
+API_TIMEOUT = float(os.environ.get('SDM_API_TIMEOUT', '5'))  # Seconds to connect, and again to wait for a reply
+API_RETRIES = int(os.environ.get('SDM_API_RETRIES', '2'))
+PAGE_SIZE = 48  # Records shown per page, a multiple of the three-card row
+CACHE_TTL = float(os.environ.get('SDM_CACHE_TTL', '2'))  # Seconds a cached page is shown without asking the backend API
+CACHE_SIZE = int(os.environ.get('SDM_CACHE_SIZE', '128'))  # Cached pages kept, least recently used dropped first
+CARD_CACHE_SIZE = int(os.environ.get('SDM_CARD_CACHE_SIZE', '10000'))  # Rendered record cards kept
+
+def create_api_session():
+    # One session for every route, so connections to the backend API are reused
+    # instead of opening a new one per call
+    retry = Retry(
+        total=API_RETRIES,
+        backoff_factor=0.1,
+        status_forcelist=(502, 503, 504),
+        # Failed connections are retried for any method; lost replies and bad
+        # statuses only for requests that are safe to send twice
+        allowed_methods=frozenset(['GET', 'PUT']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+api_session = create_api_session()
+
+def call_api(method, path, **kwargs):
+    kwargs.setdefault('timeout', API_TIMEOUT)
+    return api_session.request(method, f'{API_BASE_URL}{path}', **kwargs)
+
+class ResponseCache:
+    # LRU cache of decoded backend API responses, plus the page rendered from
+    # each. Entries checked within the last `ttl` seconds are used as they are;
+    # older ones are revalidated with If-None-Match, which the API answers with
+    # an empty 304 while nothing has changed.
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, etag, data):
+        entry = {'etag': etag, 'data': data, 'html': None, 'cards': None, 'checked': time.monotonic()}
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def is_fresh(self, entry):
+        return time.monotonic() - entry['checked'] < self.ttl
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+response_cache = ResponseCache(CACHE_SIZE, CACHE_TTL)
+
+class CardCache:
+    # LRU cache of the HTML card rendered for each record, keyed by record ID and
+    # stamped with the field values it was rendered from, so an entry is only
+    # reused for the same version of the record. Any change throws whole pages out
+    # of the response cache; the cards of the records left untouched survive it.
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # Record ID -> (version, html)
+        self._lock = threading.Lock()
+
+    def render(self, records):
+        # Markup of the cards for records, rendering only those not cached
+        template = app.jinja_env.get_template('record_card.html')
+        cards = []
+        with self._lock:
+            for record in records:
+                version = (record['first_name'], record['last_name'], record['date_of_birth'])
+                entry = self._entries.get(record['id'])
+                if entry is None or entry[0] != version:
+                    entry = self._entries[record['id']] = (version, template.render(record=record))
+                self._entries.move_to_end(record['id'])
+                cards.append(entry[1])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return Markup(''.join(cards))
+
+    def discard(self, record_id):
+        with self._lock:
+            self._entries.pop(record_id, None)
+
+card_cache = CardCache(CARD_CACHE_SIZE)
+
+def get_cached(path, params):
+    # Cache entry holding the decoded JSON of a GET to the backend API
+    key = (path, tuple(sorted(params.items())))
+    entry = response_cache.get(key)
+    if entry is not None and response_cache.is_fresh(entry):
+        return entry
+
+    headers = {'If-None-Match': entry['etag']} if entry is not None and entry['etag'] else {}
+    response = call_api('GET', path, params=params, headers=headers)
+    if response.status_code == 304 and entry is not None:
+        entry['checked'] = time.monotonic()
+        return entry
+    response.raise_for_status()
+    return response_cache.put(key, response.headers.get('ETag'), response.json())
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def get_cards(cursor):
+    # Cache entry for one page of records, with its cards rendered
+    entry = get_cached('/records', {'cursor': cursor, 'limit': PAGE_SIZE})
+    if entry['cards'] is None:
+        entry['cards'] = card_cache.render(entry['data'].get('records', []))
+    return entry
+
 @app.route('/records')
 def view_records():
+    cursor = request.args.get('cursor', type=int, default=0)
     try:
-        response = requests.get(f'{API_BASE_URL}/records')
-        response.raise_for_status()
-        records = response.json().get('records', [])
+        entry = get_cards(cursor)
     except requests.exceptions.RequestException as e:
         flash(f"An error occurred: {e}", "danger")
-        records = []
-    return render_template('records.html', records=records)
+        return render_template('records.html', cards='', cursor=cursor, next_cursor=None)
+
+    next_cursor = entry['data'].get('next_cursor')
+    if session.get('_flashes'):
+        # Pending messages are part of the page, so it must not come from or go to the cache
+        return render_template('records.html', cards=entry['cards'], cursor=cursor, next_cursor=next_cursor)
+    if entry['html'] is None:
+        entry['html'] = render_template('records.html', cards=entry['cards'], cursor=cursor, next_cursor=next_cursor)
+    return entry['html']
+
+@app.route('/records/fragment')
+def records_fragment():
+    # The cards of the page after `cursor`, for records.html to append as the list is scrolled
+    cursor = request.args.get('cursor', type=int, default=0)
+    try:
+        entry = get_cards(cursor)
+    except requests.exceptions.RequestException as e:
+        return jsonify({"success": False, "message": f"An error occurred: {e}"}), 500
+    return jsonify({"success": True, "html": str(entry['cards']), "next_cursor": entry['data'].get('next_cursor')})
 
 @app.route('/create', methods=['GET','POST'])
 def create():
@@ -30,7 +176,8 @@ def create():
             'date_of_birth': request.form['dob']
         }
         try:
-            response = requests.post(f'{API_BASE_URL}/create', json=form_data)
+            response = call_api('POST', '/create', json=form_data)
+            response_cache.clear()  # Show our own change straight away rather than after CACHE_TTL
             response.raise_for_status()
             data = response.json()
             if data['success']:
@@ -52,7 +199,9 @@ def delete():
         return jsonify({"success": False, "message": "Record ID is required"}), 400
 
     try:
-        response = requests.delete(f'{API_BASE_URL}/delete', json={'record_id': record_id}) 
+        response = call_api('DELETE', '/delete', json={'record_id': record_id}) 
+        response_cache.clear()
+        card_cache.discard(record_id)
         response.raise_for_status()
         return jsonify(response.json())  # Return JSON response to frontend
     except requests.exceptions.RequestException as e:
@@ -69,7 +218,9 @@ def update_record_route():
     }
 
     try:
-        response = requests.put(f'{API_BASE_URL}/update_record', json=form_data)
+        response = call_api('PUT', '/update_record', json=form_data)
+        response_cache.clear()
+        card_cache.discard(request.form.get('record_id', type=int))
         response.raise_for_status()
         data = response.json()
 
@@ -89,7 +240,7 @@ def update_record_route():
 
         flash(f"An error occurred: {e}", "danger")
 
-    return render_template('records.html')
+    return redirect(url_for('view_records'))
 
 
 if __name__ == '__main__':
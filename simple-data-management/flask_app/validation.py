@@ -1,15 +1,36 @@
-from datetime import datetime
+import re
+from datetime import date, datetime
+from functools import lru_cache
 
-def validate_dateOfBirth(date_of_birth):
+# Zero-padded YYYY-MM-DD, the format the forms send; anything else falls back to strptime
+DATE_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})', re.ASCII)
+
+@lru_cache(maxsize=32768)
+def _parse_date(date_of_birth):
+    # The date, or None if it is not a valid YYYY-MM-DD date. Cached because
+    # bulk imports see the same birthdays over and over.
+    match = DATE_PATTERN.fullmatch(date_of_birth)
     try:
-        parsed_date = datetime.strptime(date_of_birth, "%Y-%m-%d")
-        if parsed_date > datetime.now():  # Date cannot be in the future
-            return False, "Date of birth cannot be in the future."
-        return True, None
+        if match:
+            return date(int(match[1]), int(match[2]), int(match[3]))
+        return datetime.strptime(date_of_birth, "%Y-%m-%d").date()
     except ValueError:
+        return None
+
+def _check_date(date_of_birth, today):
+    parsed_date = _parse_date(date_of_birth)
+    if parsed_date is None:
         return False, "Invalid date format or incorrect date. Please use YYYY-MM-DD."
+    if parsed_date > today:  # Date cannot be in the future
+        return False, "Date of birth cannot be in the future."
+    return True, None
+
+def validate_dateOfBirth(date_of_birth):
+    return _check_date(date_of_birth, date.today())
 
 def validate_name(name: str) -> tuple[bool, str | None]:
+    if 2 <= len(name) <= 50 and name.isalpha():  # Common case: valid in one pass
+        return True, None
     if not name.strip():
         return False, "Input cannot be empty. Please try again."
     if len(name) < 2 or len(name) > 50:
@@ -18,4 +39,29 @@ def validate_name(name: str) -> tuple[bool, str | None]:
         return False, "Name must not contain spaces."
     if not name.isalpha():
         return False, "Name must contain only alphabetical characters."
-    return True, None  # Valid name
\ No newline at end of file
+    return True, None  # Valid name
+
+def _record_errors(first_name, last_name, date_of_birth, today):
+    error_messages = []
+    valid_first, error_first = validate_name(first_name)
+    if not valid_first:
+        error_messages.append(f"First Name: {error_first}")
+
+    valid_last, error_last = validate_name(last_name)
+    if not valid_last:
+        error_messages.append(f"Last Name: {error_last}")
+
+    valid_dob, error_dob = _check_date(date_of_birth, today)
+    if not valid_dob:
+        error_messages.append(f"Date of Birth: {error_dob}")
+    return error_messages
+
+def validate_record(first_name, last_name, date_of_birth):
+    # Every problem with one record's fields, labelled by field; empty when valid
+    return _record_errors(first_name, last_name, date_of_birth, date.today())
+
+def validate_batch(rows):
+    # validate_record for many {"first_name", "last_name", "date_of_birth"} rows
+    # at once, returning one list of messages per row
+    today = date.today()
+    return [_record_errors(row["first_name"], row["last_name"], row["date_of_birth"], today) for row in rows]
@@ -1,118 +1,613 @@
-from flask import Flask, jsonify, request
+import gzip
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from itertools import chain
+from flask import Flask, Response, g, jsonify, request
 from api.create import create_record
-from api.retrieve import read_records
+from api.retrieve import (get_all_records, get_changes, get_data_version, get_record, get_records_page, get_stats,
+                          iter_records, search_records)
+from api.records import RecordTable
+from api.search_index import exact, prefix
 from api.update import update_record
 from api.delete import delete_record
-from flask_app.validation import validate_name, validate_dateOfBirth
+from api.batch import apply_batch
+from api.bulk import export_csv, export_ndjson, gzip_chunks, import_records, parse_csv, parse_ndjson
+from api.compact import COMPACT_INTERVAL, start_background_compaction
+from api.log import LOG_SAMPLE_RATE, SamplingFilter, configure_logging
+from api import metrics
+from flask_app.validation import validate_batch, validate_record
+from server.encoding import (COMPRESSIBLE, MIN_COMPRESS_BYTES, MSGPACK, compress, compress_chunks, content_encoding,
+                             encode_msgpack, response_type, to_columns)
+
+configure_logging()
+logger = logging.getLogger(__name__)
+# One summary line per request, thinned out by SDM_LOG_SAMPLE_RATE
+request_logger = logging.getLogger(__name__ + '.requests')
+request_logger.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
 
 app = Flask(__name__)
 app.secret_key = 'top_secret0'
 
+if COMPACT_INTERVAL > 0:
+    start_background_compaction()
+
+# Largest page a client may ask for with ?limit=
+MAX_PAGE_SIZE = 1000
+# Records joined into each chunk of a streamed response
+STREAM_BATCH_SIZE = 500
+# Changes per /api/changes reply, and per batch of a change stream
+CHANGES_PAGE_SIZE = 1000
+# Longest a client may hold /api/changes open waiting for a change, in seconds
+MAX_CHANGES_WAIT = 60
+# Seconds between keep-alive comments on an idle change stream
+SSE_KEEPALIVE = 15
+# Upload formats /api/import recognises by Content-Type
+IMPORT_FORMATS = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson', 'application/ndjson': 'ndjson',
+                  'application/jsonl': 'ndjson'}
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def log_request(response):
+    level = logging.WARNING if response.status_code >= 500 else logging.INFO
+    if request_logger.isEnabledFor(level):
+        fields = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - g.started) * 1000, 2),
+            'bytes': response.content_length,  # None for streamed responses
+        }
+        if 'record_count' in g:
+            fields['records'] = g.record_count
+        request_logger.log(level, "request", extra={'fields': fields})
+    return response
+
+if metrics.ENABLED:
+    @app.after_request
+    def observe_request(response):
+        # Label by route pattern rather than path, so IDs don't make new series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.request_seconds.observe(time.perf_counter() - g.started, method=request.method, route=route,
+                                        status=response.status_code)
+        if response.content_length:
+            metrics.response_bytes.inc(response.content_length, route=route)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_route():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.after_request
+def compress_response(response):
+    # Registered last so it runs first: the log and metrics count the bytes sent
+    if response.status_code != 304 and (response.mimetype not in COMPRESSIBLE or response.direct_passthrough):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = content_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    # Weak whenever the body may be compressed, small bodies and 304s included,
+    # so a 304 always carries the ETag its 200 was sent with
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    if request.method == 'HEAD' or response.status_code in (204, 304) or 'Content-Encoding' in response.headers:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < MIN_COMPRESS_BYTES:
+            return response
+        response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def parse_paging(args):
+    try:
+        cursor = int(args.get('cursor', 0))
+        limit = args.get('limit')
+        limit = min(int(limit), MAX_PAGE_SIZE) if limit is not None else None
+    except ValueError:
+        return None, None, "Cursor and limit must be whole numbers."
+    if cursor < 0 or (limit is not None and limit < 1):
+        return None, None, "Cursor must be 0 or more and limit at least 1."
+    return cursor, limit, None
+
+def to_json(records):
+    # The store hands out Records (or a whole RecordTable); they become plain
+    # dicts only here, for the response
+    if isinstance(records, RecordTable):
+        return records.to_dicts()
+    return [record.to_dict() for record in records]
+
+def stream_ndjson(records):
+    batch = []
+    for record in records:
+        batch.append(json.dumps(record.to_dict()))
+        if len(batch) >= STREAM_BATCH_SIZE:
+            yield "\n".join(batch) + "\n"
+            batch = []
+    if batch:
+        yield "\n".join(batch) + "\n"
+
+def stream_json_array(records):
+    yield '{"success": true, "records": ['
+    separator = ""
+    batch = []
+    for record in records:
+        batch.append(json.dumps(record.to_dict()))
+        if len(batch) >= STREAM_BATCH_SIZE:
+            yield separator + ", ".join(batch)
+            separator = ", "
+            batch = []
+    if batch:
+        yield separator + ", ".join(batch)
+    yield "]}"
+
+def not_modified(version, last_modified):
+    # Whether the client's cached copy is still current. If-None-Match wins
+    # over If-Modified-Since when both are sent.
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(version)
+    if request.if_modified_since:
+        return datetime.fromtimestamp(int(last_modified), timezone.utc) <= request.if_modified_since
+    return False
+
+def with_validators(response, version, last_modified):
+    response.set_etag(version)
+    # Last-Modified only has whole seconds, so while that second lasts another
+    # change could slip in unnoticed by If-Modified-Since; leave it to the ETag
+    if int(last_modified) < int(time.time()):
+        response.last_modified = datetime.fromtimestamp(int(last_modified), timezone.utc)
+    response.cache_control.no_cache = True  # Cache, but check back every time
+    return response
+
+def parse_search(args):
+    # Turn /api/records/search query parameters into {field: (low, high)} ranges
+    criteria = {}
+    for field in ('first_name', 'last_name'):
+        if args.get(field):
+            criteria[field] = exact(args[field].strip())
+        elif args.get(f'{field}_prefix'):
+            criteria[field] = prefix(args[f'{field}_prefix'].strip())
+
+    born_from = args.get('born_from') or None
+    born_to = args.get('born_to') or None
+    if args.get('date_of_birth'):
+        born_from = born_to = args['date_of_birth']
+    for value in (born_from, born_to):
+        if value is not None:
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                return None, "Dates must be in the format YYYY-MM-DD."
+    if born_from is not None or born_to is not None:
+        criteria['date_of_birth'] = (born_from, born_to)
+
+    if not criteria:
+        return None, "Give at least one of first_name, last_name, first_name_prefix, last_name_prefix, date_of_birth, born_from or born_to."
+    return criteria, None
+
+def parse_batch_operation(item):
+    # Turn one item of a /api/batch request into an operation for apply_batch,
+    # or return the reasons it was rejected. Name and date fields are checked
+    # afterwards, for the whole batch at once.
+    if not isinstance(item, dict):
+        return None, ["Each operation must be a JSON object."]
+
+    op = item.get('op')
+    if op not in ('create', 'update', 'delete'):
+        return None, ["Operation must be 'create', 'update' or 'delete'."]
+    operation = {'op': op}
+
+    if op in ('update', 'delete'):
+        try:
+            operation['record_id'] = int(item.get('record_id'))
+        except (TypeError, ValueError):
+            return None, ["Record ID is required"]
+
+    if op in ('create', 'update'):
+        # Like /api/create, take only text: str() would turn null into "None"
+        fields = (('first_name', "First Name"), ('last_name', "Last Name"), ('date_of_birth', "Date of Birth"))
+        error_messages = [f"{label}: Must be a string." for field, label in fields if not isinstance(item.get(field, ''), str)]
+        if error_messages:
+            return None, error_messages
+        for field, _ in fields:
+            operation[field] = item.get(field, '').strip()
+
+    return operation, None
+
+def parse_layout(args):
+    # 'records' (default) for an object per record, 'columns' for an array per field
+    layout = args.get('layout', 'records')
+    if layout not in ('records', 'columns'):
+        return None, "Layout must be 'records' or 'columns'."
+    return layout, None
+
+def listing(records, layout):
+    # The records of a listing response, laid out as asked
+    if layout == 'columns':
+        return {'columns': to_columns(records)}
+    return {'records': to_json(records)}
+
+def record_count(payload):
+    if 'columns' in payload:
+        return len(payload['columns']['id'])
+    return len(payload.get('records', ()))
+
+def encoded(payload, mimetype):
+    # Response for a listing payload in the negotiated format
+    if mimetype == MSGPACK:
+        response = Response(encode_msgpack(payload), mimetype=MSGPACK)
+    else:
+        response = jsonify(payload)
+    response.vary.add('Accept')
+    return response
+
+def list_records(cursor, limit, layout='records'):
+    # Body of a non-streamed GET /api/records, also served by server/asgi.py: (payload, status)
+    if cursor or limit is not None:
+        records, next_cursor, error = get_records_page(cursor, limit)
+        if error:
+            return {'success': False, 'message': error}, 500
+        return {'success': True, **listing(records, layout), 'next_cursor': next_cursor}, 200
+
+    records, error = get_all_records()
+    if error:
+        return {'success': False, 'message': error}, 500
+    return {'success': True, **listing(records, layout)}, 200
+
 @app.route('/api/records', methods=['GET'])
 def get_records():
     try:
-        records, error = read_records()
+        cursor, limit, error = parse_paging(request.args)
+        if error:
+            return jsonify({'success': False, 'message': error}), 400
+        layout, error = parse_layout(request.args)
+        if error:
+            return jsonify({'success': False, 'message': error}), 400
+        mimetype = response_type(request.headers.get('Accept'))
+        if mimetype is None:
+            return jsonify({'success': False, 'message': "Records are available as JSON or MessagePack."}), 406
+
+        # Taken before the records, so a change in between can only make the ETag too old, never too new
+        version, last_modified, error = get_data_version()
         if error:
             return jsonify({'success': False, 'message': error}), 500
+        if not_modified(version, last_modified):
+            return with_validators(Response(status=304), version, last_modified)
+
+        stream = request.args.get('stream')
+        if stream:
+            if stream not in ('ndjson', 'json'):
+                return jsonify({'success': False, 'message': "Stream must be 'ndjson' or 'json'."}), 400
 
-        print("Records from API:", records)
-        return jsonify({'success': True, 'records': records}), 200
+            records = iter_records(cursor, limit)
+            first = next(records, None)  # Surface storage errors before the response starts
+            records = chain([first], records) if first is not None else iter(())
+            if stream == 'ndjson':
+                return with_validators(Response(stream_ndjson(records), mimetype='application/x-ndjson'), version, last_modified)
+            return with_validators(Response(stream_json_array(records), mimetype='application/json'), version, last_modified)
+
+        payload, status = list_records(cursor, limit, layout)
+        if status != 200:
+            return jsonify(payload), status
+        g.record_count = record_count(payload)
+        return with_validators(encoded(payload, mimetype), version, last_modified), 200
     except Exception as e:
+        logger.exception("Listing records failed")
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/create', methods=['POST'])
-def create_record_route():
+@app.route('/api/records/search', methods=['GET'])
+def search_records_route():
+    cursor, limit, error = parse_paging(request.args)
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+    criteria, error = parse_search(request.args)
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+    layout, error = parse_layout(request.args)
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+    mimetype = response_type(request.headers.get('Accept'))
+    if mimetype is None:
+        return jsonify({'success': False, 'message': "Records are available as JSON or MessagePack."}), 406
+
+    version, last_modified, error = get_data_version()
+    if error:
+        return jsonify({'success': False, 'message': error}), 500
+    if not_modified(version, last_modified):
+        return with_validators(Response(status=304), version, last_modified)
+
+    records, next_cursor, error = search_records(criteria, cursor, limit)
+    if error:
+        return jsonify({'success': False, 'message': error}), 500
+    g.record_count = len(records)
+    payload = {'success': True, **listing(records, layout), 'next_cursor': next_cursor}
+    return with_validators(encoded(payload, mimetype), version, last_modified), 200
+
+@app.route('/api/records/<int:record_id>', methods=['GET'])
+def get_record_route(record_id):
+    record, error = get_record(record_id)
+    if error:
+        return jsonify({'success': False, 'message': error}), 404
+    return jsonify({'success': True, 'record': record.to_dict()}), 200
+
+def change_to_json(change):
+    version, op, record = change
+    return {'version': version, 'op': op, 'record': record.to_dict()}
+
+def change_events(changes, version, reset):
+    # Server-Sent Events for one get_changes() result: a 'change' event per
+    # change, with its version as the event ID, and 'reset' when the client has
+    # to reload every record. Empty when nothing changed.
+    events = []
+    if reset:
+        events.append(f"event: reset\nid: {version}\ndata: {json.dumps({'version': version})}\n\n")
+    for change in changes:
+        events.append(f"event: change\nid: {change[0]}\ndata: {json.dumps(change_to_json(change))}\n\n")
+    return ''.join(events)
+
+def error_event(error):
+    return f"event: error\ndata: {json.dumps({'message': error})}\n\n"
+
+KEEP_ALIVE = ": keep-alive\n\n"
+
+def stream_changes(since):
+    while True:
+        changes, version, reset, error = get_changes(since, CHANGES_PAGE_SIZE, SSE_KEEPALIVE)
+        if error:
+            yield error_event(error)
+            return
+        yield change_events(changes, version, reset) or KEEP_ALIVE
+        since = version
+
+@app.route('/api/stats', methods=['GET'])
+def stats_route():
+    # The same validators as /api/records, taken before the counts like there
+    version, last_modified, error = get_data_version()
+    if error:
+        return jsonify({'success': False, 'message': error}), 500
+    if not_modified(version, last_modified):
+        return with_validators(Response(status=304), version, last_modified)
+
+    stats, error = get_stats()
+    if error:
+        return jsonify({'success': False, 'message': error}), 500
+    return with_validators(jsonify({'success': True, **stats}), version, last_modified), 200
+
+@app.route('/api/changes', methods=['GET'])
+def changes_route():
+    # What changed since a version: the ETag of GET /api/records (unless
+    # SDM_READ_MODE=mapped, where that comes from the file instead), or the
+    # version from the last call. Without ?since= only the current version is returned.
+    # ?wait= long-polls; Accept: text/event-stream (or ?stream=sse) streams.
+    since, limit, wait, stream, error = parse_changes(request.args, request.headers.get('Last-Event-ID'),
+                                                      request.accept_mimetypes)
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+
+    if stream:
+        if since is None:
+            _, since, _, error = get_changes()
+            if error:
+                return jsonify({'success': False, 'message': error}), 500
+        response = Response(stream_changes(since), mimetype='text/event-stream')
+        response.headers.update(SSE_HEADERS)
+        return response
+
+    changes, version, reset, error = get_changes(since, limit, wait)
+    if error:
+        return jsonify({'success': False, 'message': error}), 500
+    g.record_count = len(changes)
+    return jsonify(changes_reply(changes, version, reset, limit)), 200
+
+# Pieces of /api/changes shared with the ASGI server (server/asgi.py), which
+# waits for changes on its event loop instead of in a thread
+
+def parse_changes(args, last_event_id, accept):
+    # (since, limit, wait, stream, error) from the query arguments, the
+    # Last-Event-ID header and the parsed Accept header
+    since = args.get('since') or last_event_id
+    try:
+        limit = min(int(args.get('limit', CHANGES_PAGE_SIZE)), CHANGES_PAGE_SIZE)
+        wait = min(float(args.get('wait', 0)), MAX_CHANGES_WAIT)
+    except ValueError:
+        return None, None, None, None, "Limit and wait must be numbers."
+    if limit < 1 or not 0 <= wait:
+        return None, None, None, None, "Limit must be at least 1 and wait 0 or more."
+    stream = args.get('stream') == 'sse' or accept.best == 'text/event-stream'
+    return since, limit, wait, stream, None
+
+def changes_reply(changes, version, reset, limit):
+    return {'success': True, 'version': version, 'reset': reset, 'more': len(changes) == limit,
+            'changes': [change_to_json(change) for change in changes]}
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',  # Keep proxies from holding events back
+}
+
+# Bodies of the create, delete and update routes, shared with the ASGI server
+# (server/asgi.py): each takes the decoded JSON body and returns (payload, status)
+
+def create_from_json(data):
     try:
-        data = request.get_json()
         first_name = data.get('first_name', '').strip()
         last_name = data.get('last_name', '').strip()
         date_of_birth = data.get('date_of_birth', '').strip()
 
         # Validate input
-        error_messages = []
-        valid_first, error_first = validate_name(first_name)
-        if not valid_first:
-            error_messages.append(f"First Name: {error_first}")
-        
-        valid_last, error_last = validate_name(last_name)
-        if not valid_last:
-            error_messages.append(f"Last Name: {error_last}")
-
-        valid_dob, error_dob = validate_dateOfBirth(date_of_birth)
-        if not valid_dob:
-            error_messages.append(f"Date of Birth: {error_dob}")
+        error_messages = validate_record(first_name, last_name, date_of_birth)
 
         if error_messages:
-            return jsonify({"success": False, "errors": error_messages}), 400
+            return {"success": False, "errors": error_messages}, 400
 
         # Create record
-        error = create_record(first_name, last_name, date_of_birth)
-        print(error)
+        record_id, error = create_record(first_name, last_name, date_of_birth)
         if error:
-            return jsonify({"success": False, "message": f"Error: {error}"}), 500
-        return jsonify({"success": True, "message": "Record successfully created!"}), 201
+            logger.error("Creating a record failed: %s", error)
+            return {"success": False, "message": f"Error: {error}"}, 500
+        return {"success": True, "message": "Record successfully created!", "id": record_id}, 201
     except Exception as e:
-        print(e)
-        return jsonify({"success": False, "message": str(e)}), 501
+        logger.exception("Creating a record failed")
+        return {"success": False, "message": str(e)}, 501
 
-@app.route('/api/delete', methods=['DELETE'])
-def delete_record_route():
-    print("Request body:", request.get_json())
-    
-    data = request.get_json()
+def delete_from_json(data):
     record_id = data.get('record_id')
 
     if record_id is None:
-        return jsonify({"success": False, "message": "Record ID is required"}), 400
+        return {"success": False, "message": "Record ID is required"}, 400
 
     error = delete_record(record_id)
     if error:
-        return jsonify({"success": False, "message": f"Error: {error}"}), 500
-    return jsonify({"success": True, "message": "Record successfully deleted!"}), 200
-
+        return {"success": False, "message": f"Error: {error}"}, 500
+    return {"success": True, "message": "Record successfully deleted!"}, 200
 
-@app.route('/api/update_record', methods=['PUT'])
-def api_update_record():
+def update_from_json(data):
     try:
-        data = request.get_json()
-        
         # Ensure record_id is an integer
-        record_id = int(data.get('record_id', 0))  
+        record_id = int(data.get('record_id', 0))
         first_name = data.get('first_name', '').strip()
         last_name = data.get('last_name', '').strip()
         date_of_birth = data.get('date_of_birth', '').strip()
 
         # Validate input
-        error_messages = []
-        valid_first, error_first = validate_name(first_name)
-        if not valid_first:
-            error_messages.append(f"First Name: {error_first}")
-        
-        valid_last, error_last = validate_name(last_name)
-        if not valid_last:
-            error_messages.append(f"Last Name: {error_last}")
-
-        valid_dob, error_dob = validate_dateOfBirth(date_of_birth)
-        if not valid_dob:
-            error_messages.append(f"Date of Birth: {error_dob}")
+        error_messages = validate_record(first_name, last_name, date_of_birth)
 
         if error_messages:
-            return jsonify({"success": False, "errors": error_messages}), 400
+            return {"success": False, "errors": error_messages}, 400
 
         # Update record
-        print("Updating record with ID:", record_id) 
+        logger.debug("Updating record %d", record_id)
         error = update_record(record_id, first_name, last_name, date_of_birth)
 
         if error:
-            print("Update Error:", error) 
+            logger.warning("Updating record %d failed: %s", record_id, error)
+            return {"success": False, "message": f"Error: {error}"}, 500
+
+        return {"success": True, "message": "Record successfully updated!"}, 200
+
+    except Exception as e:
+        logger.exception("Updating a record failed")
+        return {"success": False, "message": f"Unexpected error: {str(e)}"}, 500
+
+@app.route('/api/create', methods=['POST'])
+def create_record_route():
+    payload, status = create_from_json(request.get_json())
+    return jsonify(payload), status
+
+@app.route('/api/delete', methods=['DELETE'])
+def delete_record_route():
+    payload, status = delete_from_json(request.get_json())
+    return jsonify(payload), status
+
+@app.route('/api/update_record', methods=['PUT'])
+def api_update_record():
+    payload, status = update_from_json(request.get_json())
+    return jsonify(payload), status
+
+@app.route('/api/batch', methods=['POST'])
+def batch_route():
+    try:
+        items = request.get_json()
+        if not isinstance(items, list):
+            return jsonify({"success": False, "message": "Request body must be a JSON array of operations."}), 400
+
+        # Validate everything first, then apply the valid operations together
+        results = [None] * len(items)
+        parsed = []
+        for position, item in enumerate(items):
+            operation, error_messages = parse_batch_operation(item)
+            if error_messages:
+                results[position] = {"success": False, "errors": error_messages}
+            else:
+                parsed.append((position, operation))
+
+        writes = [operation for _, operation in parsed if operation['op'] != 'delete']
+        field_errors = iter(validate_batch(writes))
+        positions = []
+        operations = []
+        for position, operation in parsed:
+            error_messages = next(field_errors) if operation['op'] != 'delete' else None
+            if error_messages:
+                results[position] = {"success": False, "errors": error_messages}
+            else:
+                positions.append(position)
+                operations.append(operation)
+
+        outcomes, error = apply_batch(operations)
+        if error:
             return jsonify({"success": False, "message": f"Error: {error}"}), 500
 
-        return jsonify({"success": True, "message": "Record successfully updated!"}), 200
+        for position, (record_id, error) in zip(positions, outcomes):
+            if error:
+                results[position] = {"success": False, "message": f"Error: {error}"}
+            else:
+                results[position] = {"success": True, "id": record_id}
 
+        g.record_count = len(items)
+        return jsonify({"success": all(result["success"] for result in results), "results": results}), 200
     except Exception as e:
-        print("Unexpected Error:", e) 
+        logger.exception("Batch failed")
         return jsonify({"success": False, "message": f"Unexpected error: {str(e)}"}), 500
 
+@app.route('/api/import', methods=['POST'])
+def import_route():
+    # Body is CSV (with a header row) or NDJSON, optionally gzipped, and is read
+    # as it arrives, so chunked uploads of any size work
+    upload_format = request.args.get('format')
+    if upload_format is None:
+        upload_format = IMPORT_FORMATS.get(request.mimetype)
+    if upload_format not in ('csv', 'ndjson'):
+        return jsonify({"success": False, "message": "Send text/csv or application/x-ndjson, or pass ?format=csv|ndjson."}), 400
+
+    stream = request.stream
+    if request.content_encoding == 'gzip':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    rows = parse_csv(stream) if upload_format == 'csv' else parse_ndjson(stream)
+
+    try:
+        imported, rejected, errors, error = import_records(rows, validate_batch)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    g.record_count = imported
+    if error:
+        return jsonify({"success": False, "message": f"Error: {error}", "imported": imported}), 500
+    return jsonify({"success": not rejected, "imported": imported, "rejected": rejected, "errors": errors}), 200
+
+@app.route('/api/export', methods=['GET'])
+def export_route():
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({"success": False, "message": "Format must be 'csv' or 'ndjson'."}), 400
+
+    try:
+        records = iter_records()
+        first = next(records, None)  # Surface storage errors before the response starts
+    except RuntimeError as e:
+        return jsonify({"success": False, "message": str(e)}), 500
+    records = chain([first], records) if first is not None else iter(())
+
+    if export_format == 'csv':
+        chunks, filename, mimetype = export_csv(records), 'students.csv', 'text/csv'
+    else:
+        chunks, filename, mimetype = export_ndjson(records), 'students.ndjson', 'application/x-ndjson'
+    if request.args.get('gzip') in ('1', 'true'):
+        chunks, filename, mimetype = gzip_chunks(chunks), filename + '.gz', 'application/gzip'
+
+    response = Response(chunks, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
 
 if __name__ == '__main__':
     app.run(port=5000, debug=True)
@@ -0,0 +1,507 @@
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, unquote
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import http_date, parse_accept_header, parse_date, parse_etags, quote_etag
+
+from api.retrieve import get_changes, get_data_version
+from api.store import get_store
+from api import metrics
+from server.api import (CHANGES_PAGE_SIZE, KEEP_ALIVE, SSE_HEADERS, SSE_KEEPALIVE, app as flask_app, change_events,
+                        changes_reply, create_from_json, delete_from_json, error_event, list_records, logger,
+                        parse_changes, parse_layout, parse_paging, record_count, request_logger, update_from_json)
+from server.encoding import MIN_COMPRESS_BYTES, MSGPACK, compress, content_encoding, encode_msgpack, response_type
+
+# Threads that run storage calls (and requests handed to the Flask app); every
+# other request waits on the event loop without holding a thread
+ASGI_WORKERS = int(os.environ.get('SDM_ASGI_WORKERS', '32'))
+# Encoded /api/records bodies kept for the current data version
+MAX_SHARED_READS = 64
+# Longest a request handed to the Flask app may hold a thread, in seconds. A
+# streamed response still going after this is cut off.
+BRIDGE_TIMEOUT = float(os.environ.get('SDM_ASGI_REQUEST_TIMEOUT', '300'))
+
+executor = ThreadPoolExecutor(max_workers=ASGI_WORKERS, thread_name_prefix='asgi-storage')
+
+def encode_json(payload):
+    # Byte for byte what Flask's jsonify sends
+    return json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8') + b'\n'
+
+class SharedReads:
+    # Requests for the same page of the same data version share a single read
+    # and a single encoded body, whether they arrive together or one after the
+    # other. Any change to the data moves the version on and empties the table.
+
+    def __init__(self, limit=MAX_SHARED_READS):
+        self.limit = limit
+        self._version = None
+        self._reads = {}  # (cursor, limit, layout, type, encoding) -> Future of (status, body, record count)
+
+    async def get(self, version, key, read):
+        if version != self._version:
+            self._version = version
+            self._reads.clear()
+        future = self._reads.get(key)
+        if future is None:
+            if len(self._reads) >= self.limit:
+                self._reads.pop(next(iter(self._reads)))
+            future = self._reads[key] = asyncio.ensure_future(read())
+            future.add_done_callback(lambda done: self._forget_failed(version, key, done))
+        # One client going away must not cancel the read the others are waiting for
+        return await asyncio.shield(future)
+
+    def _forget_failed(self, version, key, future):
+        if version == self._version and self._reads.get(key) is future:
+            if future.cancelled() or future.exception() is not None or future.result()[0] != 200:
+                del self._reads[key]
+
+shared_reads = SharedReads()
+
+async def run_blocking(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+def not_modified(scope, version, last_modified):
+    # Same rules as server.api.not_modified
+    if_none_match = header(scope, b'if-none-match')
+    if if_none_match:
+        return parse_etags(if_none_match).contains_weak(version)
+    if_modified_since = parse_date(header(scope, b'if-modified-since'))
+    if if_modified_since:
+        return int(last_modified) <= if_modified_since.timestamp()
+    return False
+
+def validators(version, last_modified, weak=False):
+    headers = [(b'etag', quote_etag(version, weak).encode()), (b'cache-control', b'no-cache')]
+    if int(last_modified) < int(time.time()):
+        headers.append((b'last-modified', http_date(int(last_modified)).encode()))
+    return headers
+
+async def get_records(scope, query):
+    # (status, body, headers, record count), in the format and encoding the
+    # client negotiated, as server.api.get_records would answer
+    cursor, limit, error = parse_paging(query)
+    if not error:
+        layout, error = parse_layout(query)
+    if error:
+        return 400, encode_json({'success': False, 'message': error}), JSON_HEADERS, None
+    mimetype = response_type(header(scope, b'accept'))
+    if mimetype is None:
+        return 406, encode_json({'success': False, 'message': "Records are available as JSON or MessagePack."}), JSON_HEADERS, None
+    encoding = content_encoding(header(scope, b'accept-encoding'))
+
+    version, last_modified, error = await run_blocking(get_data_version)
+    if error:
+        return 500, encode_json({'success': False, 'message': error}), JSON_HEADERS, None
+    # Weak whenever the client accepts compression, as server.api.compress_response does
+    weak = encoding is not None
+    if not_modified(scope, version, last_modified):
+        return 304, b'', validators(version, last_modified, weak), None
+
+    async def read():
+        payload, status = await run_blocking(list_records, cursor, limit, layout)
+        if status != 200:
+            return status, encode_json(payload), None, None
+        # Encoding and compressing a large list take a while too, so keep them off the event loop
+        body = await run_blocking(encode_msgpack if mimetype == MSGPACK else encode_json, payload)
+        used = None
+        if encoding is not None and len(body) >= MIN_COMPRESS_BYTES:
+            body, used = await run_blocking(compress, body, encoding), encoding
+        return status, body, used, record_count(payload)
+
+    status, body, used, count = await shared_reads.get(version, (cursor, limit, layout, mimetype, encoding), read)
+    if status != 200:
+        return status, body, JSON_HEADERS, None
+    headers = [(b'content-type', mimetype.encode()), (b'vary', b'Accept, Accept-Encoding')]
+    if used is not None:
+        headers.append((b'content-encoding', used.encode()))
+    return status, body, headers + validators(version, last_modified, weak), count
+
+class ChangeWatch:
+    # Clients of /api/changes waiting on the event loop all share one executor
+    # thread, which waits on the record store a second at a time (so changes by
+    # other processes are noticed too) and wakes them when the version moves on.
+
+    def __init__(self):
+        self._loop = None
+
+    def _start(self, loop):
+        self._loop = loop
+        self._version = None  # Latest version the thread has seen
+        self._changed = asyncio.Event()  # Set, and replaced, when that changes
+        self._waiters = 0
+        self._task = None
+
+    async def wait(self, version, timeout, gone):
+        # True once the store is past `version`, False after timeout seconds or
+        # when the future `gone` finishes first
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._start(loop)
+        if self._version is not None and self._version != version:
+            return True  # Changed before we got here (or the thread is catching up)
+        changed = asyncio.ensure_future(self._changed.wait())
+        self._waiters += 1
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._watch())
+        try:
+            done, _ = await asyncio.wait([changed, gone], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            return changed in done
+        finally:
+            changed.cancel()
+            self._waiters -= 1
+
+    async def _watch(self):
+        while self._waiters:
+            _, version, _, error = await run_blocking(self._next_version, self._version)
+            if error:
+                logger.error("Watching for changes failed: %s", error)
+                await asyncio.sleep(1)
+            elif version != self._version:
+                self._version = version
+                self._changed.set()
+                self._changed = asyncio.Event()
+        self._version = None  # Could be stale by the time a thread is needed again
+
+    @staticmethod
+    def _next_version(version):
+        if version is not None:
+            get_store().wait_for_change(version, 1.0)
+        return get_changes()
+
+change_watch = ChangeWatch()
+
+async def disconnected(receive):
+    # Finishes when the client goes away. Only for requests without a body.
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def changes_route(scope, query, receive, send, started):
+    # GET /api/changes as server.api.changes_route answers it, but waiting for
+    # changes on the event loop, so long-polls and event streams hold no thread
+    since, limit, wait, stream, error = parse_changes(query, header(scope, b'last-event-id'),
+                                                      parse_accept_header(header(scope, b'accept'), MIMEAccept))
+    if error:
+        return await send_json(send, 400, {'success': False, 'message': error}, scope, started)
+    gone = asyncio.ensure_future(disconnected(receive))
+    try:
+        if stream:
+            return await stream_changes(scope, send, since, gone, started)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while True:
+            changes, version, reset, error = await run_blocking(get_changes, since, limit)
+            remaining = deadline - loop.time()
+            if error or changes or reset or since is None or remaining <= 0:
+                break
+            await change_watch.wait(version, remaining, gone)
+            if gone.done():
+                return
+        if error:
+            return await send_json(send, 500, {'success': False, 'message': error}, scope, started)
+        await send_json(send, 200, changes_reply(changes, version, reset, limit), scope, started, len(changes))
+    finally:
+        gone.cancel()
+
+async def stream_changes(scope, send, since, gone, started):
+    # Server-Sent Events, as server.api.stream_changes sends them, until the
+    # client disconnects
+    if since is None:
+        _, since, _, error = await run_blocking(get_changes)
+        if error:
+            return await send_json(send, 500, {'success': False, 'message': error}, scope, started)
+    headers = [(b'content-type', b'text/event-stream; charset=utf-8')]
+    headers += [(name.lower().encode(), value.encode()) for name, value in SSE_HEADERS.items()]
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+    size = 0
+    while not gone.done():
+        changes, version, reset, error = await run_blocking(get_changes, since, CHANGES_PAGE_SIZE)
+        if error:
+            event = error_event(error)
+        else:
+            event = change_events(changes, version, reset)
+            if not event and not await change_watch.wait(version, SSE_KEEPALIVE, gone):
+                event = KEEP_ALIVE
+            since = version
+        if gone.done():
+            break
+        if event:
+            body = event.encode()
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+            size += len(body)
+        if error:
+            await send({'type': 'http.response.body', 'body': b''})
+            break
+    observe(scope['method'], scope['path'], 200, size, started, None)
+
+async def send_json(send, status, payload, scope, started, count=None):
+    body = encode_json(payload)
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': JSON_HEADERS + [(b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+    observe(scope['method'], scope['path'], status, len(body), started, count)
+
+JSON_HEADERS = [(b'content-type', b'application/json')]
+
+# Routes answered here without Flask: (method, path) -> handler of the JSON body
+WRITE_ROUTES = {
+    ('POST', '/api/create'): create_from_json,
+    ('DELETE', '/api/delete'): delete_from_json,
+    ('PUT', '/api/update_record'): update_from_json,
+}
+
+async def app(scope, receive, send):
+    # ASGI entry point. GET /api/records, /api/changes and the create, delete
+    # and update routes are answered here, with storage calls on the executor;
+    # everything else (streamed listings, search, batch, import, export,
+    # /metrics) is passed through to the Flask app in server/api.py.
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    started = time.perf_counter()
+    method, path = scope['method'], scope['path']
+    query = dict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+
+    if method == 'GET' and path == '/api/records' and not query.get('stream'):
+        try:
+            status, body, headers, count = await get_records(scope, query)
+        except Exception as e:
+            logger.exception("Listing records failed")
+            status, body, headers, count = 500, encode_json({'success': False, 'message': str(e)}), JSON_HEADERS, None
+    elif method == 'GET' and path == '/api/changes':
+        return await changes_route(scope, query, receive, send, started)
+    elif (method, path) in WRITE_ROUTES:
+        body = await read_body(receive)
+        if body is None:
+            return
+        data = None
+        if (header(scope, b'content-type') or '').split(';')[0].strip() == 'application/json':
+            try:
+                data = json.loads(body)
+            except ValueError:
+                pass
+        if not isinstance(data, dict):
+            # Leave error replies for malformed requests to Flask, so they match exactly
+            return await call_wsgi(scope, receive, send, body)
+        payload, status = await run_blocking(WRITE_ROUTES[method, path], data)
+        body, headers, count = encode_json(payload), JSON_HEADERS, None
+    else:
+        return await call_wsgi(scope, receive, send)
+
+    if status != 304:
+        headers = headers + [(b'content-length', str(len(body)).encode())]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+    observe(method, path, status, len(body), started, count)
+
+def observe(method, path, status, size, started, count):
+    # The request summary and metrics that server.api's after_request hooks record
+    duration = time.perf_counter() - started
+    level = logging.WARNING if status >= 500 else logging.INFO
+    if request_logger.isEnabledFor(level):
+        fields = {'method': method, 'path': path, 'status': status, 'duration_ms': round(duration * 1000, 2), 'bytes': size}
+        if count is not None:
+            fields['records'] = count
+        request_logger.log(level, "request", extra={'fields': fields})
+    if metrics.ENABLED:
+        metrics.request_seconds.observe(duration, method=method, route=path, status=status)
+        if size:
+            metrics.response_bytes.inc(size, route=path)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            error = await run_blocking(get_store().flush)
+            if error:
+                logger.error("Flushing the record store on shutdown failed: %s", error)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+class RequestBody(io.RawIOBase):
+    # wsgi.input for the Flask app: reads the ASGI request body from a worker
+    # thread, a message at a time, as the app asks for it. `complete` is set on
+    # the event loop once all of it has been received.
+
+    def __init__(self, receive, loop, body=None):
+        super().__init__()
+        self._receive = receive
+        self._loop = loop
+        self._buffer = body or b''
+        self._more = body is None
+        self.complete = asyncio.Event()
+        self.disconnected = threading.Event()
+        if body is not None:
+            self.complete.set()
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            self._more = False
+            self.disconnected.set()
+            raise OSError("Client disconnected")
+        self._buffer += message.get('body', b'')
+        self._more = message.get('more_body', False)
+        if not self._more:
+            self._loop.call_soon_threadsafe(self.complete.set)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        while self._more and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while self._more and b'\n' not in self._buffer and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and 0 <= size < end:
+            end = size
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': unquote(scope['path'], 'latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,  # Chunked uploads have no Content-Length
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for key, value in scope['headers']:
+        name = key.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+def has_body(scope):
+    # Only trusted for GET and HEAD: an HTTP/2 upload needn't say how long it is
+    if scope['method'] not in ('GET', 'HEAD'):
+        return True
+    length = header(scope, b'content-length')
+    return bool(length and length.strip() != '0') or header(scope, b'transfer-encoding') is not None
+
+async def watch_disconnect(receive, request_body):
+    # Once the app has the whole request body, the next message can only be the
+    # client going away. ASGI servers drop what is sent after that without an
+    # error, so this is the only way a streamed response learns to stop.
+    await request_body.complete.wait()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            request_body.disconnected.set()
+            return
+
+async def call_wsgi(scope, receive, send, body=None):
+    # Run the Flask app on the executor. Its response goes out chunk by chunk,
+    # so streamed listings and exports stay streamed. The thread is given back
+    # when the client disconnects or BRIDGE_TIMEOUT passes, even mid-stream.
+    loop = asyncio.get_running_loop()
+    if body is None and not has_body(scope):
+        body = b''  # Nothing to wait for, so disconnects are watched from the start
+    request_body = RequestBody(receive, loop, body)
+    environ = wsgi_environ(scope, request_body)
+    deadline = time.monotonic() + BRIDGE_TIMEOUT
+
+    def send_from_thread(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def run():
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start['status'] = int(status.split(' ', 1)[0])
+            response_start['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+        result = flask_app(environ, start_response)
+        try:
+            started = False
+            for chunk in result:
+                if request_body.disconnected.is_set():
+                    return
+                if chunk:
+                    if not started:
+                        send_from_thread({'type': 'http.response.start', **response_start})
+                        started = True
+                    send_from_thread({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                if time.monotonic() > deadline:
+                    # Returning without the last message makes the server drop the connection
+                    logger.warning("Cut off %s %s after %g seconds", scope['method'], scope['path'], BRIDGE_TIMEOUT)
+                    return
+            if not started:
+                send_from_thread({'type': 'http.response.start', **response_start})
+            send_from_thread({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    watcher = asyncio.ensure_future(watch_disconnect(receive, request_body))
+    try:
+        await run_blocking(run)
+    finally:
+        watcher.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the backend API with an ASGI server (uvicorn).")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=5000, help="port to listen on (default: %(default)s)")
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("The ASGI server needs uvicorn: pip install uvicorn")
+    uvicorn.run(app, host=args.host, port=args.port, lifespan='on', log_level='warning')
@@ -0,0 +1,85 @@
+import os
+import zlib
+
+from werkzeug.datastructures import Accept, MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from api.records import RecordTable
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only gzip is offered
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:  # Optional: without it listings are JSON only
+    msgpack = None
+
+# Bodies smaller than this are sent as they are; compressing them saves too little
+MIN_COMPRESS_BYTES = int(os.environ.get('SDM_COMPRESS_MIN_BYTES', '1024'))
+# Fast settings: most of the size reduction for a fraction of the CPU of the maximum
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+# Accept values asking for MessagePack, mapped to the type we answer with
+MSGPACK_TYPES = ('application/x-msgpack', 'application/msgpack', 'application/vnd.msgpack')
+# Content types worth compressing
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'application/x-msgpack', 'text/csv', 'text/plain')
+
+def response_type(accept):
+    # The listing format a client's Accept header asks for: JSON (also when it
+    # doesn't say) or MessagePack, or None if we can't give it either
+    if not accept:
+        return JSON
+    offers = (JSON,) + (MSGPACK_TYPES if msgpack is not None else ())
+    best = parse_accept_header(accept, MIMEAccept).best_match(offers)
+    if best is None:
+        return None
+    return MSGPACK if best in MSGPACK_TYPES else JSON
+
+def encode_msgpack(payload):
+    return msgpack.packb(payload, use_bin_type=True)
+
+def content_encoding(accept_encoding):
+    # 'br', 'gzip' or None, from an Accept-Encoding header
+    if not accept_encoding:
+        return None
+    offers = ('br', 'gzip') if brotli is not None else ('gzip',)
+    return parse_accept_header(accept_encoding, Accept).best_match(offers)
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, wbits=16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+def compress_chunks(chunks, encoding):
+    # Compress a streamed body as it is produced
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        finish = compressor.finish
+        step = compressor.process
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, wbits=16 + zlib.MAX_WBITS)
+        finish = compressor.flush
+        step = compressor.compress
+    for chunk in chunks:
+        data = step(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+def to_columns(records):
+    # The columnar layout of a listing: one array per field instead of an object
+    # per record, so field names aren't repeated on every row
+    if isinstance(records, RecordTable):
+        return records.to_columns()
+    return {
+        'id': [record.id for record in records],
+        'first_name': [record.first_name for record in records],
+        'last_name': [record.last_name for record in records],
+        'date_of_birth': [record.date_of_birth for record in records],
+    }
@@ -0,0 +1,1371 @@
+import unittest
+from unittest.mock import patch
+import csv
+import os
+import time
+import datetime
+import multiprocessing
+import json
+import gzip
+import io
+import glob
+import logging
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import NamedTemporaryFile
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from api import file_operations, store, csv_backend
+from api.file_operations import read_records
+from api.store import RecordStore
+from api.records import Record, RecordTable
+from api.create import create_record
+from api.retrieve import (count_records, get_all_records, get_changes, get_record, get_records_page, get_stats,
+                          iter_records, search_records)
+from api.search_index import exact, prefix
+from api.update import update_record
+from api.delete import delete_record
+from api.compact import compact_if_needed
+from api.batch import apply_batch
+from api import bulk, retrieve, sharded_backend, wal
+from api.mapped import read_mapped_records
+from api.bulk import export_csv, export_ndjson, gzip_chunks, import_records, parse_csv, parse_ndjson
+from api.sqlite_backend import SqliteBackend
+from api.sharded_backend import ShardedBackend
+from api.wal import WriteAheadLog
+from api.migrate import migrate_to_sqlite
+from flask_app import app as frontend
+from flask_app.validation import validate_batch, validate_dateOfBirth, validate_name, validate_record
+from api.log import SamplingFilter, StructuredFormatter
+from api import metrics
+from benchmarks.crud import generate_csv, summarize
+from server import api as server_api, asgi, encoding
+
+class BaseTestCase(unittest.TestCase):
+    def setUp(self):
+        # Create temp file for testing and point the api at it
+        self.temp_file = NamedTemporaryFile(mode='w+', delete=False, newline='', encoding='utf-8')
+        self.file_name = self.temp_file.name
+        writer = csv.writer(self.temp_file)
+        writer.writerow(["ID", "First Name", "Last Name", "Date of Birth"])
+        self.temp_file.flush()
+
+        patcher = patch.object(file_operations, 'CSV_FILE', self.file_name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Write-through store so tests see changes on disk immediately
+        self.store = RecordStore(flush_interval=0)
+        store_patcher = patch.object(store, '_store', self.store)
+        store_patcher.start()
+        self.addCleanup(store_patcher.stop)
+        self.addCleanup(self.store.close)
+
+    def tearDown(self):
+        self.temp_file.close()
+        for path in [self.file_name, self.file_name + '.idx', self.file_name + '.lock'] + glob.glob(self.file_name + '.wal*'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def add_records(self, *rows):
+        with open(self.file_name, mode='a', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerows(rows)
+
+    def read_rows(self):
+        with open(self.file_name, mode='r', newline='', encoding='utf-8') as file:
+            return list(csv.reader(file))
+
+class TestCreateRecord(BaseTestCase):
+
+    def test_create_returns_id(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"])
+
+        record_id, error = create_record("Jane", "Smith", "1985-05-15")
+        self.assertIsNone(error)
+        self.assertEqual(record_id, 2)
+
+        records, error = read_records()
+        self.assertEqual(records[-1], {"id": 2, "first_name": "Jane", "last_name": "Smith", "date_of_birth": "1985-05-15"})
+
+    def test_multiple_creates_append_rows(self):
+        create_record("John", "Doe", "1990-01-01")
+        record_id, _ = create_record("Jane", "Smith", "1985-05-15")
+
+        self.assertEqual(record_id, 2)
+        rows = self.read_rows()
+        self.assertEqual(rows[1:], [["1", "John", "Doe", "1990-01-01"], ["2", "Jane", "Smith", "1985-05-15"]])
+
+    def test_unterminated_last_row(self):
+        with open(self.file_name, mode='a', encoding='utf-8') as file:
+            file.write("1,John,Doe,1990-01-01")  # No trailing newline
+
+        record_id, error = create_record("Jane", "Smith", "1985-05-15")
+        self.assertIsNone(error)
+        self.assertEqual(record_id, 2)
+        self.assertEqual(self.read_rows()[2], ["2", "Jane", "Smith", "1985-05-15"])
+
+class TestRecordIds(BaseTestCase):
+
+    def test_ids_survive_deletes(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"], [3, "Emily", "Brown", "2000-07-20"])
+
+        self.assertIsNone(delete_record(1))
+        self.assertIsNone(delete_record(3))
+        record, error = get_record(2)
+        self.assertEqual(record["first_name"], "Jane")
+
+        # Deleted IDs are never handed out again, even by a fresh process
+        fresh = RecordStore(flush_interval=0)
+        self.addCleanup(fresh.close)
+        record_id, _ = fresh.create("Sam", "Scott", "2004-12-21")
+        self.assertEqual(record_id, 4)
+
+    def test_legacy_file_gets_id_column(self):
+        with open(self.file_name, mode='w', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerows([["First Name", "Last Name", "Date of Birth"], ["John", "Doe", "1990-01-01"], ["Jane", "Smith", "1985-05-15"]])
+
+        record, error = get_record(2)
+        self.assertEqual(record["first_name"], "Jane")
+        self.assertEqual(self.read_rows(), [["ID", "First Name", "Last Name", "Date of Birth"], ["1", "John", "Doe", "1990-01-01"], ["2", "Jane", "Smith", "1985-05-15"]])
+
+    def test_update_overwrites_row_in_place(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"])
+        get_all_records()
+
+        with patch.object(csv_backend, 'write_records') as write_mock:
+            self.assertIsNone(update_record(1, "Joan", "Dee", "1990-01-02"))
+        write_mock.assert_not_called()
+        self.assertEqual(self.read_rows()[1:], [["1", "Joan", "Dee", "1990-01-02"], ["2", "Jane", "Smith", "1985-05-15"]])
+
+        # A longer row no longer fits, so it moves to the end of the file
+        with patch.object(csv_backend, 'write_records') as write_mock:
+            self.assertIsNone(update_record(1, "Johanna", "Doe", "1990-01-01"))
+        write_mock.assert_not_called()
+        self.assertEqual(self.read_rows()[1:], [["#", "Joan", "Dee", "1990-01-02"], ["2", "Jane", "Smith", "1985-05-15"], ["1", "Johanna", "Doe", "1990-01-01"]])
+        records, _ = read_records()
+        self.assertEqual([r["first_name"] for r in records], ["Jane", "Johanna"])
+
+    def test_outside_edit_rebuilds_index(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"])
+        get_all_records()
+        with open(self.file_name, mode='w', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerows([["ID", "First Name", "Last Name", "Date of Birth"], [7, "Jane", "Smith", "1985-05-15"], [1, "John", "Doe", "1990-01-01"]])
+
+        self.assertIsNone(update_record(1, "Joan", "Dee", "1990-01-02"))
+        self.assertEqual(self.read_rows()[1:], [["7", "Jane", "Smith", "1985-05-15"], ["1", "Joan", "Dee", "1990-01-02"]])
+
+class TestTombstones(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_records(*[[i, name, "Doe", "1990-01-01"] for i, name in enumerate(("Amy", "Ben", "Cat", "Dan"), start=1)])
+
+    def test_delete_writes_tombstone(self):
+        get_all_records()
+        with patch.object(csv_backend, 'write_records') as write_mock:
+            self.assertIsNone(delete_record(2))
+        write_mock.assert_not_called()
+
+        self.assertEqual(self.read_rows()[2], ["#", "Ben", "Doe", "1990-01-01"])
+        records, _ = read_records()
+        self.assertEqual([r["first_name"] for r in records], ["Amy", "Cat", "Dan"])
+
+    def test_compaction_after_threshold(self):
+        delete_record(1)
+        self.assertEqual(compact_if_needed(0.5), (False, None))
+        self.assertEqual(len(self.read_rows()), 5)
+
+        delete_record(3)
+        self.assertEqual(compact_if_needed(0.5), (True, None))
+        self.assertEqual(self.read_rows()[1:], [["2", "Ben", "Doe", "1990-01-01"], ["4", "Dan", "Doe", "1990-01-01"]])
+        self.assertEqual(self.store.tombstone_ratio(), (0.0, None))
+
+    def test_duplicate_row_keeps_latest(self):
+        self.add_records([2, "Benjamin", "Doe", "1990-01-01"])  # As left by a crash while moving a row
+
+        record, _ = get_record(2)
+        self.assertEqual(record["first_name"], "Benjamin")
+        self.assertEqual(len(get_all_records()[0]), 4)
+        self.assertEqual(self.store.tombstone_ratio(), (0.2, None))
+
+class TestBatch(BaseTestCase):
+
+    def test_batch_reports_each_operation(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"])
+
+        results, error = apply_batch([
+            {"op": "create", "first_name": "Emily", "last_name": "Brown", "date_of_birth": "2000-07-20"},
+            {"op": "update", "record_id": 1, "first_name": "Joan", "last_name": "Dee", "date_of_birth": "1990-01-02"},
+            {"op": "delete", "record_id": 2},
+            {"op": "delete", "record_id": 7},
+        ])
+        self.assertIsNone(error)
+        self.assertEqual(results, [(3, None), (1, None), (2, None), (7, "Invalid record ID. Please enter a valid ID.")])
+
+        records, _ = read_records()
+        self.assertEqual([r["first_name"] for r in records], ["Joan", "Emily"])
+
+    def test_creates_are_written_together(self):
+        get_all_records()
+        operations = [{"op": "create", "first_name": "Student", "last_name": "Doe", "date_of_birth": "2000-01-01"}] * 100
+
+        with patch.object(csv_backend, 'append_records', wraps=file_operations.append_records) as append_mock:
+            results, error = apply_batch(operations)
+        self.assertEqual(append_mock.call_count, 1)
+        self.assertEqual([record_id for record_id, _ in results], list(range(1, 101)))
+        self.assertEqual(len(self.read_rows()), 101)
+
+    def test_route_takes_only_text_fields(self):
+        response = server_api.app.test_client().post('/api/batch', json=[
+            {"op": "create", "first_name": None, "last_name": 12, "date_of_birth": "2000-07-20"},
+            {"op": "create", "first_name": "Emily", "last_name": "Brown", "date_of_birth": "2000-07-20"},
+        ])
+        self.assertEqual(response.get_json()["results"][0],
+                         {"success": False, "errors": ["First Name: Must be a string.", "Last Name: Must be a string."]})
+        self.assertEqual([r["first_name"] for r in get_all_records()[0]], ["Emily"])
+
+def _validate_import(rows):
+    return [[] if fields["first_name"].isalpha() else ["First Name: Name must contain only alphabetical characters."] for fields in rows]
+
+class TestBulk(BaseTestCase):
+
+    def test_csv_import_in_batches(self):
+        upload = io.BytesIO(b"ID,First Name,Last Name,Date of Birth\r\n7,Ann,Lee,1990-01-01\r\n8,B0b,Ray,1991-01-01\r\n"
+                            b"9,Cid,Moe,1992-01-01\r\n10,Dee,Orr,1993-01-01\r\n")
+        with patch.object(bulk, 'apply_batch', wraps=apply_batch) as batch_mock:
+            imported, rejected, errors, error = import_records(parse_csv(upload), _validate_import, batch_size=2)
+        self.assertEqual((imported, rejected, error), (3, 1, None))
+        self.assertEqual(errors, [{"line": 3, "errors": ["First Name: Name must contain only alphabetical characters."]}])
+        self.assertEqual(batch_mock.call_count, 2)
+
+        records, _ = get_all_records()
+        self.assertEqual([(r["id"], r["first_name"]) for r in records], [(1, "Ann"), (2, "Cid"), (3, "Dee")])
+
+    def test_ndjson_import_rejects_bad_lines(self):
+        upload = io.BytesIO(b'{"first_name": "Ann", "last_name": "Lee", "date_of_birth": "1990-01-01"}\n[1]\nnope\n'
+                            b'{"first_name": null, "last_name": "Lee", "date_of_birth": 1990}\n')
+        imported, rejected, errors, error = import_records(parse_ndjson(upload), _validate_import)
+        self.assertEqual((imported, rejected), (1, 3))
+        self.assertEqual([e["line"] for e in errors], [2, 3, 4])
+        self.assertEqual(errors[2]["errors"], ["Fields must be strings: first_name, date_of_birth."])
+
+    def test_unreadable_upload_raises(self):
+        with self.assertRaises(ValueError):
+            import_records(parse_csv(io.BytesIO(b"First Name,Last Name,Date of Birth\r\n\xff\xfe\r\n")), _validate_import)
+
+    def test_export_round_trip(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"])
+        records, _ = get_all_records()
+
+        exported = b''.join(export_csv(iter(records), batch_size=1))
+        self.assertEqual(exported, b"ID,First Name,Last Name,Date of Birth\r\n1,John,Doe,1990-01-01\r\n2,Jane,Smith,1985-05-15\r\n")
+        rows = list(parse_csv(io.BytesIO(exported)))
+        self.assertEqual([fields["first_name"] for _, fields, _ in rows], ["John", "Jane"])
+
+        compressed = b''.join(gzip_chunks(export_ndjson(iter(records))))
+        self.assertEqual([json.loads(line) for line in gzip.decompress(compressed).splitlines()], [r.to_dict() for r in records])
+
+class TestRecordTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = RecordTable.from_records([
+            {"id": 1, "first_name": "John", "last_name": "Doe", "date_of_birth": "1990-01-01"},
+            {"id": 3, "first_name": "Jane", "last_name": "Doe", "date_of_birth": "not a date"},
+            {"id": 4, "first_name": "John", "last_name": "Smith", "date_of_birth": "0999-12-31"},
+        ])
+
+    def test_rows_come_back_as_records(self):
+        self.assertEqual(self.table[:], [Record(1, "John", "Doe", "1990-01-01"), Record(3, "Jane", "Doe", "not a date"),
+                                         Record(4, "John", "Smith", "0999-12-31")])
+        self.assertEqual(self.table.get(3).to_dict(), {"id": 3, "first_name": "Jane", "last_name": "Doe", "date_of_birth": "not a date"})
+        self.assertIsNone(self.table.get(2))
+        self.assertEqual(self.table[-1]["last_name"], "Smith")
+        self.assertEqual([r.id for r in self.table[self.table.after(1):]], [3, 4])
+        self.assertIs(self.table.first_names[0], self.table.first_names[2])  # Names are interned
+
+    def test_changes(self):
+        self.table.append(Record(5, "Amy", "Lee", "2000-02-29"))
+        self.table.replace(self.table.position(3), Record(3, "Jane", "Roe", "1991-03-04"))
+        self.table.delete(self.table.position(1))
+        self.assertEqual(list(self.table), [Record(3, "Jane", "Roe", "1991-03-04"), Record(4, "John", "Smith", "0999-12-31"),
+                                            Record(5, "Amy", "Lee", "2000-02-29")])
+        self.assertEqual(self.table.births.typecode, 'i')
+
+class TestRecordStore(BaseTestCase):
+
+    def test_reads_served_from_memory(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"])
+        get_all_records()
+
+        with patch.object(csv_backend, 'read_indexed_records') as read_mock:
+            records, error = get_all_records()
+        read_mock.assert_not_called()
+        self.assertEqual([r["first_name"] for r in records], ["John"])
+
+    def test_outside_edit_is_reloaded(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"])
+        get_all_records()
+        self.add_records([2, "Jane", "Smith", "1985-05-15"])
+
+        records, error = get_all_records()
+        self.assertEqual([r["first_name"] for r in records], ["John", "Jane"])
+
+    def test_update_and_delete(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"], [3, "Emily", "Brown", "2000-07-20"])
+
+        self.assertIsNone(update_record(3, "Emma", "Brown", "2000-07-20"))
+        self.assertIsNone(delete_record(1))
+
+        records, _ = get_all_records()
+        self.assertEqual([r["id"] for r in records], [2, 3])
+        self.assertEqual(delete_record(1), "Invalid record ID. Please enter a valid ID.")
+
+    def test_write_behind_flushes_after_interval(self):
+        write_behind = RecordStore(flush_interval=0.05)
+        self.addCleanup(write_behind.close)
+
+        record_id, error = write_behind.create("John", "Doe", "1990-01-01")
+        self.assertEqual(record_id, 1)
+        self.assertEqual(len(self.read_rows()), 1)  # Still only in memory
+
+        time.sleep(0.3)
+        self.assertEqual(self.read_rows()[1:], [["1", "John", "Doe", "1990-01-01"]])
+
+    def test_close_flushes_pending_changes(self):
+        write_behind = RecordStore(flush_interval=60)
+        write_behind.create("John", "Doe", "1990-01-01")
+        write_behind.close()
+
+        self.assertEqual(self.read_rows()[1:], [["1", "John", "Doe", "1990-01-01"]])
+
+    def test_version_moves_on_every_change(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"])
+        first, _, error = self.store.version()
+        self.assertIsNone(error)
+        get_all_records()
+        self.assertEqual(self.store.version()[0], first)
+
+        create_record("Jane", "Smith", "1985-05-15")
+        second = self.store.version()[0]
+        self.assertNotEqual(second, first)
+
+        self.add_records([9, "Emily", "Brown", "2000-07-20"])  # Outside edit
+        self.assertNotIn(self.store.version()[0], (first, second))
+
+class TestWriteAheadLog(BaseTestCase):
+
+    def test_unflushed_changes_survive_a_crash(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"])
+        crashed = RecordStore(flush_interval=60)
+        self.addCleanup(crashed.close)
+        self.addCleanup(crashed._pending.clear)  # Its changes never reach the file
+
+        crashed.create("Emily", "Brown", "2000-07-20")
+        crashed.update(1, "Johnny", "Doe", "1990-01-01")
+        crashed.delete(2)
+        self.assertEqual(len(self.read_rows()), 3)  # Nothing flushed yet
+
+        # A live process's log is left alone
+        self.assertEqual(RecordStore(flush_interval=0, checkpoint_bytes=0).count(), (2, None))
+        crashed._wal.close()  # As the process dying would
+
+        recovered = RecordStore(flush_interval=0)
+        self.addCleanup(recovered.close)
+        records, error = recovered.all()
+        self.assertIsNone(error)
+        self.assertEqual([(r["id"], r["first_name"]) for r in records], [(1, "Johnny"), (3, "Emily")])
+        self.assertEqual(sorted(read_records()[0], key=lambda r: r["id"]), [r.to_dict() for r in records])
+        self.assertEqual(os.path.getsize(self.file_name + '.wal'), 0)
+        self.assertEqual(recovered.create("Anna", "Lee", "1999-09-09")[0], 4)
+
+    def test_replay_keeps_other_processes_records(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"])
+        crashed = RecordStore(flush_interval=60)
+        self.addCleanup(crashed.close)
+        self.addCleanup(crashed._pending.clear)
+        self.assertEqual(crashed.create("Jane", "Smith", "1985-05-15"), (2, None))
+        self.assertIsNone(crashed.flush())
+        self.assertEqual(crashed.create("Emily", "Brown", "2000-07-20"), (3, None))
+        self.assertIsNone(crashed.update(3, "Emily", "Green", "2000-07-20"))
+
+        # Meanwhile another process edits the flushed record and takes the unflushed one's ID
+        live = RecordStore(flush_interval=0)
+        self.addCleanup(live.close)
+        self.assertIsNone(live.update(2, "Jane", "Brown", "1985-05-15"))
+        self.assertEqual(live.create("Anna", "Lee", "1999-09-09"), (3, None))
+        crashed._wal.close()
+
+        recovered = RecordStore(flush_interval=0)
+        self.addCleanup(recovered.close)
+        records, error = recovered.all()
+        self.assertIsNone(error)
+        self.assertEqual([(r["id"], r["first_name"], r["last_name"]) for r in records],
+                         [(1, "John", "Doe"), (2, "Jane", "Brown"), (3, "Anna", "Lee"), (4, "Emily", "Green")])
+
+    def test_each_process_writes_its_own_log(self):
+        record = {"id": 1, "first_name": "John", "last_name": "Doe", "date_of_birth": "1990-01-01"}
+        first, second = WriteAheadLog(self.file_name + '.wal'), WriteAheadLog(self.file_name + '.wal')
+        first.append([("create", record)])
+        second.append([("delete", record)])
+        self.assertEqual((first.path, second.path), (self.file_name + '.wal', self.file_name + '.wal.1'))
+        self.assertEqual(second.read()[0], [("delete", record)])
+
+        third = WriteAheadLog(self.file_name + '.wal')
+        third.append([("create", record)])
+        second.close()  # Both die with their changes unflushed
+        third.close()
+        recovering = WriteAheadLog(self.file_name + '.wal')
+        self.assertEqual(recovering.read()[0], [("delete", record), ("create", record)])
+        self.assertIsNone(recovering.truncate())
+        self.assertFalse(os.path.exists(self.file_name + '.wal.2'))
+        self.assertEqual(recovering.read()[0], [])
+        recovering.close()
+        self.assertFalse(os.path.exists(self.file_name + '.wal.1'))  # Empty numbered logs are removed
+        self.assertEqual(first.read()[0], [("create", record)])
+        first.close()
+
+    def test_damaged_tail_is_ignored(self):
+        log = WriteAheadLog(self.file_name + '.wal')
+        self.addCleanup(log.close)
+        log.append([("create", {"id": 1, "first_name": "John", "last_name": "Doe", "date_of_birth": "1990-01-01"})])
+        with open(log.path, mode='ab') as file:
+            file.write(b'0badc0de {"op":"delete","id":1')
+
+        changes, error = log.read()
+        self.assertIsNone(error)
+        self.assertEqual([(op, record["id"]) for op, record in changes], [("create", 1)])
+
+    def test_one_sync_covers_earlier_appends(self):
+        log = WriteAheadLog(self.file_name + '.wal')
+        self.addCleanup(log.close)
+        record = {"id": 1, "first_name": "John", "last_name": "Doe", "date_of_birth": "1990-01-01"}
+        first, _ = log.append([("create", record)])
+        second, _ = log.append([("update", record)])
+
+        with patch.object(wal.os, 'fsync') as fsync_mock:
+            self.assertIsNone(log.sync(second))
+            self.assertIsNone(log.sync(first))
+        self.assertEqual(fsync_mock.call_count, 1)
+
+    def test_checkpoint_empties_log(self):
+        checkpointing = RecordStore(flush_interval=0, checkpoint_bytes=0)
+        self.addCleanup(checkpointing.close)
+        checkpointing.create("John", "Doe", "1990-01-01")
+
+        self.assertEqual(self.read_rows()[1:], [["1", "John", "Doe", "1990-01-01"]])
+        self.assertEqual(os.path.getsize(self.file_name + '.wal'), 0)
+
+class TestChangeFeed(BaseTestCase):
+
+    def test_changes_since_version(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"])
+        _, since, reset, error = get_changes()
+        self.assertIsNone(error)
+
+        create_record("Jane", "Smith", "1985-05-15")
+        update_record(1, "Johnny", "Doe", "1990-01-01")
+        delete_record(2)
+
+        changes, version, reset, error = get_changes(since)
+        self.assertFalse(reset)
+        self.assertEqual([(op, record["id"]) for _, op, record in changes], [("create", 2), ("update", 1), ("delete", 2)])
+        self.assertEqual(changes[-1][0], version)
+        self.assertEqual(get_changes(version)[0], [])
+        self.assertEqual(get_changes(since, limit=1)[1], changes[0][0])
+
+    def test_unknown_history_asks_for_reset(self):
+        _, since, _, _ = get_changes()
+        self.assertTrue(get_changes("0badc0de-1")[2])  # From an earlier run
+
+        self.store._changes.max_entries = 1
+        self.add_records([8, "Sam", "Scott", "2004-12-21"], [9, "Emily", "Brown", "2000-07-20"])  # Too much to log
+        changes, version, reset, error = get_changes(since)
+        self.assertTrue(reset)
+        self.assertEqual(changes, [])
+        self.assertFalse(get_changes(version)[2])
+
+    def test_outside_edits_are_logged(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"])
+        _, since, _, _ = get_changes()
+        rows = self.read_rows()
+        with open(self.file_name, mode='w', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerows([rows[0], rows[1], [2, "Jane", "Brown", "1985-05-15"], [9, "Emily", "Brown", "2000-07-20"]])
+        changes, version, reset, error = get_changes(since)
+        self.assertFalse(reset)
+        self.assertEqual([(op, record["id"], record["last_name"]) for _, op, record in changes],
+                         [("update", 2, "Brown"), ("create", 9, "Brown")])
+
+    def follow_other_process(self, make_backend):
+        # Processes serving the same data give the same version, and follow on from each other's
+        first, second = RecordStore(backend=make_backend(), flush_interval=0), RecordStore(backend=make_backend(), flush_interval=0)
+        self.addCleanup(second.close)
+        self.addCleanup(first.close)
+        self.assertEqual(first.create("Jane", "Smith", "1985-05-15"), (1, None))
+        version = first.version()[0]
+        self.assertEqual(second.version()[0], version)
+
+        self.assertIsNone(first.update(1, "Jane", "Brown", "1985-05-15"))
+        changes, current, reset, error = second.changes(version)
+        self.assertFalse(reset)
+        self.assertEqual([(op, record["last_name"]) for _, op, record in changes], [("update", "Brown")])
+        self.assertEqual(current, first.version()[0])
+        self.assertEqual(first.changes(current)[:3], ([], current, False))
+
+    def test_versions_shared_between_processes(self):
+        self.follow_other_process(lambda: None)
+
+    def test_versions_shared_between_processes_sqlite(self):
+        db_name = self.file_name + '.db'
+        self.addCleanup(lambda: [os.unlink(path) for path in glob.glob(db_name + '*')])
+        self.follow_other_process(lambda: SqliteBackend(db_name))
+
+    def test_long_poll_returns_on_change(self):
+        _, since, _, _ = get_changes()
+        timer = threading.Timer(0.1, create_record, ("Jane", "Smith", "1985-05-15"))
+        timer.start()
+        self.addCleanup(timer.join)
+
+        started = time.monotonic()
+        changes, _, _, _ = get_changes(since, wait=5)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual([op for _, op, _ in changes], ["create"])
+
+    def test_route(self):
+        client = asgi.flask_app.test_client()
+        since = client.get('/api/changes').get_json()["version"]
+        create_record("Jane", "Smith", "1985-05-15")
+
+        body = client.get('/api/changes', query_string={'since': since}).get_json()
+        self.assertEqual(body["changes"], [{"version": body["version"], "op": "create",
+                                            "record": {"id": 1, "first_name": "Jane", "last_name": "Smith", "date_of_birth": "1985-05-15"}}])
+        self.assertEqual(client.get('/api/changes', query_string={'wait': 'x'}).status_code, 400)
+
+        stream = client.get('/api/changes', query_string={'since': since}, headers={'Accept': 'text/event-stream'})
+        self.assertTrue(next(stream.response).startswith(f'event: change\nid: {body["version"]}\n'.encode()))
+        stream.close()
+
+class TestResponseEncoding(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_records(*[[i, "Ada", "Lovelace", "1990-01-01"] for i in range(1, 101)])
+        self.client = asgi.flask_app.test_client()
+
+    def test_listing_is_compressed_when_asked(self):
+        plain = self.client.get('/api/records')
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+
+        response = self.client.get('/api/records', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        self.assertLess(len(response.data), len(plain.data))
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+
+        # Too small to be worth it, but the ETag is the same kind either way
+        response = self.client.get('/api/records', query_string={'limit': 1}, headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        response = self.client.get('/api/records', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual((response.status_code, response.headers['ETag'][:2]), (304, 'W/'))
+        response = self.client.get('/api/records', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(response.headers['ETag'].startswith('W/'))
+
+    def test_columnar_layout(self):
+        body = self.client.get('/api/records', query_string={'limit': 2, 'layout': 'columns'}).get_json()
+        self.assertEqual(body["columns"], {"id": [1, 2], "first_name": ["Ada", "Ada"], "last_name": ["Lovelace", "Lovelace"],
+                                           "date_of_birth": ["1990-01-01", "1990-01-01"]})
+        self.assertNotIn("records", body)
+        self.assertEqual(body["next_cursor"], 2)
+        self.assertEqual(self.client.get('/api/records', query_string={'layout': 'rows'}).status_code, 400)
+
+    def test_unacceptable_type(self):
+        self.assertEqual(self.client.get('/api/records', headers={'Accept': 'text/html'}).status_code, 406)
+
+    @unittest.skipUnless(encoding.msgpack, "msgpack is not installed")
+    def test_msgpack(self):
+        response = self.client.get('/api/records', headers={'Accept': 'application/x-msgpack'})
+        self.assertEqual(response.mimetype, 'application/x-msgpack')
+        self.assertEqual(encoding.msgpack.unpackb(response.data)["records"], self.client.get('/api/records').get_json()["records"])
+
+    def test_asgi_listing(self):
+        headers = [('accept-encoding', 'gzip')]
+        status, response_headers, body = asyncio.run(_call_asgi('GET', '/api/records?layout=columns', headers=headers))
+        self.assertEqual((status, response_headers[b'content-encoding']), (200, b'gzip'))
+        self.assertEqual(json.loads(gzip.decompress(body))["columns"]["id"], list(range(1, 101)))
+
+        etag = response_headers[b'etag'].decode()
+        status, response_headers, _ = asyncio.run(_call_asgi('GET', '/api/records?layout=columns', headers=headers + [('if-none-match', etag)]))
+        self.assertEqual((status, response_headers[b'etag'].decode()), (304, etag))
+
+        status, response_headers, _ = asyncio.run(_call_asgi('GET', '/api/records?limit=1', headers=headers))
+        self.assertNotIn(b'content-encoding', response_headers)
+        self.assertEqual(response_headers[b'etag'].decode(), etag)
+
+class TestStats(BaseTestCase):
+
+    def test_counts_follow_changes(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1991-02-02"])
+        stats, error = get_stats()
+        self.assertEqual(stats, {"total": 2, "by_birth_year": {"1990": 1, "1991": 1}, "by_last_initial": {"D": 1, "S": 1}})
+
+        create_record("Emily", "doe", "1990-07-20")
+        update_record(2, "Jane", "Brown", "1991-02-02")
+        delete_record(1)
+        stats, _ = get_stats()
+        self.assertEqual(stats, {"total": 2, "by_birth_year": {"1990": 1, "1991": 1}, "by_last_initial": {"B": 1, "D": 1}})
+
+        self.add_records([4, "Ada", "Byron", "1815-12-10"], [5, "Al", "Bee", "unknown"])  # Outside edit
+        stats, _ = get_stats()
+        self.assertEqual(stats["by_birth_year"], {"1815": 1, "1990": 1, "1991": 1, "unkn": 1})
+        self.assertEqual(stats["by_last_initial"], {"B": 3, "D": 1})
+
+    def test_route(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"])
+        client = asgi.flask_app.test_client()
+        response = client.get('/api/stats')
+        self.assertEqual(response.get_json(), {"success": True, "total": 1, "by_birth_year": {"1990": 1}, "by_last_initial": {"D": 1}})
+        self.assertEqual(client.get('/api/stats', headers={'If-None-Match': response.headers['ETag']}).status_code, 304)
+        self.assertEqual(response.headers['ETag'], client.get('/api/records').headers['ETag'])
+
+    def test_mapped_read_mode(self):
+        # The records ETag comes from the file there; stats follow it, changes can't
+        self.add_records([1, "John", "Doe", "1990-01-01"])
+        client = asgi.flask_app.test_client()
+        with patch.object(retrieve, 'READ_MODE', 'mapped'):
+            etag = client.get('/api/records').headers['ETag']
+            self.assertEqual(client.get('/api/stats').headers['ETag'], etag)
+            self.assertTrue(client.get('/api/changes', query_string={'since': etag.strip('"')}).get_json()["reset"])
+            version = client.get('/api/changes').get_json()["version"]
+            self.assertFalse(client.get('/api/changes', query_string={'since': version}).get_json()["reset"])
+
+class TestRecordPaging(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_records(*[[i, name, "Doe", "1990-01-01"] for i, name in enumerate(("Amy", "Ben", "Cat", "Dan", "Eve"), start=1)])
+
+    def test_pages_follow_cursor(self):
+        records, next_cursor, error = get_records_page(0, 2)
+        self.assertEqual([r["first_name"] for r in records], ["Amy", "Ben"])
+        self.assertEqual(next_cursor, 2)
+
+        records, next_cursor, error = get_records_page(4, 2)
+        self.assertEqual([r["first_name"] for r in records], ["Eve"])
+        self.assertIsNone(next_cursor)
+
+    def test_cursor_is_stable_across_deletes(self):
+        records, next_cursor, error = get_records_page(0, 2)
+        delete_record(1)
+
+        records, next_cursor, error = get_records_page(next_cursor, 2)
+        self.assertEqual([r["first_name"] for r in records], ["Cat", "Dan"])
+
+    def test_iter_records_in_chunks(self):
+        records = list(iter_records(cursor=1, limit=3, chunk_size=2))
+        self.assertEqual([r["first_name"] for r in records], ["Ben", "Cat", "Dan"])
+        self.assertEqual(len(list(iter_records(chunk_size=2))), 5)
+
+class TestMappedRecords(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_records(["1", "Amy", "Doe", "1990-01-01"], ["2", "Ben", "Doe", "1991-01-01"], ["not", "a", "row"],
+                         ["4", "Cat", "Doe", "1992-01-01"], ["5", "Dan", "Doe", "1993-01-01"])
+        with open(self.file_name, 'r+b') as file:  # Tombstone Ben
+            file.seek(file.read().index(b'2,Ben'))
+            file.write(file_operations.TOMBSTONE)
+        self.add_records(["1", "Amy", "Moved", "1990-01-01"])  # A later copy of a row wins
+
+    def test_view_matches_read_records(self):
+        records, error = read_mapped_records()
+        self.assertIsNone(error)
+        expected = sorted({r["id"]: r for r in read_records()[0]}.values(), key=lambda r: r["id"])
+        self.assertEqual([r.to_dict() for r in records], expected)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[-1]["first_name"], "Dan")
+        self.assertEqual(records[0]["last_name"], "Moved")
+        self.assertEqual([r["id"] for r in records[1:]], [4, 5])
+        self.assertEqual(records.get(4)["first_name"], "Cat")
+        self.assertIsNone(records.get(2))
+        self.assertEqual(records.page(1, 1), ([records[1]], 4))
+
+    def test_view_is_a_snapshot(self):
+        records, _ = read_mapped_records()
+        self.assertIsNone(delete_record(4))
+        self.assertEqual(records.get(4)["first_name"], "Cat")
+
+    def test_mapped_read_mode_leaves_the_store_unloaded(self):
+        with patch.object(retrieve, 'READ_MODE', 'mapped'):
+            self.assertEqual(count_records(), (3, None))
+            records, next_cursor, error = get_records_page(0, 2)
+            self.assertEqual(([r["id"] for r in records], next_cursor), ([1, 4], 4))
+            self.assertEqual([r["id"] for r in iter_records(cursor=1)], [4, 5])
+            self.assertEqual(get_record(5)[0]["first_name"], "Dan")
+            self.assertIsNone(self.store._records)
+
+            version = retrieve.get_data_version()[0]
+            create_record("Eve", "Doe", "1994-01-01")
+            self.assertNotEqual(retrieve.get_data_version()[0], version)
+            self.assertEqual(count_records(), (4, None))
+
+class TestSearch(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"],
+                         [3, "Joan", "Doe", "2000-07-20"], [4, "Emily", "Brown", "1995-03-03"])
+
+    def ids(self, criteria, cursor=0, limit=None):
+        records, next_cursor, error = search_records(criteria, cursor, limit)
+        self.assertIsNone(error)
+        return [r["id"] for r in records], next_cursor
+
+    def test_name_prefix_and_exact(self):
+        self.assertEqual(self.ids({"first_name": prefix("jo")}), ([1, 3], None))
+        self.assertEqual(self.ids({"last_name": exact("DOE")}), ([1, 3], None))
+        self.assertEqual(self.ids({"first_name": exact("Jo")}), ([], None))
+
+    def test_date_range_and_combined(self):
+        self.assertEqual(self.ids({"date_of_birth": ("1990-01-01", "1999-12-31")}), ([1, 4], None))
+        self.assertEqual(self.ids({"date_of_birth": (None, "1989-12-31")}), ([2], None))
+        self.assertEqual(self.ids({"last_name": exact("Doe"), "date_of_birth": ("1995-01-01", None)}), ([3], None))
+
+    def test_unpadded_dates(self):
+        # Validation lets these through, so they have to be found like any other
+        record_id, _ = create_record("Ann", "Lee", "1995-9-5")
+        self.assertEqual(self.ids({"date_of_birth": ("1995-01-01", "1995-12-31")}), ([4, record_id], None))
+        self.assertEqual(self.ids({"date_of_birth": exact("1995-09-05")}), ([record_id], None))
+        self.assertEqual(self.ids({"date_of_birth": exact("1995-3-3")}), ([4], None))
+
+    def test_paging(self):
+        self.assertEqual(self.ids({"first_name": prefix("j")}, limit=2), ([1, 2], 2))
+        self.assertEqual(self.ids({"first_name": prefix("j")}, cursor=2, limit=2), ([3], None))
+
+    def test_paging_through_wide_ranges(self):
+        # Most records match, so these walk the records in ID order instead of the index
+        self.assertEqual(self.ids({"date_of_birth": ("1900-01-01", None)}, limit=1), ([1], 1))
+        self.assertEqual(self.ids({"date_of_birth": ("1900-01-01", None)}, cursor=1, limit=2), ([2, 3], 3))
+        self.assertEqual(self.ids({"date_of_birth": ("1900-01-01", None), "last_name": prefix("")}, cursor=3, limit=2), ([4], None))
+
+    def test_indexes_follow_changes(self):
+        self.assertIsNone(update_record(1, "Jack", "Black", "1990-01-01"))
+        self.assertIsNone(delete_record(3))
+        record_id, _ = create_record("Josh", "Doe", "2001-01-01")
+
+        self.assertEqual(self.ids({"first_name": prefix("jo")}), ([record_id], None))
+        self.assertEqual(self.ids({"last_name": exact("doe")}), ([record_id], None))
+        self.assertEqual(self.ids({"last_name": prefix("bl")}), ([1], None))
+
+class TestValidation(unittest.TestCase):
+
+    def test_name_messages(self):
+        self.assertEqual(validate_name("Jöhn"), (True, None))
+        self.assertEqual(validate_name("  "), (False, "Input cannot be empty. Please try again."))
+        self.assertEqual(validate_name("J"), (False, "Name must be between 2 and 50 characters long."))
+        self.assertEqual(validate_name("Jo hn"), (False, "Name must not contain spaces."))
+        self.assertEqual(validate_name("Jo2"), (False, "Name must contain only alphabetical characters."))
+
+    def test_date_messages(self):
+        invalid = (False, "Invalid date format or incorrect date. Please use YYYY-MM-DD.")
+        self.assertEqual(validate_dateOfBirth("2000-02-29"), (True, None))
+        self.assertEqual(validate_dateOfBirth("1990-1-5"), (True, None))  # strptime accepts unpadded fields
+        self.assertEqual(validate_dateOfBirth("2001-02-29"), invalid)
+        self.assertEqual(validate_dateOfBirth("1990/01/05"), invalid)
+        self.assertEqual(validate_dateOfBirth("1990-01-05 "), invalid)
+        tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+        self.assertEqual(validate_dateOfBirth(tomorrow), (False, "Date of birth cannot be in the future."))
+        self.assertEqual(validate_dateOfBirth(datetime.date.today().isoformat()), (True, None))
+
+    def test_batch_matches_single_records(self):
+        rows = [{"first_name": "John", "last_name": "Doe", "date_of_birth": "1990-01-01"},
+                {"first_name": "J", "last_name": "Do3", "date_of_birth": "1990-02-30"}]
+        self.assertEqual(validate_batch(rows), [validate_record(**row) for row in rows])
+        self.assertEqual(validate_batch(rows)[1], [
+            "First Name: Name must be between 2 and 50 characters long.",
+            "Last Name: Name must contain only alphabetical characters.",
+            "Date of Birth: Invalid date format or incorrect date. Please use YYYY-MM-DD.",
+        ])
+
+class TestLogging(unittest.TestCase):
+
+    def make_record(self, level=logging.INFO):
+        record = logging.LogRecord('server.api.requests', level, __file__, 1, "request", None, None)
+        record.fields = {'path': '/api/records', 'status': 200, 'records': 3}
+        return record
+
+    def test_structured_formats(self):
+        self.assertTrue(StructuredFormatter().format(self.make_record()).endswith("request path=/api/records status=200 records=3"))
+        entry = json.loads(StructuredFormatter(as_json=True).format(self.make_record()))
+        self.assertEqual((entry['message'], entry['status'], entry['records']), ("request", 200, 3))
+
+    def test_sampling_keeps_warnings(self):
+        sampler = SamplingFilter(0)
+        self.assertFalse(sampler.filter(self.make_record()))
+        self.assertTrue(sampler.filter(self.make_record(logging.WARNING)))
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 5):
+            histogram.observe(value, op="x")
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{op="x",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{op="x",le="1.0"} 3', lines)
+        self.assertIn('test_seconds_bucket{op="x",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{op="x"} 4', lines)
+
+    @unittest.skipUnless(metrics.ENABLED, "metrics are turned off")
+    def test_instrument_counts_errors(self):
+        @metrics.instrument('test_operation')
+        def failing():
+            return None, "broken"
+
+        before = metrics.storage_errors._values.get((('operation', 'test_operation'),), 0)
+        failing()
+        self.assertEqual(metrics.storage_errors._values[(('operation', 'test_operation'),)], before + 1)
+        self.assertIn('sdm_storage_seconds_count{operation="test_operation"}', metrics.render())
+
+class TestBenchmarkHelpers(BaseTestCase):
+
+    def test_generated_file_is_readable_and_repeatable(self):
+        generate_csv(self.file_name, 50, seed=7)
+        records, error = read_records()
+        self.assertIsNone(error)
+        self.assertEqual([r["id"] for r in records], list(range(1, 51)))
+
+        other = self.file_name + '.copy'
+        self.addCleanup(os.unlink, other)
+        generate_csv(other, 50, seed=7)
+        with open(self.file_name, 'rb') as first, open(other, 'rb') as second:
+            self.assertEqual(first.read(), second.read())
+
+    def test_summarize(self):
+        result = summarize([0.001] * 98 + [0.01, 0.1])
+        self.assertEqual((result["ops"], result["p50_ms"], result["p99_ms"]), (100, 1.0, 10.0))
+
+async def _call_asgi(method, path, body=b'', headers=(), chunks=None):
+    # One request through the ASGI app: (status, headers, body)
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': True} for chunk in (chunks or [])]
+    messages.append({'type': 'http.request', 'body': body, 'more_body': False})
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()  # The client stays until the response is done
+
+    async def send(message):
+        sent.append(message)
+
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+             'headers': [(name.encode(), value.encode()) for name, value in headers]}
+    await asgi.app(scope, receive, send)
+    return (sent[0]['status'], dict(sent[0]['headers']),
+            b''.join(message.get('body', b'') for message in sent[1:]))
+
+def _call_json(method, path, data):
+    return asyncio.run(_call_asgi(method, path, json.dumps(data).encode(), [('content-type', 'application/json')]))
+
+class TestAsgi(BaseTestCase):
+
+    def test_crud_routes_match_flask(self):
+        status, _, body = _call_json('POST', '/api/create', {"first_name": "Ada", "last_name": "Byron", "date_of_birth": "1990-01-01"})
+        self.assertEqual((status, json.loads(body)), (201, {"success": True, "message": "Record successfully created!", "id": 1}))
+        status, _, body = _call_json('PUT', '/api/update_record', {"record_id": 1, "first_name": "Ada", "last_name": "King", "date_of_birth": "1990-01-01"})
+        self.assertEqual(status, 200)
+        status, _, body = _call_json('POST', '/api/create', {"first_name": "A", "last_name": "Byron", "date_of_birth": "1990-01-01"})
+        self.assertEqual(status, 400)
+        self.assertIn("errors", json.loads(body))
+
+        status, headers, body = asyncio.run(_call_asgi('GET', '/api/records'))
+        client = asgi.flask_app.test_client()
+        flask_response = client.get('/api/records')
+        self.assertEqual((status, body), (200, flask_response.data))
+        self.assertEqual(headers[b'etag'].decode(), flask_response.headers['ETag'])
+
+        status, _, body = asyncio.run(_call_asgi('GET', '/api/records', headers=[('if-none-match', headers[b'etag'].decode())]))
+        self.assertEqual((status, body), (304, b''))
+
+        status, _, _ = _call_json('DELETE', '/api/delete', {"record_id": 1})
+        self.assertEqual(status, 200)
+        self.assertEqual(len(get_all_records()[0]), 0)
+
+    def test_concurrent_reads_share_one_parse(self):
+        self.add_records(["1", "John", "Doe", "1990-01-01"], ["2", "Jane", "Doe", "1991-02-02"])
+        calls = []
+
+        def counting_list_records(cursor, limit, layout='records'):
+            calls.append((cursor, limit))
+            return list_records(cursor, limit, layout)
+
+        async def many():
+            return await asyncio.gather(*[_call_asgi('GET', '/api/records') for _ in range(20)])
+
+        list_records = asgi.list_records
+        with patch.object(asgi, 'list_records', counting_list_records):
+            responses = asyncio.run(many())
+            self.assertEqual(len({body for _, _, body in responses}), 1)
+            self.assertEqual(len(calls), 1)
+
+            create_record("Ada", "Byron", "1990-01-01")
+            _, _, body = asyncio.run(_call_asgi('GET', '/api/records'))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(json.loads(body)["records"]), 3)
+
+    def test_other_routes_go_through_flask(self):
+        self.add_records(["1", "John", "Doe", "1990-01-01"])
+        status, _, body = asyncio.run(_call_asgi('GET', '/api/records/1'))
+        self.assertEqual((status, json.loads(body)["record"]["first_name"]), (200, "John"))
+
+        status, headers, body = asyncio.run(_call_asgi('GET', '/api/records?stream=ndjson'))
+        self.assertEqual((status, headers[b'content-type']), (200, b'application/x-ndjson'))
+        self.assertEqual(json.loads(body)["last_name"], "Doe")
+
+        # A chunked upload is read by Flask as it arrives
+        status, _, body = asyncio.run(_call_asgi(
+            'POST', '/api/import', headers=[('content-type', 'text/csv')],
+            chunks=[b'First Name,Last Name,Date of Birth\r\n', b'Ada,Byron,1990-01-01\r\n']))
+        self.assertEqual((status, json.loads(body)["imported"]), (200, 1))
+
+        # Malformed bodies get Flask's own error reply
+        status, _, _ = asyncio.run(_call_asgi('POST', '/api/create', b'{', [('content-type', 'application/json')]))
+        self.assertEqual(status, 400)
+
+    def stream_endlessly(self, disconnect_after=None):
+        # GET /api/records?stream=ndjson over a listing that never ends: (messages sent, whether it was closed)
+        closed = threading.Event()
+        sent = []
+
+        def endless(cursor=0, limit=None):
+            try:
+                while True:
+                    yield Record(1, "John", "Doe", "1990-01-01")
+            finally:
+                closed.set()
+
+        async def run():
+            gone = asyncio.Event()
+            messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+            async def receive():
+                if messages:
+                    return messages.pop(0)
+                await gone.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if disconnect_after is not None and len(sent) > disconnect_after:
+                    gone.set()
+
+            scope = {'type': 'http', 'method': 'GET', 'path': '/api/records', 'query_string': b'stream=ndjson', 'headers': []}
+            await asyncio.wait_for(asgi.app(scope, receive, send), 5)
+
+        with patch.object(server_api, 'iter_records', endless):
+            asyncio.run(run())
+        return sent, closed.is_set()
+
+    def test_bridged_stream_stops_when_client_leaves(self):
+        sent, closed = self.stream_endlessly(disconnect_after=3)
+        self.assertTrue(closed)
+        self.assertTrue(all(message['more_body'] for message in sent[1:]))  # Never finished
+
+    def test_bridged_request_is_cut_off(self):
+        with patch.object(asgi, 'BRIDGE_TIMEOUT', 0.05):
+            sent, closed = self.stream_endlessly()
+        self.assertTrue(closed)
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertTrue(all(message['more_body'] for message in sent[1:]))
+
+    def test_changes_match_flask(self):
+        client = asgi.flask_app.test_client()
+        since = client.get('/api/changes').get_json()["version"]
+        create_record("Jane", "Smith", "1985-05-15")
+        for path in (f'/api/changes?since={since}', '/api/changes?wait=x', '/api/changes?limit=0', '/api/changes?since=0badc0de-1'):
+            status, _, body = asyncio.run(_call_asgi('GET', path))
+            flask_response = client.get(path)
+            self.assertEqual((status, json.loads(body)), (flask_response.status_code, flask_response.get_json()))
+
+    def test_changes_long_poll(self):
+        _, since, _, _ = get_changes()
+        timer = threading.Timer(0.1, create_record, ("Jane", "Smith", "1985-05-15"))
+        timer.start()
+        self.addCleanup(timer.join)
+
+        started = time.monotonic()
+        status, _, body = asyncio.run(_call_asgi('GET', f'/api/changes?since={since}&wait=5'))
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual([change["op"] for change in json.loads(body)["changes"]], ["create"])
+
+    def test_change_streams_hold_no_threads(self):
+        # More open streams than threads, and other requests are still answered
+        _, since, _, _ = get_changes()
+
+        async def run():
+            gone = asyncio.Event()
+            streams = []
+
+            async def stream():
+                sent = []
+                messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+                async def receive():
+                    if messages:
+                        return messages.pop(0)
+                    await gone.wait()
+                    return {'type': 'http.disconnect'}
+
+                async def send(message):
+                    sent.append(message)
+
+                scope = {'type': 'http', 'method': 'GET', 'path': '/api/changes', 'query_string': f'since={since}'.encode(),
+                         'headers': [(b'accept', b'text/event-stream')]}
+                streams.append(sent)
+                await asgi.app(scope, receive, send)
+                return sent
+
+            tasks = [asyncio.ensure_future(stream()) for _ in range(4)]
+            status, _, _ = await asyncio.wait_for(_call_asgi('GET', '/api/records'), 5)
+            self.assertEqual(status, 200)
+            await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(None, create_record, "Jane", "Smith", "1985-05-15"), 5)
+            while not all(len(sent) > 1 for sent in streams):
+                await asyncio.sleep(0.01)
+            gone.set()
+            return await asyncio.wait_for(asyncio.gather(*tasks), 5)
+
+        with patch.object(asgi, 'executor', ThreadPoolExecutor(max_workers=2)):
+            results = asyncio.run(run())
+        for sent in results:
+            self.assertEqual(sent[0]['headers'][0], (b'content-type', b'text/event-stream; charset=utf-8'))
+            self.assertTrue(sent[1]['body'].startswith(b'event: change\nid: '))
+            self.assertTrue(all(message['more_body'] for message in sent[1:]))  # Left open until the client went
+
+def _create_many(count, flush_interval=0):
+    # Runs in a separate process with its own store, like a gunicorn worker
+    worker_store = RecordStore(flush_interval=flush_interval)
+    for i in range(count):
+        worker_store.create("Worker", str(os.getpid()), "1990-01-01")
+    worker_store.close()
+
+class BackendAdapter(BaseAdapter):
+    # Hands the frontend's calls to the backend API app in this process
+    def __init__(self):
+        super().__init__()
+        self.client = asgi.flask_app.test_client()
+        self.sent = []
+        self.statuses = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        url = urlsplit(request.url)
+        headers = {name: value for name, value in request.headers.items() if name != 'Accept-Encoding'}
+        result = self.client.open(url.path, method=request.method, query_string=url.query, headers=headers, data=request.body)
+        response = requests.Response()
+        response.status_code = result.status_code
+        self.statuses.append(result.status_code)
+        response.headers = CaseInsensitiveDict(result.headers)
+        response._content = result.data
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+class FrontendTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = BackendAdapter()
+        session = requests.Session()
+        session.mount('http://', self.backend)
+        for name, value in (('api_session', session), ('response_cache', frontend.ResponseCache(8, 60)),
+                            ('card_cache', frontend.CardCache(100))):
+            patcher = patch.object(frontend, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = frontend.app.test_client()
+
+class TestApiSession(FrontendTestCase):
+
+    def test_pooled_session_settings(self):
+        adapter = frontend.create_api_session().get_adapter(frontend.API_BASE_URL)
+        self.assertEqual(adapter._pool_maxsize, frontend.API_POOL_SIZE)
+        self.assertEqual(adapter.max_retries.total, frontend.API_RETRIES)
+        self.assertNotIn('POST', adapter.max_retries.allowed_methods)  # Could create a record twice
+
+    def test_routes_share_the_session(self):
+        create_record("Ada", "Byron", "1990-01-01")
+        self.client.get('/records')
+        self.client.post('/create', data={'first_name': "Bob", 'last_name': "Byron", 'dob': "1991-01-01"})
+        self.assertEqual([request.method for request in self.backend.sent], ['GET', 'POST'])
+        self.assertTrue(all(request.url.startswith(frontend.API_BASE_URL) for request in self.backend.sent))
+
+        with patch.object(frontend.api_session, 'request', wraps=frontend.api_session.request) as request:
+            frontend.call_api('GET', '/records')
+        self.assertEqual(request.call_args.kwargs['timeout'], frontend.API_TIMEOUT)
+
+class TestResponseCache(FrontendTestCase):
+
+    def test_backend_validators(self):
+        create_record("Ada", "Byron", "1990-01-01")
+        client = asgi.flask_app.test_client()
+        response = client.get('/api/records')
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(client.get('/api/records', headers={'If-None-Match': response.headers['ETag']}).status_code, 304)
+
+        create_record("Bob", "Byron", "1991-01-01")
+        self.assertEqual(client.get('/api/records', headers={'If-None-Match': response.headers['ETag']}).status_code, 200)
+
+    def test_least_recently_used_entry_is_dropped(self):
+        cache = frontend.ResponseCache(2, 60)
+        cache.put('a', None, 1)
+        cache.put('b', None, 2)
+        cache.get('a')
+        cache.put('c', None, 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a')['data'], 1)
+
+    def test_stale_pages_are_revalidated(self):
+        create_record("Ada", "Byron", "1990-01-01")
+        self.client.get('/records')
+        self.client.get('/records')
+        self.assertEqual(len(self.backend.sent), 1)  # Fresh: not asked again
+
+        frontend.response_cache.ttl = 0
+        page = self.client.get('/records').get_data(as_text=True)
+        self.assertEqual(len(self.backend.sent), 2)
+        self.assertEqual(self.backend.statuses[-1], 304)
+        self.assertIn("Byron", page)
+
+        create_record("Bob", "Smith", "1991-01-01")
+        self.assertIn("Smith", self.client.get('/records').get_data(as_text=True))
+
+class TestRecordsPage(FrontendTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_records(*[[i, "Ada", f"Lovelace{i:02d}", "1990-01-01"] for i in range(1, 51)])
+
+    def test_pages_and_fragments(self):
+        page = self.client.get('/records').get_data(as_text=True)
+        self.assertIn("Lovelace01", page)
+        self.assertIn('id="next-page"', page)
+        self.assertNotIn("Lovelace49", page)
+
+        body = self.client.get('/records/fragment', query_string={'cursor': frontend.PAGE_SIZE}).get_json()
+        self.assertTrue(body["success"])
+        self.assertIn("Lovelace49", body["html"])
+        self.assertNotIn("Lovelace48", body["html"])
+        self.assertIsNone(body["next_cursor"])
+
+    def test_cards_are_rendered_once_per_version(self):
+        cache = frontend.CardCache(10)
+        template = frontend.app.jinja_env.get_template('record_card.html')
+        with frontend.app.app_context(), patch.object(template, 'render', wraps=template.render) as render:
+            html = cache.render([Record(1, "Ada", "Byron", "1990-01-01"), Record(2, "Bob", "Byron", "1990-01-01")])
+            self.assertEqual(cache.render([Record(1, "Ada", "Byron", "1990-01-01"), Record(2, "Bob", "Byron", "1990-01-01")]), html)
+            self.assertEqual(render.call_count, 2)
+
+            self.assertIn("King", cache.render([Record(1, "Ada", "King", "1990-01-01")]))
+            cache.discard(2)
+            cache.render([Record(2, "Bob", "Byron", "1990-01-01")])
+            self.assertEqual(render.call_count, 4)
+
+    def test_failed_update_without_javascript(self):
+        response = self.client.post('/update', data={'record_id': 1, 'first_name': "A", 'last_name': "Byron", 'date_of_birth': "1990-01-01"})
+        self.assertEqual((response.status_code, urlsplit(response.location).path), (302, '/records'))
+        self.assertIn("An error occurred", self.client.get('/records').get_data(as_text=True))
+
+class TestConcurrentWrites(BaseTestCase):
+
+    def test_failed_rewrite_keeps_old_file(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"])
+        before = self.read_rows()
+
+        with patch.object(file_operations, 'encode_record', side_effect=[b'1,John,Doe,1990-01-01\r\n', OSError("disk full")]):
+            offsets, error = file_operations.write_records([
+                {"id": 1, "first_name": "John", "last_name": "Doe", "date_of_birth": "1990-01-01"},
+                {"id": 2, "first_name": "Jane", "last_name": "Smith", "date_of_birth": "1985-05-15"},
+            ])
+        self.assertIn("disk full", error)
+        self.assertEqual(self.read_rows(), before)
+        leftovers = [name for name in os.listdir(os.path.dirname(self.file_name)) if name.startswith(os.path.basename(self.file_name) + '.') and name.endswith('.tmp')]
+        self.assertEqual(leftovers, [])
+
+    def test_processes_do_not_lose_creates(self):
+        self.run_workers(0)
+
+    def test_processes_do_not_lose_write_behind_creates(self):
+        self.run_workers(store.FLUSH_INTERVAL)
+
+    def test_write_behind_merges_with_other_writer(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"])
+        first, second = RecordStore(flush_interval=60), RecordStore(flush_interval=60)
+        self.addCleanup(second.close)
+        self.addCleanup(first.close)
+        self.assertEqual(first.create("Ada", "Byron", "1990-01-01"), (3, None))
+        self.assertIsNone(first.update(3, "Ada", "King", "1990-01-01"))
+        self.assertIsNone(first.delete(1))
+        self.assertEqual(second.create("Bob", "Ray", "1991-01-01"), (3, None))
+        self.assertIsNone(second.update(2, "Jane", "Brown", "1985-05-15"))
+        self.assertIsNone(second.flush())
+        self.assertIsNone(first.flush())
+
+        self.assertEqual(sorted((r["id"], r["last_name"]) for r in read_records()[0]),
+                         [(2, "Brown"), (3, "Ray"), (4, "King")])
+        self.assertEqual(first.get(4)[0]["first_name"], "Ada")
+        self.assertEqual(second.count(), (3, None))
+
+    def merge_create_then_delete(self, make_backend):
+        # A record created and deleted before a flush, while another writer takes its ID
+        first, second = RecordStore(backend=make_backend(), flush_interval=60), RecordStore(backend=make_backend(), flush_interval=0)
+        self.addCleanup(second.close)
+        self.addCleanup(first.close)
+        self.assertEqual(first.create("Alice", "Ames", "1990-01-01"), (1, None))
+        self.assertEqual(first.create("Carl", "Cole", "1992-01-01"), (2, None))
+        self.assertIsNone(first.delete(1))
+        self.assertEqual(second.create("Bob", "Ray", "1991-01-01"), (1, None))
+        self.assertIsNone(first.flush())
+
+        fresh = RecordStore(backend=make_backend(), flush_interval=0, wal=False)
+        self.addCleanup(fresh.close)
+        for reader in (first, second, fresh):
+            records, error = reader.all()
+            self.assertIsNone(error)
+            self.assertEqual([(r["id"], r["last_name"]) for r in records], [(1, "Ray"), (2, "Cole")])
+
+    def test_merge_drops_created_then_deleted_csv(self):
+        self.merge_create_then_delete(lambda: None)
+        self.assertNotIn("Ames", open(self.file_name, encoding='utf-8').read())
+
+    def test_merge_drops_created_then_deleted_sqlite(self):
+        db_name = self.file_name + '.db'
+        self.addCleanup(lambda: [os.unlink(path) for path in glob.glob(db_name + '*')])
+        self.merge_create_then_delete(lambda: SqliteBackend(db_name))
+
+    def test_merge_drops_created_then_deleted_sharded(self):
+        self.addCleanup(lambda: [os.unlink(path) for path in glob.glob(self.file_name + '*-of-2*')])
+        self.merge_create_then_delete(lambda: ShardedBackend(2))
+
+    def run_workers(self, flush_interval):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            self.skipTest("needs fork to share the patched CSV_FILE")
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=_create_many, args=(25, flush_interval)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertTrue(all(worker.exitcode == 0 for worker in workers))
+
+        records, error = read_records()
+        self.assertIsNone(error)
+        self.assertEqual(len(records), 100)
+        self.assertEqual(sorted(r["id"] for r in records), list(range(1, 101)))
+
+
+class TestSqliteBackend(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db_name = self.file_name + '.db'
+        self.addCleanup(self.remove_database)
+        self.sqlite_store = RecordStore(backend=SqliteBackend(self.db_name), flush_interval=0)
+        self.addCleanup(self.sqlite_store.close)
+
+    def remove_database(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_name + suffix):
+                os.unlink(self.db_name + suffix)
+
+    def test_crud(self):
+        self.assertEqual(self.sqlite_store.create("John", "Doe", "1990-01-01"), (1, None))
+        self.assertEqual(self.sqlite_store.create("Jane", "Smith", "1985-05-15"), (2, None))
+        self.assertIsNone(self.sqlite_store.update(1, "Joan", "Dee", "1990-01-02"))
+        self.assertIsNone(self.sqlite_store.delete(2))
+
+        # A second connection sees what was written
+        other = SqliteBackend(self.db_name)
+        self.addCleanup(other.close)
+        records, error = other.load()
+        self.assertEqual(records, [{"id": 1, "first_name": "Joan", "last_name": "Dee", "date_of_birth": "1990-01-02"}])
+        self.assertEqual(other.allocate_id(), 3)
+
+    def test_outside_change_is_reloaded(self):
+        self.sqlite_store.create("John", "Doe", "1990-01-01")
+
+        other = SqliteBackend(self.db_name)
+        self.addCleanup(other.close)
+        other.load()
+        other.apply([("create", {"id": other.allocate_id(), "first_name": "Jane", "last_name": "Smith", "date_of_birth": "1985-05-15"})], None)
+
+        records, error = self.sqlite_store.all()
+        self.assertEqual([r["first_name"] for r in records], ["John", "Jane"])
+
+    def test_migrate_from_csv(self):
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"], [3, "Emily", "Brown", "2000-07-20"])
+        delete_record(3)
+
+        self.assertEqual(migrate_to_sqlite(self.db_name), (2, None))
+        records, _ = self.sqlite_store.all()
+        self.assertEqual([r["id"] for r in records], [1, 2])
+        self.assertEqual(self.sqlite_store.create("Sam", "Scott", "2004-12-21"), (4, None))
+
+
+class TestShardedBackend(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_records([1, "John", "Doe", "1990-01-01"], [2, "Jane", "Smith", "1985-05-15"], [3, "Emily", "Brown", "2000-07-20"],
+                         [4, "Sam", "Scott", "2004-12-21"], [5, "Anna", "Lee", "1999-09-09"])
+        delete_record(5)
+        self.addCleanup(self.remove_shards)
+        self.sharded_store = RecordStore(backend=ShardedBackend(3), flush_interval=0)
+        self.addCleanup(self.sharded_store.close)
+
+    def remove_shards(self):
+        prefix = os.path.basename(self.file_name) + '.'
+        for name in os.listdir(os.path.dirname(self.file_name)):
+            if name.startswith(prefix) and '-of-3' in name:
+                os.unlink(os.path.join(os.path.dirname(self.file_name), name))
+
+    def shard_ids(self, shard):
+        with patch.object(file_operations, 'CSV_FILE', file_operations.shard_path(shard, 3)):
+            records, error = read_records()
+        return [r["id"] for r in records]
+
+    def test_split_from_csv_file(self):
+        records, error = self.sharded_store.all()
+        self.assertIsNone(error)
+        self.assertEqual([r["id"] for r in records], [1, 2, 3, 4])
+        self.assertEqual([self.shard_ids(shard) for shard in range(3)], [[3], [1, 4], [2]])
+        self.assertEqual(self.sharded_store.create("Mia", "Wong", "2001-02-03"), (6, None))  # 5 stays retired
+
+    def test_write_touches_one_shard(self):
+        self.sharded_store.all()
+        before = [os.stat(file_operations.shard_path(shard, 3)).st_mtime_ns for shard in range(3)]
+        time.sleep(0.01)
+        self.assertIsNone(self.sharded_store.update(2, "Joan", "Smith", "1985-05-15"))
+
+        after = [os.stat(file_operations.shard_path(shard, 3)).st_mtime_ns for shard in range(3)]
+        self.assertEqual([b != a for b, a in zip(before, after)], [False, False, True])
+        self.assertEqual(self.sharded_store.get(2)[0]["first_name"], "Joan")
+
+    def test_parallel_load_matches(self):
+        self.sharded_store.all()
+        with patch.object(sharded_backend, 'PARALLEL_SCAN_BYTES', 0), patch.object(sharded_backend, 'SCAN_WORKERS', 2):
+            records, error = ShardedBackend(3).load()
+        self.assertIsNone(error)
+        self.assertEqual([r["id"] for r in records], [1, 2, 3, 4])
+        self.assertEqual(list(ShardedBackend(3).scan(1)), records[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()